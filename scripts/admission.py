@@ -0,0 +1,95 @@
+"""
+准入控制：限制并发序列数、排队请求数和排队中的prompt token总数
+
+饱和时直接拒绝新请求（HTTP 429 + Retry-After），让上游路由可以分流或重定向，
+而不是让所有请求一起堆积到超时。
+"""
+
+import math
+import threading
+from typing import Any, Dict
+
+
+class QueueFullError(Exception):
+    """服务器饱和，请求未被接受"""
+
+    def __init__(self, message: str, retry_after: int, queue_depth: int = 0):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+
+
+class AdmissionController:
+    """
+    请求生命周期: reserve() 进入队列 -> start() 开始生成 -> finish() 结束。
+    排队中被取消的请求调用 release_queued()。
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 32,
+        max_queued: int = 64,
+        max_queued_tokens: int = 1_000_000,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_tokens = max_queued_tokens
+
+        self._lock = threading.Lock()
+        self.running = 0
+        self.queued = 0
+        self.queued_tokens = 0
+        self.rejected = 0
+        self._avg_duration = 10.0  # 请求平均耗时(秒)的滑动估计
+
+    def reserve(self, prompt_tokens: int):
+        """为新请求预留排队位置，饱和时抛出 QueueFullError"""
+        with self._lock:
+            if self.queued >= self.max_queued:
+                reason = f"request queue is full ({self.queued} queued)"
+            elif self.queued and self.queued_tokens + prompt_tokens > self.max_queued_tokens:
+                reason = f"too many queued prompt tokens ({self.queued_tokens} queued)"
+            else:
+                self.queued += 1
+                self.queued_tokens += prompt_tokens
+                return
+            self.rejected += 1
+            raise QueueFullError(f"Server overloaded: {reason}", self._retry_after(), self.queued)
+
+    def can_start(self, n: int = 1) -> bool:
+        """是否还有n个并发槽位（n>1的请求每个候选占一个槽位）"""
+        return self.running + n <= self.max_concurrent
+
+    def start(self, prompt_tokens: int, n: int = 1):
+        with self._lock:
+            self.queued -= 1
+            self.queued_tokens -= prompt_tokens
+            self.running += n
+
+    def release_queued(self, prompt_tokens: int):
+        with self._lock:
+            self.queued -= 1
+            self.queued_tokens -= prompt_tokens
+
+    def finish(self, duration: float):
+        """一个序列结束，释放一个并发槽位"""
+        with self._lock:
+            self.running -= 1
+            self._avg_duration = 0.9 * self._avg_duration + 0.1 * duration
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self.running,
+                "queued": self.queued,
+                "queued_tokens": self.queued_tokens,
+                "rejected": self.rejected,
+                "max_concurrent": self.max_concurrent,
+                "max_queued": self.max_queued,
+                "max_queued_tokens": self.max_queued_tokens,
+            }
+
+    def _retry_after(self) -> int:
+        """估计排队请求清空所需的秒数"""
+        waves = (self.queued + 1) / max(self.max_concurrent, 1)
+        return max(1, min(60, math.ceil(waves * self._avg_duration)))
@@ -10,74 +10,107 @@ MLX MiniMax M2.1 OpenAI-compatible API Server
 """
 
 import argparse
+import functools
 import json
-import re
+import select
+import socket
+import sys
+import threading
 import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Iterable
 
+import mlx.core as mx
+import psutil
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from mlx_lm import load, generate
+from mlx_lm import load
 from mlx_lm.sample_utils import make_sampler
 
+# Add scripts directory to path for engine import
+sys.path.insert(0, str(Path(__file__).parent))
+
+import metrics
+import tracing
+from admission import AdmissionController, QueueFullError
+from batch_runner import BatchEndpoint, BatchManager
+from engine import GenerationEngine, GenerationOutput, GenerationRequest, RequestHandle, check_mlx_lm_version
+from kv_blocks import BlockAllocator
+from kv_cache import DEFAULT_QUANTIZED_KV_START, KVCacheConfig, kv_bytes_per_token
+from model_registry import (
+    LoadedModel,
+    ModelNotFoundError,
+    ModelRegistry,
+    ModelSpec,
+    model_nbytes,
+    parse_model_spec,
+)
+from prompt_cache import PrefixCache
+from response_cache import CachedHandle, ResponseCache, cache_key
+from response_store import ResponseStore, StoredResponse
+from scheduler import DEFAULT_PRIORITY, FairScheduler, parse_tenant_caps, parse_weights, weight_arg
+from utils import get_memory_usage
+from structured_output import GrammarCache, JSONConstraint, SchemaError, response_format_schema
+from tool_parser import TOOL_CALL_FORMATS, ToolCall, ToolCallStreamParser, detect_tool_format
+from think_parser import DEFAULT_HOLD_CHARS, THINK_CLOSE, THINK_OPEN, ThinkStreamParser, parse_think_text
+from tracing import TraceWriter
+
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
 # 全局变量
-model = None
-tokenizer = None
-model_name = None
+registry: Optional[ModelRegistry] = None  # 按model字段选择的模型及其生成引擎
 strip_think = False  # 是否去除<think>块
+think_hold_chars = DEFAULT_HOLD_CHARS  # 没有开头标签时暂存的字符数（见think_parser）
+trace_writer: Optional[TraceWriter] = None  # --trace-file
+response_cache: Optional[ResponseCache] = None  # temperature=0请求的响应cache
+response_store: Optional[ResponseStore] = None  # /v1/responses 保存的会话（previous_response_id）
+batches: Optional[BatchManager] = None  # /v1/batches 任务
+grammar_cache: Optional[GrammarCache] = None  # response_format 编译后的schema
 
 
-def strip_think_blocks(text: str) -> str:
+def strip_think_blocks(text: str, in_reasoning: bool = False, hold_chars: int = 0) -> str:
     """去除<think>...</think>块，只保留最终回复"""
-    # 匹配 <think>...</think> 或未闭合的 <think>... 到 </think>
-    # 使用 DOTALL 模式让 . 匹配换行符
-    cleaned = re.sub(r'<think>.*?</think>\s*', '', text, flags=re.DOTALL)
-    # 处理可能没有闭合标签的情况（模型输出被截断）
-    cleaned = re.sub(r'<think>.*$', '', cleaned, flags=re.DOTALL)
-    # 去除开头的空白
-    cleaned = cleaned.strip()
-    return cleaned if cleaned else text  # 如果清理后为空，返回原文
-
-
-def parse_think_blocks(text: str) -> tuple[str, str]:
-    """解析<think>块，返回 (reasoning_content, final_content)"""
-    reasoning = ""
-    final = text
-
-    # 情况1: 完整的 <think>...</think> 块
-    think_matches = re.findall(r'<think>(.*?)</think>', text, flags=re.DOTALL)
-    if think_matches:
-        reasoning = '\n'.join(think_matches).strip()
-        final = re.sub(r'<think>.*?</think>\s*', '', text, flags=re.DOTALL).strip()
-
-    # 情况2: 没有开头<think>，但有</think>结尾（模型直接输出thinking后跟</think>）
-    elif '</think>' in text:
-        parts = text.split('</think>', 1)
-        if len(parts) == 2:
-            reasoning = parts[0].strip()
-            final = parts[1].strip()
-
-    # 情况3: 只有开头<think>没有结尾（被截断）
-    elif '<think>' in text:
-        final = re.sub(r'<think>.*$', '', text, flags=re.DOTALL).strip()
-        reasoning = re.search(r'<think>(.*)', text, flags=re.DOTALL)
-        reasoning = reasoning.group(1).strip() if reasoning else ""
+    _, final = parse_think_text(text, in_reasoning, hold_chars)
+    return final if final else text  # 如果清理后为空，返回原文
+
 
+def parse_think_blocks(text: str, in_reasoning: bool = False, hold_chars: int = 0) -> tuple[str, str]:
+    """解析<think>块，返回 (reasoning_content, final_content)；hold_chars与流式解析相同"""
+    with tracing.span("think_parse"):
+        reasoning, final = parse_think_text(text, in_reasoning, hold_chars)
     return reasoning, final if final else text
 
 
-def parse_args():
+def sse_event(payload: Dict[str, Any]) -> str:
+    """序列化为一条SSE事件"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """服务器参数（batch_runner.py 的命令行复用同一组参数）"""
     parser = argparse.ArgumentParser(description="MLX API Server")
     parser.add_argument(
         "--model",
         type=str,
         default="mlx-community/MiniMax-M2.1-4bit",
-        help="模型名称 (default: MiniMax-M2.1-4bit)",
+        help="默认模型名称，启动时加载 (default: MiniMax-M2.1-4bit)",
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="*",
+        default=[],
+        help="其他可用模型，格式为 名称=路径 或 路径；按请求的model字段选择，首次使用时加载",
+    )
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="统一内存预算，加载新模型会超出时卸载最久未使用的空闲模型 (default: 总内存的90%%)",
     )
     parser.add_argument(
         "--host",
@@ -96,26 +129,259 @@ def parse_args():
         action="store_true",
         help="去除<think>块，只返回最终回复 (适用于MiniMax M2.1等reasoning模型)",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--think-hold-chars",
+        type=int,
+        default=DEFAULT_HOLD_CHARS,
+        help="推理模型的输出没有<think>开头标签时，流式响应最多暂存的字符数，"
+             f"看到</think>后作为推理内容发送；0表示不暂存 (default: {DEFAULT_HOLD_CHARS})",
+    )
+    parser.add_argument(
+        "--tool-call-parser",
+        type=str,
+        default="auto",
+        choices=["auto", "none", *TOOL_CALL_FORMATS],
+        help="工具调用的解析格式，auto按chat template识别 (default: auto)",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=32,
+        help="最大并发序列数，即连续批处理中同时decode的序列数 (default: 32)",
+    )
+    parser.add_argument(
+        "--max-queued-requests",
+        type=int,
+        default=64,
+        help="排队等待的最大请求数，超出返回429 (default: 64)",
+    )
+    parser.add_argument(
+        "--max-queued-tokens",
+        type=int,
+        default=1_000_000,
+        help="排队请求的prompt token总数上限，超出返回429 (default: 1000000)",
+    )
+    parser.add_argument(
+        "--prefill-step-size",
+        type=int,
+        default=2048,
+        help="长prompt分块prefill时每块的最大token数 (default: 2048)",
+    )
+    parser.add_argument(
+        "--step-token-budget",
+        type=int,
+        default=2048,
+        help="每个引擎步骤处理的token总数上限：decode中的序列各占1个，其余分给prefill的块；"
+             "限制长prompt对其他流token间延迟的影响，0表示不限制 (default: 2048)",
+    )
+    parser.add_argument(
+        "--prompt-cache-gb",
+        type=float,
+        default=16,
+        help="前缀KV cache的内存预算，0表示关闭 (default: 16)",
+    )
+    parser.add_argument(
+        "--max-kv-size",
+        type=int,
+        default=None,
+        help="每个序列的KV cache上限(token数)，超出后使用滑动窗口丢弃最早的上下文；"
+             "configs/mlx_standard.json 中为131072 (default: 不限制)",
+    )
+    parser.add_argument(
+        "--kv-bits",
+        type=int,
+        choices=[2, 3, 4, 5, 6, 8],
+        default=None,
+        help="KV cache量化位数，只作用于长度达到 --quantized-kv-start 的序列 (default: 不量化)",
+    )
+    parser.add_argument(
+        "--kv-group-size",
+        type=int,
+        default=64,
+        help="KV cache量化的分组大小 (default: 64)",
+    )
+    parser.add_argument(
+        "--quantized-kv-start",
+        type=int,
+        default=DEFAULT_QUANTIZED_KV_START,
+        help=f"序列长度达到该token数后才量化其KV cache (default: {DEFAULT_QUANTIZED_KV_START})",
+    )
+    parser.add_argument(
+        "--kv-blocks-gb",
+        type=float,
+        default=0,
+        help="按固定大小的KV块记账的总内存(GB)：空闲块不足时新请求排队，"
+             "正在生成的序列用尽块时以length结束；只用于连续批处理 (default: 0, 关闭)",
+    )
+    parser.add_argument(
+        "--kv-block-size",
+        type=int,
+        default=16,
+        help="每个KV块的token数 (default: 16)",
+    )
+    parser.add_argument(
+        "--response-cache-mb",
+        type=float,
+        default=0,
+        help="temperature=0请求的响应cache内存上限，0表示关闭 (default: 0)",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=3600,
+        help="响应cache条目的有效期(秒) (default: 3600)",
+    )
+    parser.add_argument(
+        "--response-cache-dir",
+        type=str,
+        default=None,
+        help="响应cache的磁盘目录，重启后仍可命中 (default: 只使用内存)",
+    )
+    parser.add_argument(
+        "--response-cache-disk-gb",
+        type=float,
+        default=1,
+        help="响应cache磁盘目录的大小上限 (default: 1)",
+    )
+    parser.add_argument(
+        "--response-store-gb",
+        type=float,
+        default=1,
+        help="store=true的/v1/responses响应（对话与KV cache）的内存上限，"
+             "后续请求用previous_response_id续接时只需prefill新输入；0表示关闭 (default: 1)",
+    )
+    parser.add_argument(
+        "--response-store-ttl",
+        type=float,
+        default=3600,
+        help="保存的响应超过该时间(秒)未被引用后失效 (default: 3600)",
+    )
+    parser.add_argument(
+        "--response-store-dir",
+        type=str,
+        default=None,
+        help="保存的响应的磁盘目录：对话记录写入磁盘，超出内存上限的KV cache溢出到磁盘，"
+             "重启后仍可续接 (default: 只使用内存)",
+    )
+    parser.add_argument(
+        "--response-store-disk-gb",
+        type=float,
+        default=8,
+        help="保存的响应磁盘目录的大小上限 (default: 8)",
+    )
+    parser.add_argument(
+        "--grammar-cache-size",
+        type=int,
+        default=64,
+        help="response_format约束解码缓存的已编译schema数（含已计算的token mask）(default: 64)",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default=None,
+        help="把每个请求的阶段耗时写入Chrome trace文件（可用Perfetto打开）(default: 不写入)",
+    )
+    parser.add_argument(
+        "--priority-weights",
+        type=weight_arg,
+        nargs="*",
+        default=["interactive=8", "batch=1"],
+        help="各优先级的调度权重，格式为 优先级=权重；请求用priority字段或X-Priority头指定 "
+             "(default: interactive=8 batch=1)",
+    )
+    parser.add_argument(
+        "--tenant-max-concurrent",
+        type=str,
+        nargs="*",
+        default=[],
+        help="每个租户的并发序列上限：N 为所有租户的默认值，租户=N 单独设置；"
+             "请求用tenant/user字段或X-Tenant头指定租户 (default: 不限制)",
+    )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        default=None,
+        help="默认模型投机解码使用的draft模型，须与其使用相同的tokenizer (default: 不使用)",
+    )
+    parser.add_argument(
+        "--num-draft-tokens",
+        type=int,
+        default=3,
+        help="投机解码每轮由draft模型提议的token数 (default: 3)",
+    )
+    parser.add_argument(
+        "--batch-dir",
+        type=str,
+        default="batches",
+        help="/v1/batches 的输入输出文件与任务状态目录（请求中的路径限定在其中），重启后继续未完成的任务 (default: batches)",
+    )
+    return parser
 
 
-def load_model(model_path: str):
-    """加载模型"""
-    global model, tokenizer, model_name
+def parse_args():
+    return build_parser().parse_args()
+
 
+def load_model(spec: ModelSpec, args) -> LoadedModel:
+    """加载模型并启动它的生成引擎（由模型注册表在首次使用时调用）"""
     print(f"\n{'='*60}")
-    print(f"正在加载模型: {model_path}")
+    print(f"正在加载模型: {spec.path}")
     print(f"{'='*60}\n")
 
     start_time = time.time()
-    model, tokenizer = load(model_path)
-    model_name = model_path
+    model, tokenizer = load(spec.path)
+    nbytes = model_nbytes(model)
+
+    draft_model = None
+    if spec.draft_path:
+        print(f"正在加载draft模型: {spec.draft_path}")
+        draft_model, draft_tokenizer = load(spec.draft_path)
+        nbytes += model_nbytes(draft_model)
+        if draft_tokenizer.vocab_size != tokenizer.vocab_size:
+            print("⚠️  draft模型的词表与主模型不一致，投机解码的接受率会很低")
     load_time = time.time() - start_time
 
-    print(f"✓ 模型加载完成！用时 {load_time:.2f} 秒\n")
+    # 每个模型有独立的并发/排队限制
+    admission = AdmissionController(
+        max_concurrent=args.max_batch_size,
+        max_queued=args.max_queued_requests,
+        max_queued_tokens=args.max_queued_tokens,
+    )
+    tenant_max_concurrent, tenant_caps = parse_tenant_caps(args.tenant_max_concurrent)
+    scheduler = FairScheduler(parse_weights(args.priority_weights), tenant_max_concurrent, tenant_caps)
+    prompt_cache_bytes = int(args.prompt_cache_gb * 1024**3)
+    block_allocator = None
+    if args.kv_blocks_gb > 0 and draft_model is None:
+        block_bytes = kv_bytes_per_token(model) * args.kv_block_size
+        if block_bytes:
+            # BatchGenerator中每个序列有自己的KV cache副本，按块记账时不能当作共享
+            block_allocator = BlockAllocator(max(1, int(args.kv_blocks_gb * 1024**3) // block_bytes),
+                                             args.kv_block_size, share=False)
+    engine = GenerationEngine(
+        model,
+        tokenizer,
+        admission=admission,
+        prefill_step_size=args.prefill_step_size,
+        step_token_budget=args.step_token_budget,
+        prefix_cache=PrefixCache(prompt_cache_bytes) if prompt_cache_bytes > 0 else None,
+        draft_model=draft_model,
+        num_draft_tokens=args.num_draft_tokens,
+        scheduler=scheduler,
+        kv_config=KVCacheConfig(args.max_kv_size, args.kv_bits, args.kv_group_size, args.quantized_kv_start),
+        block_allocator=block_allocator,
+    ).start()
+
+    if args.tool_call_parser == "auto":
+        tool_format = detect_tool_format(tokenizer)
+    else:
+        tool_format = TOOL_CALL_FORMATS.get(args.tool_call_parser)
+    print(f"工具调用格式: {tool_format.name if tool_format else '无'}")
+
+    print(f"✓ 模型加载完成！用时 {load_time:.2f} 秒 (权重 {nbytes / 1024**3:.1f} GB)\n")
+    return LoadedModel(spec, model, tokenizer, engine, nbytes, loaded_at=time.time(), tool_format=tool_format)
 
 
-def format_prompt(messages: List[Dict[str, str]]) -> str:
+def format_prompt(tokenizer, messages: List[Dict[str, str]]) -> str:
     """将OpenAI格式的messages转换为prompt"""
     if hasattr(tokenizer, 'apply_chat_template'):
         # 使用模型自带的chat template
@@ -140,218 +406,686 @@ def format_prompt(messages: List[Dict[str, str]]) -> str:
         return prompt
 
 
-@app.route("/v1/models", methods=["GET"])
-def list_models():
-    """列出可用模型"""
-    return jsonify({
-        "object": "list",
-        "data": [
-            {
-                "id": model_name,
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "local",
-            }
-        ]
-    })
+def encode_prompt(tokenizer, prompt: str) -> List[int]:
+    """将prompt文本编码为token ids（chat template已包含BOS时不重复添加）"""
+    add_special_tokens = tokenizer.bos_token is None or not prompt.startswith(tokenizer.bos_token)
+    with tracing.span("tokenize"):
+        return tokenizer.encode(prompt, add_special_tokens=add_special_tokens)
+
+
+def tokenize_messages(
+    tokenizer,
+    messages: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]] = None,
+) -> List[int]:
+    """渲染chat template并直接得到token ids（整个请求只tokenize这一次）"""
+    with tracing.span("chat_template"):
+        if hasattr(tokenizer, 'apply_chat_template'):
+            return tokenizer.apply_chat_template(
+                template_messages(messages),
+                tools=tools or None,
+                tokenize=True,
+                add_generation_prompt=True
+            )
+        return encode_prompt(tokenizer, format_prompt(tokenizer, messages))
 
 
-@app.route("/v1/chat/completions", methods=["POST"])
-def chat_completions():
-    """OpenAI兼容的chat completions端点"""
+def template_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """历史中assistant的tool_calls.arguments是JSON字符串，chat template按字典遍历参数"""
+    converted = []
+    for message in messages:
+        calls = message.get("tool_calls") if isinstance(message, dict) else None
+        if calls:
+            message = dict(message, tool_calls=[template_tool_call(call) for call in calls])
+        converted.append(message)
+    return converted
+
+
+def template_tool_call(call: Any) -> Any:
+    function = call.get("function") if isinstance(call, dict) else None
+    if not isinstance(function, dict) or not isinstance(function.get("arguments"), str):
+        return call
     try:
-        data = request.json
-
-        # 解析参数
-        messages = data.get("messages", [])
-        max_tokens = data.get("max_tokens", 500)
-        temperature = data.get("temperature", 0.7)
-        stream = data.get("stream", False)
-
-        if not messages:
-            return jsonify({"error": "messages is required"}), 400
-
-        # 格式化prompt
-        prompt = format_prompt(messages)
-
-        # 创建采样器
-        sampler = make_sampler(temp=temperature)
-
-        # 生成回复
-        start_time = time.time()
-
-        if stream:
-            # 流式响应（简化版本，实际流式需要更复杂的实现）
-            def generate_stream():
-                response = generate(
-                    model,
-                    tokenizer,
-                    prompt=prompt,
-                    max_tokens=max_tokens,
-                    sampler=sampler,
-                    verbose=False
-                )
-
-                # 创建响应ID
-                response_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-
-                # 解析thinking内容
-                reasoning_content, final_content = parse_think_blocks(response)
-
-                # 发送完整响应（简化的流式）
-                delta = {"content": final_content}
-                if reasoning_content:
-                    delta["reasoning_content"] = reasoning_content
-
-                chunk = {
-                    "id": response_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model_name,
-                    "choices": [{
-                        "index": 0,
-                        "delta": delta,
-                        "finish_reason": "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(chunk)}\n\n"
-                yield "data: [DONE]\n\n"
-
-            return Response(
-                stream_with_context(generate_stream()),
-                mimetype="text/event-stream"
-            )
+        arguments = json.loads(function["arguments"])
+    except ValueError:
+        raise BadRequestError(f"tool call {function.get('name')!r}: arguments is not valid JSON")
+    return {**call, "function": {**function, "arguments": arguments}}
+
+
+def think_hold(tokenizer) -> int:
+    """
+    流式解析时暂存开头文本的字符数：只有会输出</think>的模型（词表或chat template中
+    有该标签）才可能省略开头标签，其他模型不暂存，回复照常逐token输出。
+    """
+    template = getattr(tokenizer, "chat_template", None)
+    vocab = getattr(tokenizer, "vocab", None) or {}
+    if THINK_CLOSE in vocab or (isinstance(template, str) and THINK_CLOSE in template):
+        return think_hold_chars
+    return 0
+
+
+def prompt_opens_think(tokenizer, prompt_tokens: List[int]) -> bool:
+    """prompt是否以<think>结尾（如MiniMax M2.1的chat template），此时输出直接从推理内容开始"""
+    return tokenizer.decode(prompt_tokens[-8:]).rstrip().endswith(THINK_OPEN)
+
+
+def submit_request(prepare, data: Dict[str, Any], loop=None) -> RequestHandle:
+    """
+    按请求的model字段选择模型（首次使用时加载），构建生成请求并交给该模型的引擎线程。
+
+    返回可迭代的输出句柄（传入loop时可用async for消费）。
+    """
+    with registry.use(data.get("model")) as entry:
+        req = prepare(entry, data)
+        if response_cache is not None and data.get("temperature", 0.7) == 0:
+            # greedy解码：相同输入的输出相同，命中时直接回放
+            key = cache_key(entry.spec.path, req)
+            with tracing.span("response_cache"):
+                outputs = response_cache.get(key)
+            labels = {"endpoint": req.endpoint, "model": req.model}
+            if outputs is not None:
+                metrics.RESPONSE_CACHE_LOOKUPS.inc(result="hit", **labels)
+                return CachedHandle(entry.engine, req, outputs, loop)
+            metrics.RESPONSE_CACHE_LOOKUPS.inc(result="miss", **labels)
+            req.cache_key = key
+        with tracing.span("submit"):
+            try:
+                return entry.engine.submit(req, loop=loop)
+            except ValueError as e:
+                # 空prompt、n超出范围、prompt超过全部KV块
+                raise BadRequestError(str(e))
+
+
+class BadRequestError(Exception):
+    """请求参数错误 (HTTP 400)"""
+
+
+def parse_stop(data: Dict[str, Any]) -> List[str]:
+    """OpenAI的stop参数：字符串或字符串列表"""
+    stop = data.get("stop")
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise BadRequestError("stop must be a string or a list of strings")
+    return [s for s in stop if s]
+
+
+def parse_n(entry: LoadedModel, data: Dict[str, Any]) -> int:
+    """候选数n，n个候选共享一次prefill，每个占一个并发槽位"""
+    n = data.get("n", 1)
+    limit = entry.engine.admission.max_concurrent
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= limit:
+        raise BadRequestError(f"n must be an integer between 1 and {limit}")
+    return n
+
+
+def parse_priority(entry: LoadedModel, data: Dict[str, Any]) -> str:
+    """调度优先级，须是--priority-weights中配置的类别"""
+    priority = data.get("priority") or DEFAULT_PRIORITY
+    weights = entry.engine.scheduler.weights
+    if priority not in weights:
+        raise BadRequestError(f"priority must be one of: {', '.join(weights)}")
+    return priority
+
+
+def parse_tenant(data: Dict[str, Any]) -> str:
+    """租户：tenant字段（或X-Tenant头），否则使用OpenAI的user字段"""
+    return str(data.get("tenant") or data.get("user") or "")
+
+
+def merge_scheduling_headers(data: Any, headers: Dict[str, str]) -> Any:
+    """X-Priority / X-Tenant 请求头等价于请求体中的priority / tenant字段（请求体优先）"""
+    if isinstance(data, dict):
+        for header, key in (("x-priority", "priority"), ("x-tenant", "tenant")):
+            if header in headers and not data.get(key):
+                data[key] = headers[header]
+    return data
+
+
+def parse_response_format(entry: LoadedModel, response_format: Any, prompt_tokens: List[int]) -> Optional[JSONConstraint]:
+    """response_format为json_object/json_schema时返回约束解码的logits processor工厂"""
+    try:
+        schema = response_format_schema(response_format)
+        if schema is None:
+            return None
+        with tracing.span("grammar"):
+            grammar = grammar_cache.get(entry.spec.path, entry.tokenizer, schema)
+    except SchemaError as e:
+        raise BadRequestError(f"invalid response_format: {e}")
+    # prompt以<think>结尾时先自由生成推理内容，</think>之后的回复才受约束
+    wait_for = THINK_CLOSE if prompt_opens_think(entry.tokenizer, prompt_tokens) else None
+    return JSONConstraint(grammar, wait_for)
+
+
+def parse_tools(entry: LoadedModel, data: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """
+    tools参数（chat completions格式；Responses API的扁平格式会被转换）。
+
+    tool_choice为"none"时不向模型提供工具；required或指定函数不做强制。
+    """
+    tools = data.get("tools")
+    if not tools or data.get("tool_choice") == "none":
+        return None
+    if not isinstance(tools, list) or not all(isinstance(tool, dict) for tool in tools):
+        raise BadRequestError("tools must be a list of objects")
+    return [
+        tool if "function" in tool or tool.get("type", "function") != "function"
+        else {"type": "function", "function": {k: v for k, v in tool.items() if k != "type"}}
+        for tool in tools
+    ]
+
+
+def tool_call_options(entry: LoadedModel, data: Dict[str, Any],
+                      tools: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    工具调用解析器工厂；parallel_tool_calls为false时在第一个调用结束后停止生成，
+    客户端可以立即执行工具，不必等待模型之后的输出。
+    """
+    fmt = entry.tool_format
+    if not tools or fmt is None:
+        return {}
+    options = {"tool_parser": functools.partial(ToolCallStreamParser, fmt, tools)}
+    if data.get("parallel_tool_calls") is False:
+        options["stop_after"] = [fmt.invoke_close]
+    return options
+
+
+def prepare_chat(entry: LoadedModel, data: Dict[str, Any]) -> GenerationRequest:
+    """解析chat completions请求参数"""
+    messages = data.get("messages", [])
+    if not messages:
+        raise BadRequestError("messages is required")
+
+    # 渲染chat template并tokenize
+    tools = parse_tools(entry, data)
+    prompt_tokens = tokenize_messages(entry.tokenizer, messages, tools)
+    return GenerationRequest(
+        prompt_tokens=prompt_tokens,
+        max_tokens=data.get("max_tokens", 500),
+        sampler=make_sampler(temp=data.get("temperature", 0.7)),
+        stop=parse_stop(data),
+        n=parse_n(entry, data),
+        model=entry.name,
+        endpoint="/v1/chat/completions",
+        priority=parse_priority(entry, data),
+        tenant=parse_tenant(data),
+        logits_processor=parse_response_format(entry, data.get("response_format"), prompt_tokens),
+        **tool_call_options(entry, data, tools),
+    )
 
+
+def responses_input_messages(items: List[Any]) -> List[Dict[str, Any]]:
+    """
+    Responses API的input项转换为chat消息：function_call合并为带tool_calls的assistant消息，
+    function_call_output转换为tool消息，其他项原样保留。
+    """
+    messages: List[Dict[str, Any]] = []
+    for item in items:
+        kind = item.get("type") if isinstance(item, dict) else None
+        if kind == "function_call":
+            call = {
+                "id": item.get("call_id") or item.get("id"),
+                "type": "function",
+                "function": {"name": item.get("name"), "arguments": item.get("arguments") or "{}"},
+            }
+            last = messages[-1] if messages else None
+            if last is not None and last.get("role") == "assistant" and "tool_calls" in last:
+                last["tool_calls"].append(call)
+            else:
+                messages.append({"role": "assistant", "content": "", "tool_calls": [call]})
+        elif kind == "function_call_output":
+            output = item.get("output")
+            messages.append({
+                "role": "tool",
+                "tool_call_id": item.get("call_id"),
+                "content": output if isinstance(output, str) else json.dumps(output, ensure_ascii=False),
+            })
         else:
-            # 非流式响应
-            response = generate(
-                model,
-                tokenizer,
-                prompt=prompt,
-                max_tokens=max_tokens,
-                sampler=sampler,
-                verbose=False
-            )
+            messages.append(item)
+    return messages
 
-            generation_time = time.time() - start_time
 
-            # 解析thinking内容
-            reasoning_content, final_content = parse_think_blocks(response)
+def prepare_responses(entry: LoadedModel, data: Dict[str, Any]) -> GenerationRequest:
+    """
+    解析Responses API请求参数。
 
-            # 根据设置选择输出
-            if strip_think:
-                output_content = final_content
-            else:
-                output_content = response  # 保留原始响应
+    带previous_response_id时，新输入接在保存的对话之后，并复用上一轮的KV cache；
+    store不为false时保存本轮的对话与KV cache，供下一轮续接。
+    """
+    # Responses API使用input字段
+    input_data = data.get("input", data.get("messages", []))
 
-            # 计算tokens
-            prompt_tokens = len(tokenizer.encode(prompt))
-            completion_tokens = len(tokenizer.encode(response))
-            total_tokens = prompt_tokens + completion_tokens
+    # 转换input格式为messages
+    if isinstance(input_data, str):
+        messages = [{"role": "user", "content": input_data}]
+    elif isinstance(input_data, list):
+        messages = responses_input_messages(input_data)
+    else:
+        messages = [{"role": "user", "content": str(input_data)}]
+
+    if not messages:
+        raise BadRequestError("input is required")
+
+    resume_cache = None
+    previous_id = data.get("previous_response_id")
+    if previous_id:
+        if response_store is None:
+            raise BadRequestError("previous_response_id requires the response store (--response-store-gb > 0)")
+        previous = response_store.get(str(previous_id))
+        if previous is None:
+            raise BadRequestError(f"previous response {previous_id} not found")
+        messages = previous.messages + messages
+        # 只在磁盘上的KV cache在这里读入，不占用引擎线程
+        with tracing.span("preload_cache"):
+            response_store.preload_cache(previous.id, entry.spec.path)
+        resume_cache = functools.partial(response_store.load_cache, previous.id, entry.spec.path)
+
+    response_id = f"resp_{uuid.uuid4().hex[:12]}"
+    store = response_store is not None and data.get("store", True) is not False
+    tools = parse_tools(entry, data)
+    prompt_tokens = tokenize_messages(entry.tokenizer, messages, tools)
+    # Responses API的结构化输出参数是text.format
+    text = data.get("text")
+    response_format = text.get("format") if isinstance(text, dict) else None
+    return GenerationRequest(
+        prompt_tokens=prompt_tokens,
+        max_tokens=data.get("max_output_tokens", data.get("max_tokens", 500)),
+        sampler=make_sampler(temp=data.get("temperature", 0.7)),
+        stop=parse_stop(data),
+        model=entry.name,
+        endpoint="/v1/responses",
+        priority=parse_priority(entry, data),
+        tenant=parse_tenant(data),
+        resume_cache=resume_cache,
+        on_cache=functools.partial(response_store.put_cache, response_id, entry.spec.path) if store else None,
+        response_id=response_id,
+        messages=messages if store else None,
+        logits_processor=parse_response_format(entry, response_format, prompt_tokens),
+        **tool_call_options(entry, data, tools),
+    )
 
-            # 构建消息对象
-            message = {
-                "role": "assistant",
-                "content": final_content  # 总是返回清理后的内容作为主要content
-            }
 
-            # 如果有reasoning内容，添加到响应中（类似云API）
-            if reasoning_content:
-                message["reasoning_content"] = reasoning_content
-
-            # 返回OpenAI格式的响应
-            return jsonify({
-                "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model_name,
-                "choices": [{
-                    "index": 0,
-                    "message": message,
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": prompt_tokens,
-                    "completion_tokens": completion_tokens,
-                    "total_tokens": total_tokens
-                },
-                "system_fingerprint": f"mlx-{model_name}",
-                # 自定义字段
-                "_mlx_stats": {
-                    "generation_time": round(generation_time, 2),
-                    "tokens_per_second": round(completion_tokens / generation_time, 2) if generation_time > 0 else 0
-                }
-            })
+def prepare_completion(entry: LoadedModel, data: Dict[str, Any]) -> GenerationRequest:
+    """解析completions请求参数"""
+    prompt = data.get("prompt", "")
+    if not prompt:
+        raise BadRequestError("prompt is required")
+
+    return GenerationRequest(
+        prompt_tokens=encode_prompt(entry.tokenizer, prompt),
+        max_tokens=data.get("max_tokens", 500),
+        sampler=make_sampler(temp=data.get("temperature", 0.7)),
+        stop=parse_stop(data),
+        n=parse_n(entry, data),
+        model=entry.name,
+        endpoint="/v1/completions",
+        priority=parse_priority(entry, data),
+        tenant=parse_tenant(data),
+    )
 
-    except Exception as e:
-        return jsonify({
-            "error": {
-                "message": str(e),
-                "type": "internal_error",
-                "code": 500
-            }
-        }), 500
 
+@dataclass
+class GenerationChoice:
+    """一个候选的完整文本"""
+    text: str
+    finish_reason: str
+
+
+@dataclass
+class GenerationResult:
+    """一次生成的文本与统计，token数来自实际的prompt/生成token ids"""
+    model: str
+    choices: List[GenerationChoice]
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    generation_time: float
+    tokens_per_second: float
+    in_reasoning: bool = False  # 输出是否从<think>块内部开始
+    think_hold: int = 0  # 解析<think>块时暂存开头文本的字符数（与流式解析一致）
+    draft_proposed: int = 0  # 投机解码: draft模型提议的token数
+    draft_accepted: int = 0  # 投机解码: 被主模型接受的draft token数
+    kv_bytes: int = 0  # 单个序列结束时的KV cache字节数
+    response_id: Optional[str] = None  # Responses API: 预先分配的响应id
+    messages: Optional[List[Dict[str, Any]]] = None  # Responses API: 需要保存时为本轮完整的输入消息
+    tool_parser: Optional[Any] = None  # 请求带tools时的ToolCallStreamParser工厂
+
+    @property
+    def text(self) -> str:
+        return self.choices[0].text
+
+    @property
+    def finish_reason(self) -> str:
+        return self.choices[0].finish_reason
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def mlx_stats(self) -> Dict[str, Any]:
+        stats = {
+            "generation_time": round(self.generation_time, 2),
+            "tokens_per_second": round(self.tokens_per_second, 2)
+        }
+        if self.draft_proposed:
+            stats["draft_tokens_proposed"] = self.draft_proposed
+            stats["draft_tokens_accepted"] = self.draft_accepted
+            stats["draft_acceptance_rate"] = round(self.draft_accepted / self.draft_proposed, 4)
+        if self.kv_bytes:
+            stats["kv_cache_bytes_per_sequence"] = self.kv_bytes
+        return stats
+
+
+def generation_result(handle: RequestHandle, outputs: Iterable[GenerationOutput]) -> GenerationResult:
+    """按候选拼接输出文本，并根据句柄的计时和每个候选的最后一个输出汇总统计"""
+    n = handle.request.n
+    texts = [""] * n
+    lasts: List[Optional[GenerationOutput]] = [None] * n
+    for out in outputs:
+        texts[out.index] += out.text
+        lasts[out.index] = out
+
+    completion_tokens = sum(last.generation_tokens for last in lasts if last)
+    finished_at = handle.finished_at or time.perf_counter()
+    trace_generation(handle, completion_tokens, finished_at)
+    if handle.request.cache_key and response_cache is not None:
+        store_response(handle.request.cache_key, texts, lasts)
+    # decode速度不含prefill（首token之前的时间）
+    decode_time = finished_at - handle.first_token_at if handle.first_token_at else 0
+    return GenerationResult(
+        model=handle.request.model,
+        choices=[
+            GenerationChoice(text, (last.finish_reason if last else None) or "stop")
+            for text, last in zip(texts, lasts)
+        ],
+        prompt_tokens=len(handle.request.prompt_tokens),
+        completion_tokens=completion_tokens,
+        cached_tokens=handle.cached_tokens,
+        generation_time=finished_at - handle.submitted_at,
+        tokens_per_second=completion_tokens / decode_time if decode_time > 0 else 0,
+        in_reasoning=prompt_opens_think(handle.engine.tokenizer, handle.request.prompt_tokens),
+        think_hold=think_hold(handle.engine.tokenizer),
+        draft_proposed=handle.draft_proposed,
+        draft_accepted=handle.draft_accepted,
+        kv_bytes=handle.kv_bytes,
+        response_id=handle.request.response_id,
+        messages=handle.request.messages,
+        tool_parser=handle.request.tool_parser,
+    )
 
-@app.route("/v1/responses", methods=["POST"])
-def responses():
-    """OpenAI Responses API端点（用于openai-responses API类型）"""
-    try:
-        data = request.json
-
-        # Responses API使用input字段
-        input_data = data.get("input", data.get("messages", []))
-        max_tokens = data.get("max_output_tokens", data.get("max_tokens", 500))
-        temperature = data.get("temperature", 0.7)
-
-        # 转换input格式为messages
-        if isinstance(input_data, str):
-            messages = [{"role": "user", "content": input_data}]
-        elif isinstance(input_data, list):
-            messages = input_data
-        else:
-            messages = [{"role": "user", "content": str(input_data)}]
-
-        if not messages:
-            return jsonify({"error": "input is required"}), 400
-
-        # 格式化prompt
-        prompt = format_prompt(messages)
-
-        # 创建采样器
-        sampler = make_sampler(temp=temperature)
-
-        # 生成
-        start_time = time.time()
-        response = generate(
-            model,
-            tokenizer,
-            prompt=prompt,
-            max_tokens=max_tokens,
-            sampler=sampler,
-            verbose=False
-        )
-        generation_time = time.time() - start_time
 
-        # 解析thinking内容
-        reasoning_content, final_content = parse_think_blocks(response)
+def store_response(key: str, texts: List[str], lasts: List[Optional[GenerationOutput]]):
+    """把正常结束的生成结果存入响应cache（每个候选一个完整输出）"""
+    if not all(last and last.finish_reason in ("stop", "length") for last in lasts):
+        return
+    response_cache.put(key, [
+        GenerationOutput(text, None, last.finish_reason, last.prompt_tokens, last.generation_tokens, index)
+        for index, (text, last) in enumerate(zip(texts, lasts))
+    ])
+
+
+def trace_generation(handle: RequestHandle, completion_tokens: int, finished_at: float):
+    """用句柄上的时间戳补记引擎线程内的阶段：排队、prefill、decode"""
+    trace = tracing.current()
+    if trace is None:
+        return
+    started_at = handle.started_at or finished_at
+    first_token_at = handle.first_token_at or finished_at
+    generate = trace.add("generate", handle.submitted_at, finished_at, model=handle.request.model, n=handle.request.n)
+    trace.add("queue", handle.submitted_at, started_at, parent=generate)
+    trace.add(
+        "prefill", started_at, first_token_at, parent=generate,
+        prompt_tokens=len(handle.request.prompt_tokens), cached_tokens=handle.cached_tokens,
+    )
+    trace.add(
+        "decode", first_token_at, finished_at, parent=generate,
+        completion_tokens=completion_tokens, detokenize_ms=round(handle.detokenize_time * 1000, 3),
+    )
+
 
-        # 计算tokens
-        prompt_tokens = len(tokenizer.encode(prompt))
-        completion_tokens = len(tokenizer.encode(response))
+def attach_trace(body: Dict[str, Any], data: Dict[str, Any]) -> Dict[str, Any]:
+    """请求带有 "mlx_trace": true 时，在响应中附上目前为止的span树"""
+    trace = tracing.current()
+    if trace is not None and data.get("mlx_trace"):
+        body["_mlx_trace"] = trace.to_dict()
+    return body
 
-        # 构建output数组（Responses API格式）
-        output = []
 
-        # 如果有reasoning，添加reasoning output
-        if reasoning_content:
-            output.append({
-                "type": "reasoning",
-                "id": f"rs_{uuid.uuid4().hex[:12]}",
-                "summary": [{"type": "summary_text", "text": reasoning_content[:200] + "..." if len(reasoning_content) > 200 else reasoning_content}]
-            })
+def export_trace():
+    """结束当前请求的trace，并写入--trace-file"""
+    trace = tracing.current()
+    if trace is None:
+        return
+    trace.finish()
+    if trace_writer is not None:
+        trace_writer.write(trace)
+
+
+def render_body(build, result: GenerationResult, data: Dict[str, Any]) -> str:
+    """构建并序列化非流式响应，分别记录两者的耗时"""
+    with tracing.span("build_response"):
+        body = attach_trace(build(result), data)
+    with tracing.span("serialize"):
+        payload = json.dumps(body)
+    export_trace()
+    return payload
+
+
+def collect_generation(handle: RequestHandle) -> GenerationResult:
+    """等待生成结束，返回完整文本和统计"""
+    return generation_result(handle, list(handle))
+
+
+async def collect_generation_async(handle: RequestHandle) -> GenerationResult:
+    """collect_generation 的协程版本（ASGI模式）"""
+    return generation_result(handle, [out async for out in handle])
+
+
+def chat_usage(result: GenerationResult) -> Dict[str, Any]:
+    """chat/completions 格式的usage字段"""
+    return {
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": result.completion_tokens,
+        "total_tokens": result.total_tokens,
+        "prompt_tokens_details": {"cached_tokens": result.cached_tokens}
+    }
+
+
+def error_body(message: str, error_type: str, code: int) -> Dict[str, Any]:
+    return {
+        "error": {
+            "message": message,
+            "type": error_type,
+            "code": code
+        }
+    }
+
+
+def overloaded_headers(e: QueueFullError) -> Dict[str, str]:
+    """服务器饱和时的响应头，Retry-After提示客户端何时重试"""
+    return {
+        "Retry-After": str(e.retry_after),
+        "X-Queue-Depth": str(e.queue_depth)
+    }
+
+
+def parse_tool_calls(result: GenerationResult, content: str) -> tuple[str, List[ToolCall]]:
+    """从最终回复中分离工具调用，返回 (content, 工具调用)"""
+    if result.tool_parser is None:
+        return content, []
+    parser = result.tool_parser()
+    parser.feed(content)
+    parser.finish()
+    return parser.result()
+
+
+def tool_finish_reason(finish_reason: str, has_tool_calls: bool) -> str:
+    """正常结束且包含工具调用时，finish_reason为tool_calls（与OpenAI一致）"""
+    return "tool_calls" if has_tool_calls and finish_reason == "stop" else finish_reason
+
 
-        # 添加message output
+def chat_completion_body(result: GenerationResult) -> Dict[str, Any]:
+    """构建非流式chat completion响应"""
+    choices = []
+    for index, choice in enumerate(result.choices):
+        # 解析thinking内容与工具调用
+        reasoning_content, final_content = parse_think_blocks(choice.text, result.in_reasoning, result.think_hold)
+        final_content, tool_calls = parse_tool_calls(result, final_content)
+
+        # 构建消息对象
+        message = {
+            "role": "assistant",
+            "content": final_content  # 总是返回清理后的内容作为主要content
+        }
+
+        # 如果有reasoning内容，添加到响应中（类似云API）
+        if reasoning_content and not strip_think:
+            message["reasoning_content"] = reasoning_content
+
+        if tool_calls:
+            message["content"] = final_content or None
+            message["tool_calls"] = [call.to_dict() for call in tool_calls]
+
+        choices.append({
+            "index": index,
+            "message": message,
+            "finish_reason": tool_finish_reason(choice.finish_reason, bool(tool_calls))
+        })
+
+    # 返回OpenAI格式的响应
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": result.model,
+        "choices": choices,
+        "usage": chat_usage(result),
+        "system_fingerprint": f"mlx-{result.model}",
+        # 自定义字段
+        "_mlx_stats": result.mlx_stats()
+    }
+
+
+class ChatStream:
+    """把引擎输出转换为 chat.completion.chunk SSE事件（Flask与ASGI共用）"""
+
+    def __init__(self, handle: RequestHandle, trace: bool = False):
+        self.handle = handle
+        self.trace = trace  # 是否在usage chunk中附上span树
+        self.response_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+        self.created = int(time.time())
+        # 全部输出（结束时拼接各候选的完整文本，写入响应缓存）和每个候选的<think>解析器
+        self.outputs: List[GenerationOutput] = []
+        in_reasoning = prompt_opens_think(handle.engine.tokenizer, handle.request.prompt_tokens)
+        hold = think_hold(handle.engine.tokenizer)
+        self.think = [ThinkStreamParser(in_reasoning, hold) for _ in range(handle.request.n)]
+        # 请求带tools时，最终回复再经过工具调用解析器
+        tool_parser = handle.request.tool_parser
+        self.tools = [tool_parser() for _ in range(handle.request.n)] if tool_parser else None
+
+    def make_chunk(
+        self,
+        delta: Dict[str, Any],
+        finish_reason: Optional[str] = None,
+        index: int = 0,
+    ) -> Dict[str, Any]:
+        return {
+            "id": self.response_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.handle.request.model,
+            "choices": [{
+                "index": index,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
+
+    def start(self) -> List[str]:
+        # 第一个chunk只携带role（与OpenAI一致）
+        return [
+            sse_event(self.make_chunk({"role": "assistant", "content": ""}, index=index))
+            for index in range(len(self.think))
+        ]
+
+    def feed(self, out: GenerationOutput) -> List[str]:
+        self.outputs.append(out)
+        return self.deltas(out.index, *self.think[out.index].feed(out.text))
+
+    def deltas(self, index: int, reasoning: str, content: str, final: bool = False) -> List[str]:
+        """
+        <think>块内的文本作为reasoning_content增量发送，--strip-think时丢弃；
+        工具调用在识别出函数名与每个参数时作为tool_calls增量发送。
+        """
+        events = []
+        # 多字节字符或被暂存的标签前缀可能产生空片段，跳过
+        if reasoning and not strip_think:
+            events.append(sse_event(self.make_chunk({"reasoning_content": reasoning}, index=index)))
+        tool_deltas = []
+        if self.tools is not None:
+            parser = self.tools[index]
+            content, tool_deltas = parser.feed(content)
+            if final:
+                rest, more = parser.finish()
+                content, tool_deltas = content + rest, tool_deltas + more
+        if content:
+            events.append(sse_event(self.make_chunk({"content": content}, index=index)))
+        if tool_deltas:
+            delta = {"tool_calls": [d.to_dict() for d in tool_deltas]}
+            events.append(sse_event(self.make_chunk(delta, index=index)))
+        return events
+
+    def finish(self) -> List[str]:
+        result = generation_result(self.handle, self.outputs)
+        events = []
+        for index, parser in enumerate(self.think):
+            events += self.deltas(index, *parser.finish(), final=True)
+            # 结束chunk: length = 达到max_tokens, stop = 遇到EOS或stop字符串, tool_calls = 调用了工具
+            has_tool_calls = self.tools is not None and bool(self.tools[index].calls)
+            finish_reason = tool_finish_reason(result.choices[index].finish_reason, has_tool_calls)
+            events.append(sse_event(self.make_chunk({}, finish_reason, index)))
+
+        # 最后一个chunk携带usage（choices为空）
+        usage_chunk = self.make_chunk({})
+        usage_chunk["choices"] = []
+        usage_chunk["usage"] = chat_usage(result)
+        usage_chunk["_mlx_stats"] = result.mlx_stats()
+        if self.trace:
+            attach_trace(usage_chunk, {"mlx_trace": True})
+        export_trace()
+
+        return events + [
+            sse_event(usage_chunk),
+            "data: [DONE]\n\n",
+        ]
+
+    def error(self, e: Exception) -> List[str]:
+        # 响应头已发送，只能以事件形式报告错误
+        export_trace()
+        return [sse_event(error_body(str(e), "internal_error", 500)), "data: [DONE]\n\n"]
+
+
+def responses_body(result: GenerationResult) -> Dict[str, Any]:
+    """构建Responses API响应"""
+    # 解析thinking内容与工具调用
+    reasoning_content, final_content = parse_think_blocks(result.text, result.in_reasoning, result.think_hold)
+    final_content, tool_calls = parse_tool_calls(result, final_content)
+
+    # 构建output数组（Responses API格式）
+    output = []
+
+    # 如果有reasoning，添加reasoning output
+    if reasoning_content and not strip_think:
+        output.append({
+            "type": "reasoning",
+            "id": f"rs_{uuid.uuid4().hex[:12]}",
+            "summary": [{"type": "summary_text", "text": reasoning_content[:200] + "..." if len(reasoning_content) > 200 else reasoning_content}]
+        })
+
+    # 添加message output（只有工具调用时省略）
+    if final_content or not tool_calls:
         output.append({
             "type": "message",
             "id": f"msg_{uuid.uuid4().hex[:12]}",
@@ -359,98 +1093,432 @@ def responses():
             "content": [{"type": "output_text", "text": final_content}]
         })
 
-        # 返回Responses API格式
-        return jsonify({
-            "id": f"resp_{uuid.uuid4().hex[:12]}",
-            "object": "response",
-            "created_at": int(time.time()),
-            "model": model_name,
-            "output": output,
-            "usage": {
-                "input_tokens": prompt_tokens,
-                "output_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
-            },
-            "status": "completed"
+    # 每个工具调用一个function_call output
+    for call in tool_calls:
+        output.append({
+            "type": "function_call",
+            "id": f"fc_{uuid.uuid4().hex[:12]}",
+            "call_id": call.id,
+            "name": call.name,
+            "arguments": call.arguments,
+            "status": "completed" if call.complete else "incomplete",
         })
 
-    except Exception as e:
-        return jsonify({
-            "error": {
-                "message": str(e),
-                "type": "internal_error",
-                "code": 500
+    # 返回Responses API格式
+    body = {
+        "id": result.response_id or f"resp_{uuid.uuid4().hex[:12]}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": result.model,
+        "output": output,
+        "usage": {
+            "input_tokens": result.prompt_tokens,
+            "output_tokens": result.completion_tokens,
+            "total_tokens": result.total_tokens,
+            "input_tokens_details": {"cached_tokens": result.cached_tokens}
+        },
+        "status": "completed",
+        "store": result.messages is not None,
+        "_mlx_stats": result.mlx_stats()
+    }
+    if result.messages is not None and response_store is not None:
+        store_conversation(result, body)
+    return body
+
+
+def store_conversation(result: GenerationResult, body: Dict[str, Any]):
+    """保存本轮对话：assistant消息使用模型的原始输出，续接时重新渲染的历史与保存的KV一致"""
+    text = THINK_OPEN + result.text if result.in_reasoning else result.text
+    response_store.put(StoredResponse(
+        id=body["id"],
+        messages=result.messages + [{"role": "assistant", "content": text}],
+        body=body,
+        created=time.time(),
+    ))
+
+
+def stored_response_body(response_id: str) -> Optional[Dict[str, Any]]:
+    """GET /v1/responses/{id}：保存的响应体，不存在时为None"""
+    record = response_store.get(response_id) if response_store is not None else None
+    return record.body if record is not None else None
+
+
+def delete_response(response_id: str) -> Optional[Dict[str, Any]]:
+    """DELETE /v1/responses/{id}：删除保存的对话与KV cache，不存在时为None"""
+    if response_store is None or not response_store.delete(response_id):
+        return None
+    return {"id": response_id, "object": "response", "deleted": True}
+
+
+def completion_body(result: GenerationResult) -> Dict[str, Any]:
+    """构建completions响应"""
+    return {
+        "id": f"cmpl-{uuid.uuid4().hex[:8]}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": result.model,
+        "choices": [
+            {
+                "text": choice.text,
+                "index": index,
+                "finish_reason": choice.finish_reason
             }
-        }), 500
+            for index, choice in enumerate(result.choices)
+        ],
+        "usage": chat_usage(result),
+        "_mlx_stats": result.mlx_stats()
+    }
+
+
+# /v1/batches 支持的端点：请求体解析与响应体构建与在线端点相同
+BATCH_ENDPOINTS = {
+    "/v1/chat/completions": BatchEndpoint(prepare_chat, chat_completion_body),
+    "/v1/completions": BatchEndpoint(prepare_completion, completion_body),
+    "/v1/responses": BatchEndpoint(prepare_responses, responses_body),
+}
+
+
+def create_batch(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    创建批处理任务。input_file 是 --batch-dir 内的JSONL路径（不实现 /v1/files 上传，
+    input_file_id 同样按路径处理）；output_file 默认写入 --batch-dir，指定时也必须
+    在其中且尚不存在。
+    """
+    input_file = data.get("input_file") or data.get("input_file_id")
+    if not isinstance(input_file, str):
+        raise BadRequestError("input_file must be a path to a JSONL file in the batch directory")
+    output_file = data.get("output_file")
+    if output_file is not None and not isinstance(output_file, str):
+        raise BadRequestError("output_file must be a path in the batch directory")
+    try:
+        job = batches.create(
+            input_file,
+            endpoint=data.get("endpoint", "/v1/chat/completions"),
+            output_file=output_file,
+            metadata=data.get("metadata"),
+        )
+    except ValueError as e:
+        raise BadRequestError(str(e))
+    return job.to_dict()
+
+
+def batch_list_body() -> Dict[str, Any]:
+    jobs = [job.to_dict() for job in batches.list()]
+    return {
+        "object": "list",
+        "data": jobs,
+        "first_id": jobs[0]["id"] if jobs else None,
+        "last_id": jobs[-1]["id"] if jobs else None,
+        "has_more": False,
+    }
+
+
+def models_body() -> Dict[str, Any]:
+    """所有已配置的模型，loaded表示当前是否已在内存中"""
+    loaded = {entry.name: entry for entry in registry.loaded_models()}
+    return {
+        "object": "list",
+        "data": [
+            {
+                "id": name,
+                "object": "model",
+                "created": int(loaded[name].loaded_at if name in loaded else time.time()),
+                "owned_by": "local",
+                "loaded": name in loaded,
+            }
+            for name in registry.specs
+        ]
+    }
+
+
+def engine_stats(entry: LoadedModel) -> Dict[str, Any]:
+    engine = entry.engine
+    return {
+        "path": entry.spec.path,
+        "weights_gb": round(entry.nbytes / 1024**3, 2),
+        "prompt_cache": engine.prefix_cache.stats() if engine.prefix_cache is not None else None,
+        "queue": engine.admission.stats(),
+        "scheduler": engine.scheduler.stats(),
+        "kv_cache": engine.kv_stats(),
+        "kv_blocks": engine.block_allocator.stats() if engine.block_allocator is not None else None,
+    }
+
+
+def health_body() -> Dict[str, Any]:
+    loaded = {entry.name: engine_stats(entry) for entry in registry.loaded_models()}
+    default = loaded.get(registry.default)
+    return {
+        "status": "ok",
+        "model": registry.default,
+        "model_loaded": default is not None,
+        # 默认模型的统计（保持原有字段）
+        "prompt_cache": default["prompt_cache"] if default else None,
+        "queue": default["queue"] if default else None,
+        "models": loaded,
+        "memory": registry.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "response_store": response_store.stats() if response_store is not None else None,
+        "grammar_cache": grammar_cache.stats(),
+    }
+
+
+def collect_metrics() -> str:
+    """采集各模型引擎与进程内存的当前状态，返回Prometheus文本格式的全部指标"""
+    for metric in metrics.PER_MODEL:
+        # 已卸载的模型不再导出
+        metric.clear()
+    for entry in registry.loaded_models():
+        engine = entry.engine
+        if engine is None:
+            continue
+        queue = engine.admission.stats()
+        metrics.QUEUE_DEPTH.set(queue["queued"], model=entry.name)
+        metrics.QUEUED_TOKENS.set(queue["queued_tokens"], model=entry.name)
+        metrics.ACTIVE_SEQUENCES.set(queue["running"], model=entry.name)
+        metrics.MAX_CONCURRENT.set(queue["max_concurrent"], model=entry.name)
+        metrics.REJECTED.set(queue["rejected"], model=entry.name)
+        metrics.WEIGHTS_BYTES.set(entry.nbytes, model=entry.name)
+        kv = engine.kv_stats()
+        metrics.KV_CACHE_BYTES.set(kv["active_bytes"], model=entry.name)
+        metrics.KV_CACHE_BYTES_PER_SEQUENCE.set(kv["bytes_per_sequence"], model=entry.name)
+        if engine.block_allocator is not None:
+            blocks = engine.block_allocator.stats()
+            metrics.KV_BLOCKS_USED.set(blocks["used_blocks"], model=entry.name)
+            metrics.KV_BLOCKS_TOTAL.set(blocks["num_blocks"], model=entry.name)
+            metrics.KV_BLOCKS_SHARED.set(blocks["shared_blocks"], model=entry.name)
+            metrics.KV_BLOCK_FRAGMENTATION.set(blocks["fragmentation"], model=entry.name)
+        scheduler = engine.scheduler.stats()
+        for priority, queued in scheduler["queued_by_priority"].items():
+            metrics.QUEUE_DEPTH_BY_PRIORITY.set(queued, model=entry.name, priority=priority)
+        for tenant, running in scheduler["running_by_tenant"].items():
+            metrics.TENANT_ACTIVE_SEQUENCES.set(running, model=entry.name, tenant=tenant)
+        if engine.prefix_cache is not None:
+            cache = engine.prefix_cache.stats()
+            metrics.CACHE_HITS.set(cache["hits"], model=entry.name)
+            metrics.CACHE_MISSES.set(cache["misses"], model=entry.name)
+            metrics.CACHE_HIT_RATE.set(cache["hit_rate"], model=entry.name)
+            metrics.CACHE_BYTES.set(cache["bytes"], model=entry.name)
+
+    if response_cache is not None:
+        cache = response_cache.stats()
+        metrics.RESPONSE_CACHE_ENTRIES.set(cache["entries"])
+        metrics.RESPONSE_CACHE_BYTES.set(cache["bytes"])
+        metrics.RESPONSE_CACHE_DISK_BYTES.set(cache["disk_bytes"])
+    if response_store is not None:
+        store = response_store.stats()
+        metrics.RESPONSE_STORE_ENTRIES.set(store["entries"])
+        metrics.RESPONSE_STORE_BYTES.set(store["bytes"])
+        metrics.RESPONSE_STORE_DISK_BYTES.set(store["disk_bytes"])
+
+    metrics.MODEL_LOADS.set(registry.loads)
+    metrics.MODEL_EVICTIONS.set(registry.evictions)
+    metrics.MEMORY_BUDGET.set(registry.memory_budget_gb * 1024**3)
+    mem = psutil.virtual_memory()
+    metrics.MEMORY_USED.set(mem.used)
+    metrics.MEMORY_TOTAL.set(mem.total)
+    metrics.SWAP_USED.set(psutil.swap_memory().used)
+    metrics.PROCESS_RSS.set(psutil.Process().memory_info().rss)
+    metrics.MLX_ACTIVE_MEMORY.set(mx.get_active_memory())
+    metrics.MLX_PEAK_MEMORY.set(mx.get_peak_memory())
+    return metrics.render()
+
+
+def handle_errors(handler):
+    """把请求处理中的异常转换为OpenAI格式的错误响应"""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        tracing.start(f"{request.method} {request.path}")
+        try:
+            return handler(*args, **kwargs)
+        except BadRequestError as e:
+            response = jsonify({"error": str(e)}), 400
+        except ModelNotFoundError as e:
+            response = jsonify(error_body(str(e), "model_not_found", 404)), 404
+        except QueueFullError as e:
+            response = jsonify(error_body(str(e), "server_overloaded", 429)), 429, overloaded_headers(e)
+        except Exception as e:
+            response = jsonify(error_body(str(e), "internal_error", 500)), 500
+        export_trace()
+        return response
+    return wrapper
+
+
+def client_disconnected(sock: socket.socket) -> bool:
+    """连接上可读且读到EOF（或连接已重置）说明客户端已关闭连接"""
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+
+def watch_disconnect(handle: RequestHandle, interval: float = 0.05):
+    """
+    客户端断开连接（超时、关闭流）时取消生成，引擎在下一个token边界释放序列。
+
+    在后台线程中用select等待请求的socket可读，读到EOF即认为断开。
+    非Werkzeug的WSGI服务器不提供socket，此时不检测。
+    """
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None or handle.done:
+        return
+    endpoint = request.path
+
+    def watch():
+        while not handle.done:
+            try:
+                readable, _, _ = select.select([sock], [], [], interval)
+            except (OSError, ValueError):
+                readable = [sock]  # socket已关闭
+            if not readable:
+                continue
+            if client_disconnected(sock):
+                if not handle.done:
+                    metrics.CLIENT_DISCONNECTS.inc(endpoint=endpoint)
+                    handle.cancel()
+                return
+            # 客户端发来了下一个请求的数据（pipelining），连接仍然有效
+            time.sleep(interval)
+
+    threading.Thread(target=watch, name="disconnect-watch", daemon=True).start()
+
+
+def request_json() -> Dict[str, Any]:
+    with tracing.span("parse_request"):
+        headers = {key.lower(): value for key, value in request.headers.items()}
+        return merge_scheduling_headers(request.json, headers)
+
+
+def json_response(payload: str) -> Response:
+    return Response(payload, mimetype="application/json")
+
+
+@app.route("/v1/models", methods=["GET"])
+def list_models():
+    """列出可用模型"""
+    return jsonify(models_body())
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+@handle_errors
+def chat_completions():
+    """OpenAI兼容的chat completions端点"""
+    data = request_json()
+    handle = submit_request(prepare_chat, data)
+    watch_disconnect(handle)
+
+    if data.get("stream", False):
+        # 流式响应：逐token输出chunk，首字节时间 = 首token时间
+        stream = ChatStream(handle, trace=bool(data.get("mlx_trace")))
+
+        def generate_stream():
+            try:
+                yield from stream.start()
+                try:
+                    for out in handle:
+                        yield from stream.feed(out)
+                except Exception as e:
+                    yield from stream.error(e)
+                    return
+                yield from stream.finish()
+            finally:
+                # 写入失败时Werkzeug会关闭生成器（GeneratorExit）
+                if not handle.done:
+                    handle.cancel()
+
+        return Response(
+            stream_with_context(generate_stream()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    # 非流式响应
+    return json_response(render_body(chat_completion_body, collect_generation(handle), data))
+
+
+@app.route("/v1/responses", methods=["POST"])
+@handle_errors
+def responses():
+    """OpenAI Responses API端点（用于openai-responses API类型）"""
+    data = request_json()
+    handle = submit_request(prepare_responses, data)
+    watch_disconnect(handle)
+    return json_response(render_body(responses_body, collect_generation(handle), data))
+
+
+@app.route("/v1/responses/<response_id>", methods=["GET"])
+def get_response(response_id: str):
+    body = stored_response_body(response_id)
+    if body is None:
+        return jsonify(error_body(f"response {response_id} not found", "not_found", 404)), 404
+    return jsonify(body)
+
+
+@app.route("/v1/responses/<response_id>", methods=["DELETE"])
+def delete_response_route(response_id: str):
+    body = delete_response(response_id)
+    if body is None:
+        return jsonify(error_body(f"response {response_id} not found", "not_found", 404)), 404
+    return jsonify(body)
 
 
 @app.route("/v1/completions", methods=["POST"])
+@handle_errors
 def completions():
     """OpenAI兼容的completions端点（非chat）"""
-    try:
-        data = request.json
-
-        prompt = data.get("prompt", "")
-        max_tokens = data.get("max_tokens", 500)
-        temperature = data.get("temperature", 0.7)
-
-        if not prompt:
-            return jsonify({"error": "prompt is required"}), 400
-
-        # 创建采样器
-        sampler = make_sampler(temp=temperature)
-
-        # 生成
-        start_time = time.time()
-        response = generate(
-            model,
-            tokenizer,
-            prompt=prompt,
-            max_tokens=max_tokens,
-            sampler=sampler,
-            verbose=False
-        )
-        generation_time = time.time() - start_time
+    data = request_json()
+    handle = submit_request(prepare_completion, data)
+    watch_disconnect(handle)
+    return json_response(render_body(completion_body, collect_generation(handle), data))
 
-        # 计算tokens
-        prompt_tokens = len(tokenizer.encode(prompt))
-        completion_tokens = len(tokenizer.encode(response))
 
-        return jsonify({
-            "id": f"cmpl-{uuid.uuid4().hex[:8]}",
-            "object": "text_completion",
-            "created": int(time.time()),
-            "model": model_name,
-            "choices": [{
-                "text": response,
-                "index": 0,
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
-            }
-        })
+@app.route("/v1/batches", methods=["POST"])
+@handle_errors
+def create_batch_route():
+    """创建批处理任务（OpenAI Batch API）"""
+    return jsonify(create_batch(request.json or {}))
 
-    except Exception as e:
-        return jsonify({
-            "error": {
-                "message": str(e),
-                "type": "internal_error",
-                "code": 500
-            }
-        }), 500
+
+@app.route("/v1/batches", methods=["GET"])
+def list_batches():
+    return jsonify(batch_list_body())
+
+
+@app.route("/v1/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id: str):
+    job = batches.get(batch_id)
+    if job is None:
+        return jsonify(error_body(f"batch {batch_id} not found", "not_found", 404)), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/v1/batches/<batch_id>/cancel", methods=["POST"])
+def cancel_batch(batch_id: str):
+    job = batches.cancel(batch_id)
+    if job is None:
+        return jsonify(error_body(f"batch {batch_id} not found", "not_found", 404)), 404
+    return jsonify(job.to_dict())
 
 
 @app.route("/health", methods=["GET"])
 def health():
     """健康检查"""
-    return jsonify({
-        "status": "ok",
-        "model": model_name,
-        "model_loaded": model is not None
-    })
+    return jsonify(health_body())
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Prometheus指标"""
+    return Response(collect_metrics(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.after_request
+def count_request(response):
+    # 按路由模板计数，未匹配的路径归为other，避免标签基数失控
+    endpoint = request.url_rule.rule if request.url_rule else "other"
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    return response
 
 
 @app.route("/", methods=["GET"])
@@ -458,23 +1526,67 @@ def index():
     """API信息"""
     return jsonify({
         "message": "MLX MiniMax M2.1 API Server",
-        "model": model_name,
+        "model": registry.default,
+        "models": list(registry.specs),
         "endpoints": {
             "chat": "/v1/chat/completions",
             "completions": "/v1/completions",
+            "batches": "/v1/batches",
             "models": "/v1/models",
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics"
         },
         "documentation": "https://platform.openai.com/docs/api-reference"
     })
 
 
-def main():
-    global strip_think
-    args = parse_args()
+def init_runtime(args):
+    """设置全局状态并加载默认模型（服务器与批处理命令行共用）"""
+    global registry, strip_think, think_hold_chars, trace_writer, response_cache, response_store, grammar_cache
+
+    try:
+        check_mlx_lm_version()
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
     # 设置是否去除think块
     strip_think = args.strip_think
+    think_hold_chars = args.think_hold_chars
+    if args.trace_file:
+        trace_writer = TraceWriter(args.trace_file)
+    if args.response_cache_mb > 0:
+        response_cache = ResponseCache(
+            int(args.response_cache_mb * 1024**2),
+            ttl=args.response_cache_ttl,
+            disk_dir=args.response_cache_dir,
+            disk_max_bytes=int(args.response_cache_disk_gb * 1024**3),
+        )
+    grammar_cache = GrammarCache(args.grammar_cache_size)
+    if args.response_store_gb > 0:
+        response_store = ResponseStore(
+            int(args.response_store_gb * 1024**3),
+            ttl=args.response_store_ttl,
+            disk_dir=args.response_store_dir,
+            disk_max_bytes=int(args.response_store_disk_gb * 1024**3),
+        )
+
+    # 默认模型在前，其他模型首次被请求时才加载
+    specs = [ModelSpec(name=args.model, path=args.model, draft_path=args.draft_model)]
+    specs += [parse_model_spec(value) for value in args.models]
+    memory_budget_gb = args.memory_budget_gb
+    if memory_budget_gb is None:
+        memory_budget_gb = round(get_memory_usage()["total_gb"] * 0.9, 1)
+    registry = ModelRegistry(specs, functools.partial(load_model, args=args), memory_budget_gb)
+
+    # 加载默认模型
+    with registry.use():
+        pass
+
+
+def setup_server(args):
+    """加载模型、启动引擎和批处理任务并打印配置（Flask与ASGI入口共用）"""
+    global batches
 
     print("""
 ╔══════════════════════════════════════════════════════════╗
@@ -483,23 +1595,62 @@ def main():
 ╚══════════════════════════════════════════════════════════╝
 """)
 
-    # 加载模型
-    load_model(args.model)
+    init_runtime(args)
+    batches = BatchManager(args.batch_dir, registry, BATCH_ENDPOINTS, generation_result)
 
     print(f"{'='*60}")
     print(f"API 服务器配置")
     print(f"{'='*60}")
     print(f"模型: {args.model}")
+    if args.models:
+        print(f"其他模型 (按需加载): {', '.join(name for name in registry.specs if name != registry.default)}")
+        print(f"内存预算: {registry.memory_budget_gb:g} GB (超出时卸载最久未使用的模型)")
     print(f"地址: http://{args.host}:{args.port}")
     print(f"去除<think>块: {'是' if strip_think else '否'}")
+    if args.draft_model:
+        print(f"投机解码: {args.draft_model} (每轮 {args.num_draft_tokens} 个draft token, 请求逐个生成)")
+    else:
+        print(f"连续批处理: 最多 {args.max_batch_size} 个并发序列, 最多 {args.max_queued_requests} 个排队请求")
+        budget = f"每步最多 {args.step_token_budget} token" if args.step_token_budget else "每步不限token数"
+        print(f"分块prefill: 每块最多 {args.prefill_step_size} token, {budget}")
+    print(f"调度权重: {' '.join(args.priority_weights)}")
+    if args.tenant_max_concurrent:
+        print(f"租户并发上限: {' '.join(args.tenant_max_concurrent)}")
+    print(f"前缀KV cache: {f'{args.prompt_cache_gb:g} GB' if args.prompt_cache_gb > 0 else '关闭'}")
+    if args.max_kv_size:
+        note = " (投机解码不使用滑动窗口)" if args.draft_model else ""
+        print(f"每序列KV上限: {args.max_kv_size} token (滑动窗口){note}")
+    if args.kv_bits:
+        print(f"KV量化: {args.kv_bits} 位, 分组 {args.kv_group_size}, 序列达到 {args.quantized_kv_start} token 后量化")
+    if args.kv_blocks_gb > 0:
+        note = " (投机解码不使用)" if args.draft_model else ""
+        print(f"KV块: {args.kv_blocks_gb:g} GB, 每块 {args.kv_block_size} token{note}")
+    if response_cache is not None:
+        disk = f", 磁盘 {args.response_cache_dir}" if args.response_cache_dir else ""
+        print(f"响应cache (temperature=0): {args.response_cache_mb:g} MB, TTL {args.response_cache_ttl:g} 秒{disk}")
+    if response_store is not None:
+        disk = f", 磁盘 {args.response_store_dir}" if args.response_store_dir else ""
+        print(f"会话保存 (previous_response_id): {args.response_store_gb:g} GB, TTL {args.response_store_ttl:g} 秒{disk}")
+    note = " (投机解码不支持)" if args.draft_model else ""
+    print(f"结构化输出 (response_format): 缓存 {args.grammar_cache_size} 个schema{note}")
+    if args.trace_file:
+        print(f"请求trace: {args.trace_file}")
+    print(f"批处理任务目录: {args.batch_dir}")
     print(f"端点:")
     print(f"  • Chat: http://{args.host}:{args.port}/v1/chat/completions")
     print(f"  • Completions: http://{args.host}:{args.port}/v1/completions")
+    print(f"  • Batches: http://{args.host}:{args.port}/v1/batches")
     print(f"  • Models: http://{args.host}:{args.port}/v1/models")
     print(f"  • Health: http://{args.host}:{args.port}/health")
+    print(f"  • Metrics: http://{args.host}:{args.port}/metrics")
     print(f"\n按 Ctrl+C 停止服务器")
     print(f"{'='*60}\n")
 
+
+def main():
+    args = parse_args()
+    setup_server(args)
+
     # 启动服务器
     app.run(
         host=args.host,
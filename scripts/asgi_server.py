@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+MLX API Server 的 ASGI 入口（asyncio + uvicorn）
+
+与 api_server.py 提供相同的路由和参数，请求解析与响应构建也完全复用；
+区别在于流式响应是由生成引擎驱动的异步生成器，成百上千个空闲或读取缓慢的
+流式客户端只占用协程，而不是每个连接一个OS线程。
+
+使用方法:
+    pip install uvicorn
+    python scripts/asgi_server.py
+    python scripts/asgi_server.py --model mlx-community/MiniMax-M2.1-4bit --port 8000
+"""
+
+import asyncio
+import json
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Add scripts directory to path for api_server import
+sys.path.insert(0, str(Path(__file__).parent))
+
+import api_server
+import metrics
+import tracing
+from admission import QueueFullError
+from api_server import BadRequestError, ChatStream, error_body
+from model_registry import ModelNotFoundError
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, DELETE, OPTIONS"),
+]
+
+
+async def read_json(scope, receive) -> Dict[str, Any]:
+    """读取完整请求体并解析为JSON"""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    if not body:
+        return {}
+    try:
+        with tracing.span("parse_request"):
+            headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+            return api_server.merge_scheduling_headers(json.loads(body), headers)
+    except json.JSONDecodeError as e:
+        raise BadRequestError(f"invalid JSON body: {e}")
+
+
+async def send_json(send, body: Any, status: int = 200, headers: Optional[Dict[str, str]] = None):
+    await send_text(send, json.dumps(body), "application/json", status, headers)
+
+
+async def send_text(
+    send,
+    text: str,
+    content_type: str = "application/json",
+    status: int = 200,
+    headers: Optional[Dict[str, str]] = None,
+):
+    """发送完整的响应体（已序列化的JSON或其他文本）"""
+    payload = text.encode()
+    raw_headers = [
+        (b"content-type", content_type.encode()),
+        (b"content-length", str(len(payload)).encode()),
+    ] + CORS_HEADERS
+    for key, value in (headers or {}).items():
+        raw_headers.append((key.lower().encode(), value.encode()))
+    await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def send_chat_stream(send, handle, trace: bool = False):
+    """以SSE发送流式chat响应，每个chunk到达即写出"""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ] + CORS_HEADERS,
+    })
+
+    async def write(events: List[str]):
+        for event in events:
+            await send({"type": "http.response.body", "body": event.encode(), "more_body": True})
+
+    stream = ChatStream(handle, trace)
+    await write(stream.start())
+    try:
+        async for out in handle:
+            await write(stream.feed(out))
+        await write(stream.finish())
+    except Exception as e:
+        await write(stream.error(e))
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def submit(prepare, data: Dict[str, Any]):
+    """在线程池中完成模型加载、chat template渲染和tokenize，避免阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.to_thread(api_server.submit_request, prepare, data, loop)
+
+
+@asynccontextmanager
+async def cancel_on_disconnect(scope, receive, handle):
+    """
+    请求体读完后，receive() 只会在客户端断开连接时返回 http.disconnect；
+    此时取消生成，引擎在下一个token边界释放序列。
+    """
+    async def watch():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+        if not handle.done:
+            metrics.CLIENT_DISCONNECTS.inc(endpoint=scope["path"])
+            handle.cancel()
+
+    task = asyncio.create_task(watch())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def chat_completions(scope, receive, send):
+    data = await read_json(scope, receive)
+    handle = await submit(api_server.prepare_chat, data)
+    async with cancel_on_disconnect(scope, receive, handle):
+        if data.get("stream", False):
+            await send_chat_stream(send, handle, bool(data.get("mlx_trace")))
+            return
+        result = await api_server.collect_generation_async(handle)
+    await send_text(send, api_server.render_body(api_server.chat_completion_body, result, data))
+
+
+async def responses(scope, receive, send):
+    data = await read_json(scope, receive)
+    handle = await submit(api_server.prepare_responses, data)
+    async with cancel_on_disconnect(scope, receive, handle):
+        result = await api_server.collect_generation_async(handle)
+    await send_text(send, api_server.render_body(api_server.responses_body, result, data))
+
+
+async def get_response(scope, receive, send):
+    response_id = scope["path_params"]["response_id"]
+    await send_found(send, f"response {response_id}", api_server.stored_response_body(response_id))
+
+
+async def delete_response(scope, receive, send):
+    response_id = scope["path_params"]["response_id"]
+    await send_found(send, f"response {response_id}", api_server.delete_response(response_id))
+
+
+async def completions(scope, receive, send):
+    data = await read_json(scope, receive)
+    handle = await submit(api_server.prepare_completion, data)
+    async with cancel_on_disconnect(scope, receive, handle):
+        result = await api_server.collect_generation_async(handle)
+    await send_text(send, api_server.render_body(api_server.completion_body, result, data))
+
+
+async def list_models(scope, receive, send):
+    await send_json(send, api_server.models_body())
+
+
+async def health(scope, receive, send):
+    await send_json(send, api_server.health_body())
+
+
+async def prometheus_metrics(scope, receive, send):
+    await send_text(send, api_server.collect_metrics(), metrics.CONTENT_TYPE)
+
+
+async def create_batch(scope, receive, send):
+    await send_json(send, api_server.create_batch(await read_json(scope, receive)))
+
+
+async def list_batches(scope, receive, send):
+    await send_json(send, api_server.batch_list_body())
+
+
+async def get_batch(scope, receive, send):
+    batch_id = scope["path_params"]["batch_id"]
+    await send_batch(send, batch_id, api_server.batches.get(batch_id))
+
+
+async def cancel_batch(scope, receive, send):
+    batch_id = scope["path_params"]["batch_id"]
+    await send_batch(send, batch_id, api_server.batches.cancel(batch_id))
+
+
+async def send_batch(send, batch_id: str, job):
+    await send_found(send, f"batch {batch_id}", job.to_dict() if job is not None else None)
+
+
+async def send_found(send, what: str, body: Optional[Dict[str, Any]]):
+    if body is None:
+        await send_json(send, error_body(f"{what} not found", "not_found", 404), 404)
+    else:
+        await send_json(send, body)
+
+
+ROUTES: Dict[Tuple[str, str], Any] = {
+    ("POST", "/v1/chat/completions"): chat_completions,
+    ("POST", "/v1/responses"): responses,
+    ("GET", "/v1/responses/<response_id>"): get_response,
+    ("DELETE", "/v1/responses/<response_id>"): delete_response,
+    ("POST", "/v1/completions"): completions,
+    ("GET", "/v1/models"): list_models,
+    ("GET", "/health"): health,
+    ("GET", "/metrics"): prometheus_metrics,
+    ("POST", "/v1/batches"): create_batch,
+    ("GET", "/v1/batches"): list_batches,
+    ("GET", "/v1/batches/<batch_id>"): get_batch,
+    ("POST", "/v1/batches/<batch_id>/cancel"): cancel_batch,
+}
+
+
+def match_route(path: str) -> Tuple[str, Dict[str, str]]:
+    """把 /v1/batches/<id>[/cancel]、/v1/responses/<id> 映射到路由模板，返回 (模板, 路径参数)"""
+    parts = path.split("/")
+    if len(parts) in (4, 5) and parts[1:3] == ["v1", "batches"] and parts[3]:
+        template = "/v1/batches/<batch_id>" + ("/" + parts[4] if len(parts) == 5 else "")
+        return template, {"batch_id": parts[3]}
+    if len(parts) == 4 and parts[1:3] == ["v1", "responses"] and parts[3]:
+        return "/v1/responses/<response_id>", {"response_id": parts[3]}
+    return path, {}
+
+
+def counted(send, endpoint: str):
+    """包装send，按路由和状态码计数响应"""
+    async def wrapper(message):
+        if message["type"] == "http.response.start":
+            metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status=message["status"])
+        await send(message)
+    return wrapper
+
+
+async def app(scope, receive, send):
+    """ASGI应用"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path, scope["path_params"] = match_route(scope["path"].rstrip("/") or "/")
+    send = counted(send, path if any(path == p for _, p in ROUTES) else "other")
+
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 204, "headers": CORS_HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        await send_json(send, error_body(f"{method} {path} not found", "not_found", 404), 404)
+        return
+
+    if method == "POST":
+        tracing.start(f"{method} {path}")
+    try:
+        await handler(scope, receive, send)
+        return
+    except BadRequestError as e:
+        await send_json(send, {"error": str(e)}, 400)
+    except ModelNotFoundError as e:
+        await send_json(send, error_body(str(e), "model_not_found", 404), 404)
+    except QueueFullError as e:
+        await send_json(send, error_body(str(e), "server_overloaded", 429), 429,
+                        api_server.overloaded_headers(e))
+    except Exception as e:
+        await send_json(send, error_body(str(e), "internal_error", 500), 500)
+    api_server.export_trace()
+
+
+def main():
+    try:
+        import uvicorn
+    except ImportError:
+        print("Error: uvicorn not installed. Run: pip install uvicorn")
+        sys.exit(1)
+
+    args = api_server.parse_args()
+    api_server.setup_server(args)
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
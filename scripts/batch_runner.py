@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+离线批处理：按OpenAI Batch API的JSONL格式执行大量请求
+
+输入每行一个请求:
+    {"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+输出每行一个结果（按完成顺序）:
+    {"id": "batch_req_...", "custom_id": "req-1", "response": {"status_code": 200, "body": {...}}, "error": null}
+
+请求体的解析、chat template渲染和采样参数与在线端点完全相同（复用 prepare_* 和
+响应构建函数）。为了吞吐量，同一模型的请求先全部tokenize，再按prompt前缀和长度
+排序（共享前缀的请求相邻，可以命中前缀KV cache；长度相近的请求一起decode），
+并始终保持足够多的请求在引擎中，让连续批处理的batch一直是满的。批处理请求以
+batch优先级提交，与在线流量共用服务器时不会拖慢交互请求。
+
+输出文件同时就是检查点：每完成一个请求就追加一行，重新运行时跳过已有结果的
+custom_id，从中断处继续。
+
+使用方法:
+    python scripts/batch_runner.py --input requests.jsonl --output results.jsonl
+    python scripts/batch_runner.py --model mlx-community/MiniMax-M2.1-4bit --input requests.jsonl --output results.jsonl
+
+服务器模式下同样可以通过 POST /v1/batches 提交（见 api_server.py）。
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+# Add scripts directory to path for api_server import
+sys.path.insert(0, str(Path(__file__).parent))
+
+from admission import QueueFullError
+from engine import GenerationRequest, RequestHandle
+from model_registry import ModelNotFoundError
+
+PREFIX_SORT_TOKENS = 256  # 排序时用于分组的前缀长度
+RESULT_PREFIX = b'{"id": "batch_req_'  # 每个结果行的开头（见 BatchRunner._write）
+
+
+@dataclass
+class BatchEndpoint:
+    """批处理支持的一个端点：解析请求体的prepare函数与构建响应体的函数"""
+    prepare: Callable  # (entry, data) -> GenerationRequest
+    build: Callable  # (GenerationResult) -> Dict
+
+
+@dataclass
+class BatchJob:
+    """一个批处理任务，字段与OpenAI的batch对象对应"""
+    id: str
+    input_file: str
+    output_file: str
+    endpoint: str = "/v1/chat/completions"  # 请求行没有url时使用
+    status: str = "validating"
+    created_at: int = field(default_factory=lambda: int(time.time()))
+    in_progress_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    errors: List[str] = field(default_factory=list)
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": self.endpoint,
+            "input_file": self.input_file,
+            "output_file": self.output_file,
+            "status": self.status,
+            "created_at": self.created_at,
+            "in_progress_at": self.in_progress_at,
+            "completed_at": self.completed_at,
+            "cancelled_at": self.cancelled_at,
+            "failed_at": self.failed_at,
+            "request_counts": {"total": self.total, "completed": self.completed, "failed": self.failed},
+            "errors": {"object": "list", "data": [{"message": e} for e in self.errors]} if self.errors else None,
+            "metadata": self.metadata,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "BatchJob":
+        counts = data.get("request_counts", {})
+        return cls(
+            id=data["id"],
+            input_file=data["input_file"],
+            output_file=data["output_file"],
+            endpoint=data.get("endpoint", "/v1/chat/completions"),
+            status=data.get("status", "validating"),
+            created_at=data.get("created_at", int(time.time())),
+            in_progress_at=data.get("in_progress_at"),
+            completed_at=data.get("completed_at"),
+            cancelled_at=data.get("cancelled_at"),
+            failed_at=data.get("failed_at"),
+            total=counts.get("total", 0),
+            completed=counts.get("completed", 0),
+            failed=counts.get("failed", 0),
+            metadata=data.get("metadata") or {},
+        )
+
+
+@dataclass
+class _Item:
+    """一个待执行的请求行"""
+    custom_id: str
+    url: str
+    body: Dict[str, Any]
+    request: Optional[GenerationRequest] = None
+    written: bool = False
+
+
+def read_completed(output_file: str) -> Dict[str, bool]:
+    """
+    读取已完成的请求（断点续跑）：custom_id -> 是否失败。
+
+    上次中断时写了一半的最后一行会被截掉，之后追加的结果才能逐行解析。文件中
+    有不是结果行的内容时抛出ValueError：它不是本程序写的输出文件，不能截断或追加。
+    """
+    path = Path(output_file)
+    if not path.exists():
+        return {}
+    data = path.read_bytes()
+    end = data.rfind(b"\n") + 1
+    done = {}
+    for lineno, line in enumerate(data[:end].splitlines(), 1):
+        try:
+            result = json.loads(line) if line.startswith(RESULT_PREFIX) else {}
+        except ValueError:
+            result = {}
+        if "custom_id" not in result:
+            raise ValueError(f"{output_file} is not a batch output file (line {lineno})")
+        done[result["custom_id"]] = result.get("error") is not None
+    if end < len(data):
+        if not data[end:].startswith(RESULT_PREFIX[:len(data) - end]):
+            raise ValueError(f"{output_file} is not a batch output file")
+        with open(path, "r+b") as f:
+            f.truncate(end)
+    return done
+
+
+def read_requests(input_file: str, default_url: str) -> List[_Item]:
+    """解析输入JSONL，custom_id重复或格式错误时抛出ValueError"""
+    items = []
+    seen = set()
+    with open(input_file, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"line {lineno}: invalid JSON: {e}")
+            custom_id = data.get("custom_id")
+            if not isinstance(custom_id, str) or not isinstance(data.get("body"), dict):
+                raise ValueError(f"line {lineno}: custom_id (string) and body (object) are required")
+            if custom_id in seen:
+                raise ValueError(f"line {lineno}: duplicate custom_id {custom_id!r}")
+            seen.add(custom_id)
+            items.append(_Item(custom_id, data.get("url") or default_url, data["body"]))
+    return items
+
+
+class BatchRunner:
+    """
+    执行一个批处理任务（在调用线程中阻塞运行）。
+
+    registry: 模型注册表；endpoints: url -> BatchEndpoint；
+    collect: (handle, outputs) -> GenerationResult，与在线端点使用同一个函数。
+    """
+
+    def __init__(
+        self,
+        job: BatchJob,
+        registry,
+        endpoints: Dict[str, BatchEndpoint],
+        collect: Callable,
+        on_progress: Optional[Callable[[BatchJob], None]] = None,
+    ):
+        self.job = job
+        self.registry = registry
+        self.endpoints = endpoints
+        self.collect = collect
+        self.on_progress = on_progress or (lambda job: None)
+        self.cancelled = threading.Event()
+        self._out = None
+
+    def run(self):
+        job = self.job
+        try:
+            items = read_requests(job.input_file, job.endpoint)
+        except (OSError, ValueError) as e:
+            self._set_status("failed", str(e))
+            return
+
+        try:
+            done = read_completed(job.output_file)
+        except (OSError, ValueError) as e:
+            self._set_status("failed", str(e))
+            return
+        pending = [item for item in items if item.custom_id not in done]
+        job.total = len(items)
+        job.failed = sum(done.values())
+        job.completed = len(done) - job.failed
+        self._set_status("in_progress")
+
+        Path(job.output_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(job.output_file, "a", encoding="utf-8") as self._out:
+            # 按模型分组，每组在模型被固定（不会被卸载）期间执行
+            groups: Dict[Optional[str], List[_Item]] = {}
+            for item in pending:
+                groups.setdefault(item.body.get("model"), []).append(item)
+            for model, group in groups.items():
+                if self.cancelled.is_set():
+                    break
+                try:
+                    with self.registry.use(model) as entry:
+                        self._run_group(entry, group)
+                except ModelNotFoundError as e:
+                    for item in group:
+                        self._write_error(item, 404, "model_not_found", str(e))
+                except Exception as e:
+                    # 引擎出错时组内剩余的请求都记为失败，已写入的结果保留
+                    for item in group:
+                        if not item.written:
+                            self._write_error(item, 500, "internal_error", str(e))
+            self._out.flush()
+            os.fsync(self._out.fileno())
+
+        self._set_status("cancelled" if self.cancelled.is_set() else "completed")
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _run_group(self, entry, group: List[_Item]):
+        ready = []
+        for item in group:
+            endpoint = self.endpoints.get(item.url)
+            if endpoint is None:
+                self._write_error(item, 400, "invalid_url", f"unsupported url {item.url!r}")
+                continue
+            data = dict(item.body, stream=False)
+            # 批处理的响应默认不保存会话状态（/v1/responses 的store），避免挤占在线会话的KV
+            data.setdefault("store", False)
+            # 默认以batch优先级、按任务区分的租户提交，不影响在线请求
+            if "batch" in entry.engine.scheduler.weights:
+                data.setdefault("priority", "batch")
+            if not data.get("tenant") and not data.get("user"):
+                data["tenant"] = self.job.id
+            try:
+                item.request = endpoint.prepare(entry, data)
+            except Exception as e:
+                self._write_error(item, 400, "invalid_request", str(e))
+                continue
+            ready.append(item)
+
+        # 共享前缀的请求相邻（命中前缀cache），同组内长度相近的请求一起decode
+        ready.sort(key=lambda it: (it.request.prompt_tokens[:PREFIX_SORT_TOKENS], len(it.request.prompt_tokens)))
+        self._execute(entry, deque(ready))
+
+    def _execute(self, entry, pending: "deque[_Item]"):
+        """保持约两倍并发上限的请求在引擎中，batch有空位时下一个请求已在排队"""
+        engine = entry.engine
+        window = 2 * engine.admission.max_concurrent
+        inflight: List[tuple] = []
+        while pending or inflight:
+            if self.cancelled.is_set():
+                for _, handle in inflight:
+                    handle.cancel()
+                return
+            while pending and sum(it.request.n for it, _ in inflight) + pending[0].request.n <= window:
+                try:
+                    handle = engine.submit(pending[0].request)
+                except QueueFullError:
+                    break
+                except Exception as e:
+                    self._write_error(pending.popleft(), 400, "invalid_request", str(e))
+                    continue
+                inflight.append((pending.popleft(), handle))
+
+            finished = [(item, handle) for item, handle in inflight if handle.done]
+            for item, handle in finished:
+                inflight.remove((item, handle))
+                self._write_result(item, handle)
+            if not finished:
+                time.sleep(0.01)
+
+    def _write_result(self, item: _Item, handle: RequestHandle):
+        try:
+            result = self.collect(handle, list(handle))
+            body = self.endpoints[item.url].build(result)
+        except Exception as e:
+            self._write_error(item, 500, "internal_error", str(e))
+            return
+        self._write(item, {"status_code": 200, "request_id": body.get("id"), "body": body}, None)
+        self.job.completed += 1
+        self.on_progress(self.job)
+
+    def _write_error(self, item: _Item, status_code: int, code: str, message: str):
+        error = {"code": code, "message": message}
+        self._write(item, {"status_code": status_code, "body": {"error": error}}, error)
+        self.job.failed += 1
+        self.on_progress(self.job)
+
+    def _write(self, item: _Item, response: Dict[str, Any], error: Optional[Dict[str, Any]]):
+        line = {
+            "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+            "custom_id": item.custom_id,
+            "response": response,
+            "error": error,
+        }
+        self._out.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._out.flush()
+        item.written = True
+
+    def _set_status(self, status: str, error: Optional[str] = None):
+        job = self.job
+        job.status = status
+        now = int(time.time())
+        if status == "in_progress":
+            job.in_progress_at = job.in_progress_at or now
+        elif status in ("completed", "cancelled", "failed"):
+            setattr(job, f"{status}_at", now)
+        if error:
+            job.errors.append(error)
+        self.on_progress(job)
+
+
+class BatchManager:
+    """
+    服务器端的批处理任务（/v1/batches）：每个任务在自己的线程中运行。
+
+    任务状态保存在 batch_dir/<id>.json，服务器重启后未完成的任务自动继续。
+    输入与输出文件都限定在 batch_dir 之内（客户端给出的路径按batch_dir的相对路径
+    解析），输出文件必须是尚不存在的新文件。
+    """
+
+    def __init__(self, batch_dir: str, registry, endpoints: Dict[str, BatchEndpoint], collect: Callable):
+        self.batch_dir = Path(batch_dir)
+        self.batch_dir.mkdir(parents=True, exist_ok=True)
+        self.registry = registry
+        self.endpoints = endpoints
+        self.collect = collect
+        self.jobs: Dict[str, BatchJob] = {}
+        self._runners: Dict[str, BatchRunner] = {}
+        self._lock = threading.Lock()
+        self._saved_at: Dict[str, float] = {}
+
+        for path in sorted(self.batch_dir.glob("batch_*.json")):
+            try:
+                job = BatchJob.from_dict(json.loads(path.read_text(encoding="utf-8")))
+            except (OSError, ValueError, KeyError):
+                continue
+            self.jobs[job.id] = job
+            if job.status in ("validating", "in_progress", "cancelling"):
+                if job.status == "cancelling":
+                    job.status = "cancelled"
+                    self._save(job)
+                else:
+                    self._start(job)
+
+    def create(
+        self,
+        input_file: str,
+        endpoint: str = "/v1/chat/completions",
+        output_file: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> BatchJob:
+        if endpoint not in self.endpoints:
+            raise ValueError(f"endpoint must be one of: {', '.join(self.endpoints)}")
+        input_path = self.confine(input_file)
+        if not input_path.is_file():
+            raise ValueError(f"input file not found: {input_file}")
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        output_path = self.confine(output_file or f"{batch_id}_output.jsonl")
+        if output_path.suffix != ".jsonl":
+            raise ValueError("output_file must be a .jsonl file")
+        if output_path.exists():
+            # 恢复任务时会截断输出文件末尾不完整的行再追加结果，只能是本任务新建的文件
+            raise ValueError(f"output file already exists: {output_file}")
+        job = BatchJob(
+            id=batch_id,
+            input_file=str(input_path),
+            output_file=str(output_path),
+            endpoint=endpoint,
+            metadata=metadata or {},
+        )
+        with self._lock:
+            self.jobs[batch_id] = job
+        self._start(job)
+        return job
+
+    def confine(self, path: str) -> Path:
+        """把客户端给出的路径解析为batch_dir内的绝对路径（跟随符号链接），在其外时抛出ValueError"""
+        root = self.batch_dir.resolve()
+        resolved = (root / path).resolve()
+        if resolved == root or root not in resolved.parents:
+            raise ValueError(f"path must be inside the batch directory: {path}")
+        return resolved
+
+    def get(self, batch_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(batch_id)
+
+    def list(self) -> List[BatchJob]:
+        return sorted(self.jobs.values(), key=lambda job: -job.created_at)
+
+    def cancel(self, batch_id: str) -> Optional[BatchJob]:
+        job = self.jobs.get(batch_id)
+        runner = self._runners.get(batch_id)
+        if job is not None and runner is not None and job.status in ("validating", "in_progress"):
+            job.status = "cancelling"
+            self._save(job)
+            runner.cancel()
+        return job
+
+    def _start(self, job: BatchJob):
+        runner = BatchRunner(job, self.registry, self.endpoints, self.collect, on_progress=self._progress)
+        self._runners[job.id] = runner
+        self._save(job)
+
+        def run():
+            try:
+                runner.run()
+            finally:
+                self._runners.pop(job.id, None)
+                self._save(job)
+
+        threading.Thread(target=run, name=f"batch-{job.id}", daemon=True).start()
+
+    def _progress(self, job: BatchJob):
+        # 计数每秒最多落盘一次，状态变化立即落盘
+        now = time.time()
+        if job.status != "in_progress" or now - self._saved_at.get(job.id, 0) >= 1:
+            self._save(job)
+
+    def _save(self, job: BatchJob):
+        self._saved_at[job.id] = time.time()
+        path = self.batch_dir / f"{job.id}.json"
+        tmp = path.with_suffix(".tmp")
+        with self._lock:
+            tmp.write_text(json.dumps(job.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, path)
+
+
+def main():
+    import api_server
+
+    parser = api_server.build_parser()
+    parser.description = "MLX 离线批处理 (OpenAI Batch JSONL)"
+    parser.add_argument("--input", type=str, required=True, help="输入JSONL文件（每行一个请求）")
+    parser.add_argument("--output", type=str, required=True, help="输出JSONL文件，同时作为断点续跑的检查点")
+    parser.add_argument(
+        "--endpoint",
+        type=str,
+        default="/v1/chat/completions",
+        help="请求行没有url字段时使用的端点 (default: /v1/chat/completions)",
+    )
+    args = parser.parse_args()
+
+    api_server.init_runtime(args)
+    job = BatchJob(id=f"batch_{uuid.uuid4().hex[:16]}", input_file=args.input, output_file=args.output,
+                   endpoint=args.endpoint)
+
+    started = time.time()
+    last_report = [0.0]
+
+    def report(job: BatchJob):
+        now = time.time()
+        if now - last_report[0] >= 5 or job.status != "in_progress":
+            last_report[0] = now
+            finished = job.completed + job.failed
+            print(f"[{job.status}] {finished}/{job.total} (失败 {job.failed})，用时 {now - started:.0f} 秒")
+
+    runner = BatchRunner(job, api_server.registry, api_server.BATCH_ENDPOINTS, api_server.generation_result,
+                         on_progress=report)
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        print(f"\n已中断，重新运行相同命令将从 {args.output} 中已完成的请求之后继续")
+        sys.exit(130)
+    finally:
+        for entry in api_server.registry.loaded_models():
+            entry.engine.stop()
+    if job.errors:
+        print(f"错误: {'; '.join(job.errors)}")
+        sys.exit(1)
+    print(f"结果已写入: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
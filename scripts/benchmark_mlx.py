@@ -5,6 +5,7 @@ MiniMax M2.1 MLX Benchmark Script
 Usage:
     python benchmark_mlx.py --model mlx-community/MiniMax-M2.1-4bit
     python benchmark_mlx.py --model mlx-community/MiniMax-M2.1-8bit
+    python benchmark_mlx.py --model mlx-community/MiniMax-M2.1-4bit --draft-model <small-model>
 """
 
 import argparse
@@ -68,6 +69,18 @@ def parse_args():
         default=None,
         help="Specific tests to run (e.g., short medium)",
     )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        default=None,
+        help="Draft model for speculative decoding; each test is also run with and without drafting",
+    )
+    parser.add_argument(
+        "--num-draft-tokens",
+        type=int,
+        default=3,
+        help="Tokens proposed by the draft model per step",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -178,6 +191,89 @@ def run_generation_test(
     }
 
 
+def stream_generation_stats(
+    model,
+    tokenizer,
+    prompt: str,
+    max_tokens: int,
+    temperature: float,
+    draft_model=None,
+    num_draft_tokens: int = 3,
+) -> dict:
+    """Stream one generation and measure decode TPS (and draft acceptance if drafting)."""
+    from mlx_lm import stream_generate
+    from mlx_lm.sample_utils import make_sampler
+
+    if hasattr(tokenizer, "apply_chat_template"):
+        messages = [{"role": "user", "content": prompt}]
+        prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    kwargs = {}
+    if draft_model is not None:
+        kwargs = {"draft_model": draft_model, "num_draft_tokens": num_draft_tokens}
+
+    start_time = time.perf_counter()
+    first_token_time = None
+    tokens = 0
+    proposed = 0
+    accepted = 0
+    new_round = True
+    for response in stream_generate(
+        model,
+        tokenizer,
+        prompt,
+        max_tokens=max_tokens,
+        sampler=make_sampler(temp=temperature),
+        **kwargs,
+    ):
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+        if draft_model is not None:
+            # Each round proposes up to num_draft_tokens and ends with a token from the main model
+            if new_round:
+                proposed += min(max_tokens - tokens, num_draft_tokens)
+            new_round = not response.from_draft
+            accepted += response.from_draft
+        tokens = response.generation_tokens
+    end_time = time.perf_counter()
+
+    generation_time = end_time - (first_token_time or start_time)
+    stats = {
+        "tokens": tokens,
+        "ttft_sec": round((first_token_time or end_time) - start_time, 3),
+        "tps": round(tokens / generation_time, 2) if generation_time > 0 else 0,
+    }
+    if draft_model is not None:
+        stats["draft_tokens_proposed"] = proposed
+        stats["draft_tokens_accepted"] = accepted
+        stats["acceptance_rate"] = round(accepted / proposed, 4) if proposed else 0
+    return stats
+
+
+def run_speculative_comparison(
+    model,
+    draft_model,
+    tokenizer,
+    prompt: str,
+    max_tokens: int,
+    temperature: float,
+    num_draft_tokens: int,
+) -> dict:
+    """Compare decode TPS with and without the draft model on the same prompt."""
+    baseline = stream_generation_stats(model, tokenizer, prompt, max_tokens, temperature)
+    drafted = stream_generation_stats(
+        model, tokenizer, prompt, max_tokens, temperature, draft_model, num_draft_tokens
+    )
+    return {
+        "baseline_tps": baseline["tps"],
+        "speculative_tps": drafted["tps"],
+        "speedup": round(drafted["tps"] / baseline["tps"], 3) if baseline["tps"] else 0,
+        "draft_tokens_proposed": drafted["draft_tokens_proposed"],
+        "draft_tokens_accepted": drafted["draft_tokens_accepted"],
+        "acceptance_rate": drafted["acceptance_rate"],
+    }
+
+
 def run_benchmark(args):
     """Run the complete benchmark suite."""
     print("\n" + "=" * 60)
@@ -194,6 +290,8 @@ def run_benchmark(args):
         "config": {
             "temperature": args.temperature,
             "max_tokens_override": args.max_tokens,
+            "draft_model": args.draft_model,
+            "num_draft_tokens": args.num_draft_tokens if args.draft_model else None,
         },
         "metrics": {},
         "tests": [],
@@ -221,6 +319,8 @@ def run_benchmark(args):
     if args.dry_run:
         print("\nDry run mode - skipping model load and tests")
         print(f"Would test model: {args.model}")
+        if args.draft_model:
+            print(f"Would compare against draft model: {args.draft_model}")
         return results
 
     # Load model
@@ -231,6 +331,11 @@ def run_benchmark(args):
         print(f"Error loading model: {e}")
         raise
 
+    draft_model = None
+    if args.draft_model:
+        draft_model, _, draft_load_time = load_model(args.draft_model, memory_monitor)
+        results["metrics"]["draft_load_time_sec"] = round(draft_load_time, 2)
+
     # Load test prompts
     prompts = load_test_prompts(args.prompts)
 
@@ -243,6 +348,7 @@ def run_benchmark(args):
     # Run tests
     all_tps = []
     all_ttft = []
+    all_speculative = []
 
     for test_key, test_config in prompts.items():
         print(f"\n--- Test: {test_config['name']} ({test_key}) ---")
@@ -278,6 +384,24 @@ def run_benchmark(args):
             print(f"Total tokens: {test_result['total_tokens']}")
             print(f"Output preview: {test_result['output'][:100]}...")
 
+            if draft_model is not None:
+                speculative = run_speculative_comparison(
+                    model=model,
+                    draft_model=draft_model,
+                    tokenizer=tokenizer,
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    temperature=args.temperature,
+                    num_draft_tokens=args.num_draft_tokens,
+                )
+                test_result["speculative"] = speculative
+                all_speculative.append(speculative)
+
+                print(f"TPS without draft: {speculative['baseline_tps']:.2f} tokens/sec")
+                print(f"TPS with draft: {speculative['speculative_tps']:.2f} tokens/sec "
+                      f"({speculative['speedup']:.2f}x)")
+                print(f"Draft acceptance rate: {speculative['acceptance_rate']:.1%}")
+
         except Exception as e:
             print(f"Error in test {test_key}: {e}")
             results["tests"].append({
@@ -299,6 +423,15 @@ def run_benchmark(args):
     if all_ttft:
         results["metrics"]["avg_ttft_sec"] = round(sum(all_ttft) / len(all_ttft), 3)
 
+    if all_speculative:
+        n = len(all_speculative)
+        proposed = sum(s["draft_tokens_proposed"] for s in all_speculative)
+        accepted = sum(s["draft_tokens_accepted"] for s in all_speculative)
+        results["metrics"]["baseline_avg_tps"] = round(sum(s["baseline_tps"] for s in all_speculative) / n, 2)
+        results["metrics"]["speculative_avg_tps"] = round(sum(s["speculative_tps"] for s in all_speculative) / n, 2)
+        results["metrics"]["speculative_speedup"] = round(sum(s["speedup"] for s in all_speculative) / n, 3)
+        results["metrics"]["draft_acceptance_rate"] = round(accepted / proposed, 4) if proposed else 0
+
     # Print summary
     print("\n" + "=" * 60)
     print("BENCHMARK SUMMARY")
@@ -308,10 +441,17 @@ def run_benchmark(args):
     print(f"Peak memory: {results['metrics'].get('peak_memory_gb', 0):.2f} GB")
     print(f"Average TPS: {results['metrics'].get('avg_tps', 0):.2f} tokens/sec")
     print(f"Average TTFT: {results['metrics'].get('avg_ttft_sec', 0):.3f} sec")
+    if all_speculative:
+        print(f"Draft model: {args.draft_model} ({args.num_draft_tokens} draft tokens)")
+        print(f"Average TPS without/with draft: {results['metrics']['baseline_avg_tps']:.2f} / "
+              f"{results['metrics']['speculative_avg_tps']:.2f} tokens/sec "
+              f"({results['metrics']['speculative_speedup']:.2f}x)")
+        print(f"Draft acceptance rate: {results['metrics']['draft_acceptance_rate']:.1%}")
 
     # Cleanup
     del model
     del tokenizer
+    del draft_model
     gc.collect()
 
     return results
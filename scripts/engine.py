@@ -0,0 +1,874 @@
+"""
+MLX 连续批处理(continuous batching)生成引擎
+
+模型只由一个专用的引擎线程持有和调用；HTTP处理线程通过 submit() 提交请求，
+然后只需消费属于自己的输出队列。新请求在token边界加入正在运行的batch，
+完成的序列随即离开，聚合吞吐量随并发数增长。
+配置了 PrefixCache 时，请求只需prefill最长已缓存前缀之后的部分。
+并发序列数与排队深度由 AdmissionController 限制，超出时 submit() 直接拒绝。
+请求带有stop字符串时，在decode循环内匹配，一旦出现立即把序列移出batch。
+n>1 的请求只prefill一次prompt，然后把KV cache复制n份，n个样本在同一个batch中decode。
+等待并发槽位的请求由 FairScheduler 按优先级和租户加权公平地放行。
+配置了draft模型时改为逐个请求做投机解码：小模型提议若干token，大模型一次前向验证。
+KV cache的长度上限（滑动窗口）与量化由 KVCacheConfig 决定。
+配置了 BlockAllocator 时按KV块记账：prompt和每个新token占用块，空闲块不足时不再接纳请求。
+请求可以带上一轮保存的KV cache（resume_cache），并在结束时交出自己的cache（on_cache），
+有状态的会话每轮只需prefill新增的部分。
+
+长prompt按块prefill，每一步先为正在decode的序列各生成一个token，再处理一块prompt；
+每步处理的token总数受 step_token_budget 限制，超长prompt不会让其他流长时间停顿。
+"""
+
+import asyncio
+import copy
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import mlx.core as mx
+import mlx_lm
+from mlx_lm.generate import BatchGenerator, speculative_generate_step
+from mlx_lm.models.cache import can_trim_prompt_cache, trim_prompt_cache
+
+import metrics
+from admission import AdmissionController
+from kv_blocks import BlockAllocationError, BlockAllocator
+from kv_cache import KVCacheConfig
+from prompt_cache import PrefixCache, cache_nbytes, common_prefix_length
+from scheduler import DEFAULT_PRIORITY, FairScheduler
+from stop_sequences import StopSequenceMatcher
+
+MIN_PREFILL_CHUNK = 128  # 预算被decode占满时每个prefill序列每步仍处理的token数
+# BatchGenerator(stream=)、next()返回的元组、insert(all_tokens=)、
+# remove(return_prompt_caches=)和prompt_cache_nbytes需要的最低版本
+MIN_MLX_LM_VERSION = (0, 31, 2)
+
+
+def check_mlx_lm_version():
+    """已安装的mlx-lm低于MIN_MLX_LM_VERSION时抛出RuntimeError"""
+    parts = []
+    for part in mlx_lm.__version__.split(".")[:3]:
+        digits = "".join(itertools.takewhile(str.isdigit, part))
+        parts.append(int(digits or 0))
+    if tuple(parts) < MIN_MLX_LM_VERSION:
+        required = ".".join(map(str, MIN_MLX_LM_VERSION))
+        raise RuntimeError(
+            f"mlx-lm {mlx_lm.__version__} is too old, {required}+ is required. "
+            f"Run: pip install -U 'mlx-lm>={required}'"
+        )
+
+
+@dataclass
+class GenerationRequest:
+    """提交给引擎的一个生成请求"""
+    prompt_tokens: List[int]
+    max_tokens: int = 500
+    sampler: Optional[Callable] = None
+    stop: List[str] = field(default_factory=list)  # 遇到任一字符串即停止（不包含在输出中）
+    stop_after: List[str] = field(default_factory=list)  # 遇到任一字符串即停止（包含在输出中）
+    n: int = 1  # 采样的候选数，共享同一次prefill
+    model: str = ""  # 请求的模型名（响应中的model字段）
+    endpoint: str = ""  # 发起请求的API路径（指标标签）
+    cache_key: Optional[str] = None  # 可缓存（temperature=0）时的响应cache键
+    priority: str = DEFAULT_PRIORITY  # 调度优先级（interactive/batch）
+    tenant: str = ""  # 租户，用于公平调度与并发上限
+    # 有状态会话：在引擎线程中取得上一轮保存的 (tokens, cache)，优先于前缀cache
+    resume_cache: Optional[Callable[[], Optional[Tuple[List[int], List[Any]]]]] = None
+    # 结束时在引擎线程中交出最终的 (tokens, cache)，调用方不得修改cache
+    on_cache: Optional[Callable[[List[int], List[Any]], None]] = None
+    response_id: Optional[str] = None  # Responses API: 本轮响应的id（store=true时据此保存）
+    messages: Optional[List[Dict[str, Any]]] = None  # Responses API: 本轮完整的输入消息（含历史）
+    # 约束解码（response_format）：每个候选调用一次，得到该候选独立的logits processor
+    logits_processor: Optional[Callable[[], Callable]] = None
+    # 请求带tools时的工具调用解析器工厂（API层解析输出用，引擎不使用）
+    tool_parser: Optional[Callable[[], Any]] = None
+
+
+@dataclass
+class GenerationOutput:
+    """引擎输出的一个增量（通常对应一个token）"""
+    text: str
+    token: Optional[int]
+    finish_reason: Optional[str] = None
+    prompt_tokens: int = 0
+    generation_tokens: int = 0
+    index: int = 0  # 属于第几个候选（n>1时）
+
+
+class RequestHandle:
+    """
+    调用方持有的请求句柄，可迭代得到 GenerationOutput，n个候选全部结束时迭代结束。
+
+    绑定了事件循环(loop)的句柄用 async for 消费，输出通过
+    call_soon_threadsafe 投递，等待中的客户端只占用协程而不占用线程。
+    """
+
+    def __init__(
+        self,
+        engine: "GenerationEngine",
+        request: GenerationRequest,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        self.engine = engine
+        self.request = request
+        self.uids: List[int] = []  # 加入batch后每个候选对应一个uid
+        self.cached_tokens = 0  # 命中前缀cache而无需prefill的token数
+        self.submitted_at = time.perf_counter()
+        self.started_at: Optional[float] = None  # 离开队列、开始prefill的时间
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 投机解码统计：draft模型提议/被接受的token数
+        self.draft_proposed = 0
+        self.draft_accepted = 0
+        self.detokenize_time = 0.0  # 反tokenize与stop匹配的累计耗时
+        self.kv_bytes = 0  # 结束时单个序列的KV cache字节数（各候选取最大）
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+        # 每个候选的上一个token时间与已生成token数（用于指标）
+        self._last_token_at: Dict[int, float] = {}
+        self._generated: Dict[int, int] = {}
+        self._remaining = request.n
+
+    def put(self, item: Union[GenerationOutput, Exception]):
+        """由引擎线程调用"""
+        now = time.perf_counter()
+        if isinstance(item, GenerationOutput):
+            self._observe(item, now)
+        else:
+            self.finished_at = now
+            self._finish_metrics("error", self._remaining)
+        self._deliver(item)
+
+    def _deliver(self, item: Union[GenerationOutput, Exception]):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        else:
+            self._queue.put(item)
+
+    def __iter__(self):
+        remaining = self.request.n
+        while True:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            if item.finish_reason is not None:
+                remaining -= 1
+                if not remaining:
+                    return
+
+    async def __aiter__(self):
+        remaining = self.request.n
+        while True:
+            item = await self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            if item.finish_reason is not None:
+                remaining -= 1
+                if not remaining:
+                    return
+
+    @property
+    def done(self) -> bool:
+        """所有候选都已结束（或出错）"""
+        return self._remaining <= 0
+
+    def cancel(self):
+        """放弃该请求，引擎会在下一个token边界释放它的序列"""
+        self.engine.cancel(self)
+
+    def _observe(self, out: GenerationOutput, now: float):
+        """更新计时和延迟指标"""
+        labels = {"endpoint": self.request.endpoint, "model": self.request.model}
+        if out.token is not None:
+            if self.first_token_at is None:
+                self.first_token_at = now
+                metrics.TTFT.observe(now - self.submitted_at, **labels)
+                uncached = len(self.request.prompt_tokens) - self.cached_tokens
+                prefill_time = now - (self.started_at or self.submitted_at)
+                if uncached > 0 and prefill_time > 0:
+                    metrics.PREFILL_TPS.observe(uncached / prefill_time, **labels)
+            last = self._last_token_at.get(out.index)
+            if last is not None:
+                metrics.INTER_TOKEN_LATENCY.observe(now - last, **labels)
+            self._last_token_at[out.index] = now
+        self._generated[out.index] = out.generation_tokens
+        if out.finish_reason is None:
+            return
+
+        self.finished_at = now
+        self._finish_metrics(out.finish_reason, 1)
+        if self._remaining:
+            return
+        completion_tokens = sum(self._generated.values())
+        metrics.REQUEST_DURATION.observe(now - self.submitted_at, **labels)
+        metrics.PROMPT_TOKENS.observe(len(self.request.prompt_tokens), **labels)
+        metrics.CACHED_PROMPT_TOKENS.inc(self.cached_tokens, **labels)
+        metrics.COMPLETION_TOKENS.observe(completion_tokens, **labels)
+        decode_time = now - self.first_token_at if self.first_token_at else 0
+        if completion_tokens > 1 and decode_time > 0:
+            metrics.DECODE_TPS.observe(completion_tokens / decode_time, **labels)
+        if self.draft_proposed:
+            metrics.DRAFT_PROPOSED.inc(self.draft_proposed, **labels)
+            metrics.DRAFT_ACCEPTED.inc(self.draft_accepted, **labels)
+
+    def _finish_metrics(self, finish_reason: str, count: int):
+        if count <= 0:
+            return
+        self._remaining -= count
+        metrics.GENERATIONS.inc(
+            count, endpoint=self.request.endpoint, model=self.request.model, finish_reason=finish_reason
+        )
+
+
+@dataclass
+class _Fork:
+    """n>1 的请求：先分块prefill共享的prompt，完成后复制cache加入batch"""
+    handle: RequestHandle
+    cache: List[Any]
+    position: int  # 已在cache中的token数
+    cached: int  # 其中命中前缀cache的token数
+
+
+@dataclass
+class _Sequence:
+    """引擎线程内部的每序列状态"""
+    handle: RequestHandle
+    detokenizer: Any
+    stop: Optional[StopSequenceMatcher] = None
+    index: int = 0
+    generation_tokens: int = 0
+
+
+class GenerationEngine:
+    """拥有模型的引擎线程，运行连续批处理的decode循环"""
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        admission: Optional[AdmissionController] = None,
+        prefill_batch_size: int = 8,
+        prefill_step_size: int = 2048,
+        step_token_budget: int = 0,
+        prefix_cache: Optional[PrefixCache] = None,
+        draft_model=None,
+        num_draft_tokens: int = 3,
+        scheduler: Optional[FairScheduler] = None,
+        kv_config: Optional[KVCacheConfig] = None,
+        block_allocator: Optional[BlockAllocator] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.admission = admission or AdmissionController()
+        self.prefill_batch_size = prefill_batch_size
+        self.prefill_step_size = prefill_step_size  # 每个序列每步最多prefill的token数
+        self.step_token_budget = step_token_budget  # 每步decode+prefill的token总数上限，0表示不限制
+        self.prefix_cache = prefix_cache
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.scheduler = scheduler or FairScheduler()
+        self.kv_config = kv_config or KVCacheConfig()
+        self.kv_active_bytes = 0  # 正在生成的序列的KV cache字节数（引擎线程更新）
+        self.block_allocator = block_allocator  # 只用于连续批处理，uid即块表的序列id
+
+        self._inbox: "queue.Queue[RequestHandle]" = queue.Queue()
+        self._cancelled: "queue.Queue[RequestHandle]" = queue.Queue()
+        self._sequences: Dict[int, _Sequence] = {}
+        self._forks: "deque[_Fork]" = deque()
+        self._stream = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mlx-engine", daemon=True)
+
+    @property
+    def active_count(self) -> int:
+        """正在batch中的序列数"""
+        return len(self._sequences)
+
+    @property
+    def pending_count(self) -> int:
+        """已提交但尚未加入batch的请求数"""
+        return self.admission.queued
+
+    def kv_stats(self) -> Dict[str, Any]:
+        active = self.active_count
+        return {
+            **self.kv_config.stats(),
+            "active_bytes": self.kv_active_bytes,
+            "active_sequences": active,
+            "bytes_per_sequence": self.kv_active_bytes // active if active else 0,
+        }
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def submit(
+        self,
+        request: GenerationRequest,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> RequestHandle:
+        """提交请求（线程安全），返回可迭代的句柄；饱和时抛出 QueueFullError"""
+        if not request.prompt_tokens:
+            raise ValueError("prompt is empty")
+        if not 1 <= request.n <= self.admission.max_concurrent:
+            raise ValueError(f"n must be between 1 and {self.admission.max_concurrent}")
+        if request.logits_processor is not None and self.draft_model is not None:
+            # 投机解码验证草稿时logits processor看到的上下文会回退，无法跟踪自动机状态
+            raise ValueError("response_format is not supported with speculative decoding")
+        allocator = self.block_allocator
+        if allocator is not None and self.draft_model is None:
+            # 放不进全部KV块的prompt永远等不到空闲块
+            needed = allocator.blocks_needed(self._block_tokens(len(request.prompt_tokens)), request.n)
+            needed += allocator.watermark_blocks
+            if needed > allocator.num_blocks:
+                raise ValueError(f"prompt needs {needed} KV blocks, only {allocator.num_blocks} configured")
+        self.admission.reserve(len(request.prompt_tokens))
+        handle = RequestHandle(self, request, loop)
+        self._inbox.put(handle)
+        return handle
+
+    def cancel(self, handle: RequestHandle):
+        self._cancelled.put(handle)
+
+    def _run(self):
+        # 在引擎线程自己的stream上运行所有计算
+        self._stream = mx.default_stream(mx.default_device())
+        if self.draft_model is not None:
+            self._run_speculative()
+        else:
+            self._run_batch()
+
+    def _make_batch(self) -> BatchGenerator:
+        return BatchGenerator(
+            self.model,
+            stop_tokens=[(t,) for t in self.tokenizer.eos_token_ids],
+            completion_batch_size=self.admission.max_concurrent,
+            prefill_batch_size=self.prefill_batch_size,
+            prefill_step_size=self.prefill_step_size,
+            stream=self._stream,
+        )
+
+    def _run_batch(self):
+        batch = self._make_batch()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    self._step_batch(batch)
+                except Exception as e:
+                    # 引擎线程不能退出，否则所有请求都会永远等待：
+                    # 进行中的请求以该异常结束，换一个新的batch继续
+                    self._fail_running(e)
+                    batch.close()
+                    batch = self._make_batch()
+        finally:
+            batch.close()
+
+    def _step_batch(self, batch):
+        """引擎循环的一次迭代：接收、取消、接纳、prefill，然后decode一步"""
+        # 空闲时阻塞等待新请求，忙碌时只取已到达的请求
+        self._receive(block=not (self._sequences or self._forks))
+        self._drop_cancelled(batch)
+        self._admit(batch)
+        chunk = self._prefill_chunk()
+        if self._forks:
+            self._advance_fork(batch, chunk)
+        if not self._sequences:
+            self.kv_active_bytes = 0
+            return
+
+        batch.prefill_step_size = chunk
+        _, responses = batch.next()
+        self.kv_active_bytes = batch.prompt_cache_nbytes
+
+        stopped = {}
+        failed = []
+        for r in responses:
+            seq = self._sequences.get(r.uid)
+            if seq is None:
+                continue
+            try:
+                finish_reason = r.finish_reason
+                if finish_reason is None and not self._append_block(r.uid, r.token):
+                    # KV块用尽：序列提前结束，与达到max_tokens相同
+                    finish_reason = "length"
+                finish_reason = self._emit(seq, r.token, finish_reason)
+                if finish_reason is None:
+                    continue
+                del self._sequences[r.uid]
+                self._finish(seq.handle)
+                self._release(r.uid)
+                if r.finish_reason is not None:
+                    self._record_kv(seq.handle, r.prompt_cache)
+                    self._store_cache(r.all_tokens, r.prompt_cache, seq.handle.request)
+                else:
+                    # 遇到stop字符串，batch中的序列还在继续，需要提前移除
+                    stopped[r.uid] = seq
+            except Exception as e:
+                # 只影响这一个序列（如detokenize或保存cache出错）
+                if self._sequences.pop(r.uid, None) is not None:
+                    self._finish(seq.handle)
+                    self._release(r.uid)
+                    if r.finish_reason is None:
+                        failed.append(r.uid)
+                seq.handle.put(e)
+        if stopped:
+            self._remove(batch, stopped)
+        if failed:
+            batch.remove(failed)
+
+    def _fail_running(self, error: Exception):
+        """让batch中的序列和正在prefill的n>1请求以error结束"""
+        print(f"⚠️  引擎出错，{len(self._sequences)} 个进行中的序列以错误结束: {type(error).__name__}: {error}")
+        for uid, seq in self._sequences.items():
+            self._finish(seq.handle)
+            self._release(uid)
+            seq.handle.put(error)
+        self._sequences.clear()
+        for fork in self._forks:
+            for _ in range(fork.handle.request.n):
+                self._finish(fork.handle)
+            fork.handle.put(error)
+        self._forks.clear()
+        self.kv_active_bytes = 0
+
+    def _run_speculative(self):
+        """
+        投机解码：BatchGenerator不支持draft模型，请求按到达顺序逐个生成。
+
+        decode受内存带宽限制时，一次验证多个draft token比组batch更划算。
+        每生成一个token检查一次取消和新到达的请求。
+        """
+        while not self._stopping.is_set():
+            try:
+                self._step_speculative()
+            except Exception as e:
+                # 单个请求的错误在 _step_speculative 内处理，这里只保证引擎线程继续运行
+                print(f"⚠️  引擎出错: {type(e).__name__}: {e}")
+
+    def _step_speculative(self):
+        self._receive(block=True)
+        self._drop_cancelled(None)
+        handle = self.scheduler.pop(self._can_start)
+        if handle is None:
+            return
+        req = handle.request
+        self._start(handle)
+        index = 0
+        try:
+            caches, start, handle.cached_tokens = self._prompt_caches(req)
+            handle.uids = list(range(req.n))
+            for index, cache in enumerate(caches):
+                if not self._generate_speculative(handle, index, cache, start):
+                    break
+        except Exception as e:
+            for _ in range(index, req.n):
+                self._finish(handle)
+            handle.put(e)
+
+    def _generate_speculative(self, handle: RequestHandle, index: int, cache, start: int) -> bool:
+        """生成一个候选，返回False表示请求已被取消"""
+        req = handle.request
+        seq = _Sequence(
+            handle,
+            self.tokenizer.detokenizer,
+            StopSequenceMatcher(req.stop, req.stop_after) if req.stop or req.stop_after else None,
+            index,
+        )
+        tokens = list(req.prompt_tokens)
+        generator = speculative_generate_step(
+            mx.array(req.prompt_tokens[start:]),
+            self.model,
+            self.draft_model,
+            self._stream,
+            num_draft_tokens=self.num_draft_tokens,
+            max_tokens=req.max_tokens,
+            sampler=req.sampler,
+            prompt_cache=cache,
+            prefill_step_size=self.prefill_step_size,
+        )
+        n_generated = 0
+        new_round = True
+        cancelled = False
+        try:
+            for token, _, from_draft in generator:
+                # 每一轮draft模型提议若干token，以一个大模型采样的token结束
+                if new_round:
+                    handle.draft_proposed += min(req.max_tokens - n_generated, self.num_draft_tokens)
+                new_round = not from_draft
+                handle.draft_accepted += from_draft
+                n_generated += 1
+                tokens.append(token)
+
+                if token in self.tokenizer.eos_token_ids:
+                    finish_reason = "stop"
+                elif n_generated >= req.max_tokens:
+                    finish_reason = "length"
+                else:
+                    finish_reason = None
+                if self._emit(seq, token, finish_reason) is not None:
+                    break
+
+                self.kv_active_bytes = cache_nbytes(cache)
+                self._receive(block=False)
+                if handle in self._drop_cancelled(None):
+                    cancelled = True
+                    break
+            else:
+                # 生成器提前结束（max_tokens不是正数）
+                handle.put(GenerationOutput(
+                    "", None, "length", len(req.prompt_tokens), seq.generation_tokens, index
+                ))
+        finally:
+            generator.close()
+
+        self.kv_active_bytes = 0
+        self._finish(handle)
+        self._record_kv(handle, cache)
+        self._store_speculative_cache(tokens, cache, req)
+        if cancelled:
+            n_prompt = len(req.prompt_tokens)
+            handle.put(GenerationOutput("", None, "cancelled", n_prompt, seq.generation_tokens, index))
+            for rest in range(index + 1, req.n):
+                self._finish(handle)
+                handle.put(GenerationOutput("", None, "cancelled", n_prompt, 0, rest))
+        return not cancelled
+
+    def _store_speculative_cache(self, tokens: List[int], cache: List[Any], req: GenerationRequest):
+        """大模型与draft模型的cache长度可能相差一个token，裁剪到一致后存入前缀cache"""
+        n_layers = len(self.model.layers)
+        model_cache, draft_cache = cache[:n_layers], cache[n_layers:]
+        length = min(model_cache[0].offset, draft_cache[0].offset, len(tokens))
+        trim_prompt_cache(model_cache, model_cache[0].offset - length)
+        trim_prompt_cache(draft_cache, draft_cache[0].offset - length)
+        self._store_cache(tokens[:length], cache, req)
+
+    def _receive(self, block: bool):
+        """把inbox中新到达的请求移入等待队列"""
+        try:
+            self._push(self._inbox.get(timeout=0.1) if block else self._inbox.get_nowait())
+            while True:
+                self._push(self._inbox.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _push(self, handle: RequestHandle):
+        try:
+            self.scheduler.push(handle)
+        except Exception as e:
+            # 无法排队的请求直接失败，不影响其他请求
+            self.admission.release_queued(len(handle.request.prompt_tokens))
+            handle.put(e)
+
+    def _admit(self, batch):
+        """在并发上限内把等待中的请求插入batch（在token边界进行）"""
+        while True:
+            handle = self.scheduler.pop(self._can_start)
+            if handle is None:
+                break
+            req = handle.request
+            self._start(handle)
+            try:
+                cache, cached = self._fetch_cache(req)
+                handle.cached_tokens = cached
+                if req.n > 1:
+                    # 共享的prompt由 _advance_fork 分块prefill，完成后再复制n份加入batch
+                    self._forks.append(_Fork(handle, cache, cached, cached))
+                    continue
+                self._insert(batch, handle, [cache], cached)
+            except Exception as e:
+                for _ in range(req.n):
+                    self._finish(handle)
+                handle.put(e)
+
+    def _insert(self, batch, handle: RequestHandle, caches: List[Any], start: int):
+        """把请求的n个候选加入batch，caches中已有prompt的前start个token"""
+        req = handle.request
+        uids = batch.insert(
+            [req.prompt_tokens[start:]] * req.n,
+            max_tokens=[req.max_tokens] * req.n,
+            caches=caches,
+            # batch会就地追加生成的token，每个候选需要独立的列表
+            all_tokens=[req.prompt_tokens[:start] for _ in range(req.n)],
+            samplers=[req.sampler] * req.n if req.sampler else None,
+            logits_processors=[[req.logits_processor()] for _ in range(req.n)] if req.logits_processor else None,
+        )
+        if self.block_allocator is not None:
+            try:
+                # n个候选从同一个prompt分出（allocator不共享时各自占用完整的块）
+                self.block_allocator.allocate(uids[0], req.prompt_tokens[-self._block_tokens(len(req.prompt_tokens)):])
+                for uid in uids[1:]:
+                    self.block_allocator.fork(uids[0], uid)
+            except BlockAllocationError:
+                for uid in uids:
+                    self.block_allocator.free(uid)
+                batch.remove(uids)
+                raise
+        handle.uids = uids
+        for index, uid in enumerate(uids):
+            self._sequences[uid] = _Sequence(
+                handle,
+                self.tokenizer.detokenizer,
+                StopSequenceMatcher(req.stop, req.stop_after) if req.stop or req.stop_after else None,
+                index,
+            )
+
+    def _prefill_chunk(self) -> int:
+        """
+        本步每个prefill中的序列处理的prompt token数。
+
+        每个decode中的序列每步消耗一个token的预算，剩余预算由prefill中的序列
+        （最多prefill_batch_size个，加上正在prefill的n>1请求）平分。
+        """
+        if not self.step_token_budget:
+            return self.prefill_step_size
+        prefilling = sum(1 for seq in self._sequences.values() if seq.generation_tokens == 0)
+        decoding = len(self._sequences) - prefilling
+        prefilling = min(prefilling, self.prefill_batch_size) + (1 if self._forks else 0)
+        if not prefilling:
+            return self.prefill_step_size
+        share = (self.step_token_budget - decoding) // prefilling
+        return max(MIN_PREFILL_CHUNK, min(self.prefill_step_size, share))
+
+    def _advance_fork(self, batch, chunk: int):
+        """为最早的n>1请求prefill一块prompt，全部完成后把n个候选加入batch"""
+        fork = self._forks[0]
+        req = fork.handle.request
+        end = len(req.prompt_tokens) - 1
+        try:
+            if fork.position < end:
+                n = min(chunk, end - fork.position)
+                self._prefill(fork.cache, req.prompt_tokens[fork.position:fork.position + n])
+                fork.position += n
+            if fork.position < end:
+                return
+            self._forks.popleft()
+            caches = [fork.cache] + [copy.deepcopy(fork.cache) for _ in range(req.n - 1)]
+            self._insert(batch, fork.handle, caches, end)
+        except Exception as e:
+            if self._forks and self._forks[0] is fork:
+                self._forks.popleft()
+            for _ in range(req.n):
+                self._finish(fork.handle)
+            fork.handle.put(e)
+
+    def _fetch_cache(self, req: GenerationRequest):
+        """
+        取得请求的初始KV cache：命中前缀cache时是其副本，否则按需新建（可能为None，
+        由BatchGenerator创建）。返回 (cache, 已在cache中的token数)。
+        """
+        cache, cached = None, 0
+        if req.resume_cache is not None:
+            cache, cached = self._resume_cache(req)
+        if cache is None and self.prefix_cache is not None:
+            cache, cached = self.prefix_cache.fetch(req.prompt_tokens)
+        if self.draft_model is not None:
+            # 投机解码逐个请求生成，prompt已超过量化起始位置时直接在量化cache上生成
+            cache = self.kv_config.quantize(cache or self._make_cache(), len(req.prompt_tokens))
+        elif cache is not None:
+            # BatchGenerator不支持量化cache，前缀cache中的量化条目先还原
+            cache = self.kv_config.dequantize(cache)
+        elif req.n > 1 or self.kv_config.max_kv_size is not None:
+            # 有KV上限时总是自己创建cache（BatchGenerator对自带make_cache的模型不使用滑动窗口）
+            cache = self._make_cache()
+        return cache, cached
+
+    def _resume_cache(self, req: GenerationRequest):
+        """
+        上一轮保存的cache：与prompt的公共前缀直接复用，cache中多出的部分
+        （例如chat template重新渲染历史时不同的结尾）裁剪掉。返回 (cache副本, token数)。
+        """
+        saved = req.resume_cache()
+        if saved is None:
+            return None, 0
+        tokens, cache = saved
+        # 投机解码的cache还包含draft模型的层，切换模式后保存的cache不可用
+        if len(cache) != len(self._make_cache()):
+            return None, 0
+        n = min(common_prefix_length(tokens, req.prompt_tokens), len(req.prompt_tokens) - 1)
+        if n <= 0 or (n < len(tokens) and not can_trim_prompt_cache(cache)):
+            return None, 0
+        cache = copy.deepcopy(cache)
+        if n < len(tokens):
+            trim_prompt_cache(cache, len(tokens) - n)
+        return cache, n
+
+    def _prompt_caches(self, req: GenerationRequest):
+        """
+        投机解码：为请求的每个候选准备KV cache。
+
+        返回 (caches, 已在cache中的token数, 其中命中前缀cache的token数)。
+        n>1 时在这里把prompt（除最后一个token）prefill一次，再复制n份。
+        """
+        cache, cached = self._fetch_cache(req)
+        if req.n == 1:
+            return [cache], cached, cached
+
+        start = len(req.prompt_tokens) - 1
+        self._prefill(cache, req.prompt_tokens[cached:start])
+        return [cache] + [copy.deepcopy(cache) for _ in range(req.n - 1)], start, cached
+
+    def _make_cache(self) -> List[Any]:
+        """新的空cache；投机解码时是大模型与draft模型cache的拼接（不使用滑动窗口，须可裁剪）"""
+        if self.draft_model is None:
+            return self.kv_config.make_cache(self.model)
+        return self.kv_config.make_cache(self.model, bounded=False) + self.kv_config.make_cache(
+            self.draft_model, bounded=False
+        )
+
+    def _prefill(self, cache: List[Any], tokens: List[int]):
+        """按prefill_step_size分块把tokens写入cache"""
+        n_layers = len(self.model.layers)
+        models = [(self.model, cache[:n_layers])]
+        if self.draft_model is not None:
+            models.append((self.draft_model, cache[n_layers:]))
+        with mx.stream(self._stream):
+            for model, model_cache in models:
+                for i in range(0, len(tokens), self.prefill_step_size):
+                    model(mx.array(tokens[i:i + self.prefill_step_size])[None], cache=model_cache)
+                    mx.eval([c.state for c in model_cache])
+
+    def _drop_cancelled(self, batch) -> List[RequestHandle]:
+        """
+        移除已取消的序列并释放其KV cache。
+
+        返回已开始生成的被取消请求（投机解码模式下由调用方自行结束）。
+        """
+        seqs = {}
+        running = []
+        while True:
+            try:
+                handle = self._cancelled.get_nowait()
+            except queue.Empty:
+                break
+            n_prompt = len(handle.request.prompt_tokens)
+            fork = next((f for f in self._forks if f.handle is handle), None)
+            if fork is not None:
+                # n>1 的请求仍在prefill共享的prompt
+                self._forks.remove(fork)
+                for index in range(handle.request.n):
+                    self._finish(handle)
+                    handle.put(GenerationOutput("", None, "cancelled", n_prompt, 0, index))
+                continue
+            if not handle.uids:
+                # 仍在排队
+                if self.scheduler.remove(handle):
+                    self.admission.release_queued(n_prompt)
+                    for index in range(handle.request.n):
+                        handle.put(GenerationOutput("", None, "cancelled", n_prompt, 0, index))
+                continue
+            running.append(handle)
+            for uid in handle.uids:
+                seq = self._sequences.pop(uid, None)
+                if seq is not None:
+                    seqs[uid] = seq
+                    self._finish(handle)
+                    self._release(uid)
+                    handle.put(GenerationOutput(
+                        "", None, "cancelled", n_prompt, seq.generation_tokens, seq.index
+                    ))
+        if seqs:
+            # 被取消序列已计算的KV同样可复用（例如客户端超时后重试）
+            self._remove(batch, seqs)
+        return running
+
+    def _remove(self, batch, seqs: Dict[int, _Sequence]):
+        """把未结束的序列移出batch，并保存它们的KV cache"""
+        for uid, (cache, tokens) in batch.remove(list(seqs), return_prompt_caches=True).items():
+            self._record_kv(seqs[uid].handle, cache)
+            self._store_cache(tokens, cache, seqs[uid].handle.request)
+
+    def _can_start(self, req: GenerationRequest) -> bool:
+        """并发槽位足够，且（按块记账时）空闲块足以容纳prompt"""
+        if not self.admission.can_start(req.n):
+            return False
+        if self.block_allocator is None or self.draft_model is not None:
+            return True
+        return self.block_allocator.can_allocate(self._block_tokens(len(req.prompt_tokens)), req.n)
+
+    def _block_tokens(self, n_tokens: int) -> int:
+        """n_tokens个token实际占用KV的token数：有--max-kv-size时滑动窗口不超过上限"""
+        max_kv_size = self.kv_config.max_kv_size
+        return n_tokens if max_kv_size is None else min(n_tokens, max_kv_size)
+
+    def _append_block(self, uid: int, token: int) -> bool:
+        if self.block_allocator is None:
+            return True
+        max_kv_size = self.kv_config.max_kv_size
+        if max_kv_size is not None and self.block_allocator.length(uid) >= max_kv_size:
+            # 滑动窗口已满：新token覆盖最旧的位置，不再占用新块
+            return True
+        return self.block_allocator.append(uid, token)
+
+    def _release(self, uid: int):
+        if self.block_allocator is not None:
+            self.block_allocator.free(uid)
+
+    def _start(self, handle: RequestHandle):
+        """请求离开队列、占用并发槽位"""
+        req = handle.request
+        self.admission.start(len(req.prompt_tokens), req.n)
+        handle.started_at = time.perf_counter()
+        metrics.QUEUE_WAIT.observe(
+            handle.started_at - handle.submitted_at, model=req.model, priority=req.priority
+        )
+
+    def _finish(self, handle: RequestHandle):
+        """释放请求的一个序列占用的并发槽位"""
+        self.admission.finish(time.perf_counter() - handle.submitted_at)
+        self.scheduler.finish(handle)
+
+    def _store_cache(self, tokens: List[int], cache, req: Optional[GenerationRequest] = None):
+        on_cache = req.on_cache if req is not None else None
+        if cache is None or not tokens or (self.prefix_cache is None and on_cache is None):
+            return
+        cache = self.kv_config.quantize(cache, len(tokens))
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(tokens, cache)
+        if on_cache is not None:
+            # 与前缀cache共享同一个cache对象，双方取用时都先复制
+            on_cache(list(tokens), cache)
+
+    @staticmethod
+    def _record_kv(handle: RequestHandle, cache):
+        if cache is not None:
+            handle.kv_bytes = max(handle.kv_bytes, cache_nbytes(cache))
+
+    def _emit(self, seq: _Sequence, token: int, finish_reason: Optional[str]) -> Optional[str]:
+        """增量反tokenize并推送给调用方，返回该序列的结束原因（未结束为None）"""
+        started = time.perf_counter()
+        detokenizer = seq.detokenizer
+        # 结束于EOS时不解码stop token
+        if finish_reason != "stop":
+            detokenizer.add_token(token)
+            seq.generation_tokens += 1
+        if finish_reason is not None:
+            detokenizer.finalize()
+        text = detokenizer.last_segment
+
+        if seq.stop is not None:
+            text, matched = seq.stop.feed(text)
+            if matched:
+                finish_reason = "stop"
+            elif finish_reason is not None:
+                text += seq.stop.flush()
+
+        seq.handle.detokenize_time += time.perf_counter() - started
+        seq.handle.put(GenerationOutput(
+            text,
+            token,
+            finish_reason,
+            len(seq.handle.request.prompt_tokens),
+            seq.generation_tokens,
+            seq.index,
+        ))
+        return finish_reason
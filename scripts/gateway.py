@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+多引擎网关：一个OpenAI兼容的入口，按模型名转发到MLX、llama.cpp server、LM Studio等后端
+
+    MiniMax-M2    → api_server.py (MLX, :8000)
+    qwen3-coder   → LM Studio (:1234)，过载或不可用时 → llama.cpp server (:8081)
+
+- 配置文件（默认 configs/gateway.json）声明后端与模型：每个模型按优先顺序列出
+  (后端, 上游模型名)，转发时把请求中的model改写为上游的名字
+- 每个后端是一个 router.ReplicaPool：keep-alive连接池、后台健康检查；一个后端
+  可以有多个地址，之间按前缀一致性哈希选择（同 router.py）
+- 后端的所有副本都不健康、或负载达到 max_load 时排到后面；连接失败或返回429/503
+  时（尚未向客户端发送任何数据）转给下一个后端
+- 流式响应（SSE）按块原样转发，不做缓冲
+- 后端差异：健康检查路径不同（llama.cpp的/health在加载模型时返回503，LM Studio
+  没有/health）；非MLX后端去掉只有api_server认识的字段（priority、tenant、mlx_trace）
+
+GET /v1/models 返回网关配置的模型；/health 汇总各后端状态。本地验证可用
+--fake-upstreams 在配置的各后端地址上启动模拟服务：
+
+    python scripts/gateway.py --config configs/gateway.json
+    python scripts/gateway.py --fake-upstreams --fake-status lmstudio=503
+"""
+
+import argparse
+import http.client
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import metrics
+from router import (
+    RETRY_STATUSES, NoReplicaError, ProxyHandler, Replica, ReplicaPool, make_server,
+    object_id, prefix_key, render_metrics, start_stub_backend,
+)
+
+DEFAULT_CONFIG = Path(__file__).parent.parent / "configs" / "gateway.json"
+
+# 只有api_server.py认识的请求字段，其他引擎可能拒绝未知字段
+MLX_FIELDS = ("priority", "tenant", "mlx_trace")
+
+# 各类后端的默认值，配置中可以逐项覆盖
+BACKEND_TYPES: Dict[str, Dict[str, Any]] = {
+    "mlx": {"health_path": "/health", "drop_fields": ()},
+    "llamacpp": {"health_path": "/health", "drop_fields": MLX_FIELDS},
+    "lmstudio": {"health_path": "/v1/models", "drop_fields": MLX_FIELDS},
+    "openai": {"health_path": "/v1/models", "drop_fields": MLX_FIELDS},
+}
+
+GATEWAY_REQUESTS = metrics.Counter(
+    "mlx_gateway_requests_total", "Requests handled by the gateway", ("model", "backend", "status"))
+GATEWAY_FAILOVERS = metrics.Counter(
+    "mlx_gateway_failovers_total", "Requests moved to the next backend", ("model", "backend", "reason"))
+GATEWAY_METRICS = (GATEWAY_REQUESTS, GATEWAY_FAILOVERS)
+
+
+class ConfigError(ValueError):
+    """网关配置无效"""
+
+
+@dataclass
+class Backend:
+    """一个推理引擎：一组地址（同一引擎的副本）与它的差异"""
+    name: str
+    type: str
+    pool: ReplicaPool
+    max_load: Optional[int] = None  # 每个副本的负载达到该值视为过载
+    drop_fields: Tuple[str, ...] = ()
+    api_key: Optional[str] = None
+
+    @property
+    def available(self) -> bool:
+        """有健康且未过载的副本"""
+        healthy = [r for r in self.pool.replicas.values() if r.healthy]
+        if self.max_load is None:
+            return bool(healthy)
+        return any(r.load < self.max_load for r in healthy)
+
+    def prepare(self, body: Optional[bytes], data: Any, model: Optional[str]) -> Optional[bytes]:
+        """改写model并去掉后端不支持的字段；无需改动时返回原请求体"""
+        if not isinstance(data, dict):
+            return body
+        drop = [f for f in self.drop_fields if f in data]
+        if not drop and (model is None or data.get("model") == model):
+            return body
+        data = {k: v for k, v in data.items() if k not in drop}
+        if model is not None:
+            data["model"] = model
+        return json.dumps(data, ensure_ascii=False).encode()
+
+    def prepare_headers(self, headers: Dict[str, str]) -> Dict[str, str]:
+        if not self.api_key:
+            return headers
+        headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+        headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def stats(self) -> Dict[str, Any]:
+        return {"type": self.type, "available": self.available, "max_load": self.max_load,
+                **self.pool.stats()}
+
+
+@dataclass
+class Target:
+    """模型的一个去处：后端与上游模型名（None时不改写）"""
+    backend: Backend
+    model: Optional[str] = None
+
+
+@dataclass
+class Gateway:
+    backends: Dict[str, Backend]
+    models: Dict[str, List[Target]]
+    default_model: Optional[str] = None
+    created: int = field(default_factory=lambda: int(time.time()))
+
+    def targets(self, path: str, data: Any, affinity: Optional[str]) -> Tuple[str, List[Target]]:
+        """
+        请求的 (公开模型名, 按优先顺序的去处)。
+
+        没有model的请求（按id查询响应、批处理）回到记住该id的后端；续接
+        previous_response_id 时持有会话的后端排在最前。找不到时抛出LookupError。
+        """
+        model = data.get("model") if isinstance(data, dict) else None
+        pinned = self.find_affinity(affinity) if affinity else None
+        if model is None and pinned is not None:
+            return "", [Target(pinned)]
+        name = model if model is not None else self.default_model
+        if name is None:
+            raise LookupError(f"no model specified for {path}")
+        targets = self.models.get(str(name))
+        if targets is None:
+            raise LookupError(f"model '{name}' not found")
+        if pinned is not None:
+            targets = sorted(targets, key=lambda t: t.backend is not pinned)
+        return str(name), targets
+
+    def find_affinity(self, object_id: str) -> Optional[Backend]:
+        for backend in self.backends.values():
+            if backend.pool.lookup_affinity(object_id) is not None:
+                return backend
+        return None
+
+    def models_body(self) -> Dict[str, Any]:
+        return {
+            "object": "list",
+            "data": [
+                {
+                    "id": name,
+                    "object": "model",
+                    "created": self.created,
+                    "owned_by": "gateway",
+                    "backends": [t.backend.name for t in targets],
+                    "available": any(t.backend.available for t in targets),
+                }
+                for name, targets in self.models.items()
+            ],
+        }
+
+    def start_health_checks(self, interval: float):
+        for backend in self.backends.values():
+            backend.pool.start_health_checks(interval)
+
+    def stop(self):
+        for backend in self.backends.values():
+            backend.pool.stop()
+
+
+def load_config(path: Path) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"cannot read {path}: {e}") from e
+
+
+def build_gateway(config: Dict[str, Any], timeout: float = 600, max_idle: int = 16,
+                  vnodes: int = 64, load_factor: float = 1.25) -> Gateway:
+    """按配置创建各后端的连接池（不启动健康检查）"""
+    backends: Dict[str, Backend] = {}
+    for name, spec in (config.get("backends") or {}).items():
+        kind = spec.get("type", "openai")
+        if kind not in BACKEND_TYPES:
+            raise ConfigError(f"backend '{name}': unknown type '{kind}' (expected one of {', '.join(BACKEND_TYPES)})")
+        defaults = BACKEND_TYPES[kind]
+        urls = spec.get("urls") or ([spec["url"]] if spec.get("url") else [])
+        if not urls:
+            raise ConfigError(f"backend '{name}': no urls")
+        pool = ReplicaPool(urls, vnodes, load_factor, spec.get("timeout", timeout), max_idle,
+                           spec.get("health_path", defaults["health_path"]))
+        backends[name] = Backend(
+            name=name,
+            type=kind,
+            pool=pool,
+            max_load=spec.get("max_load"),
+            drop_fields=tuple(spec.get("drop_fields", defaults["drop_fields"])),
+            api_key=spec.get("api_key"),
+        )
+    if not backends:
+        raise ConfigError("no backends configured")
+
+    models: Dict[str, List[Target]] = {}
+    for name, routes in (config.get("models") or {}).items():
+        targets = []
+        for route in routes if isinstance(routes, list) else [routes]:
+            if isinstance(route, str):
+                route = {"backend": route}
+            backend = backends.get(route.get("backend"))
+            if backend is None:
+                raise ConfigError(f"model '{name}': unknown backend '{route.get('backend')}'")
+            targets.append(Target(backend, route.get("model", name)))
+        if not targets:
+            raise ConfigError(f"model '{name}': no backends")
+        models[name] = targets
+    default_model = config.get("default_model")
+    if default_model is not None and default_model not in models:
+        raise ConfigError(f"default_model '{default_model}' is not a configured model")
+    return Gateway(backends, models, default_model)
+
+
+class GatewayHandler(ProxyHandler):
+    """按模型选择后端的ProxyHandler；同一后端内的副本选择与失败转移由其ReplicaPool完成"""
+
+    server_version = "mlx-gateway"
+    gateway: Gateway  # 由make_server设置
+
+    def handle_request(self):
+        if self.command == "GET" and self.path.split("?")[0].rstrip("/") == "/v1/models":
+            return self.send_json(200, self.gateway.models_body())
+        if self.command == "GET" and self.path == "/metrics":
+            text = render_metrics() + "\n".join(line for m in GATEWAY_METRICS for line in m.render()) + "\n"
+            return self.send_bytes(200, text.encode(), metrics.CONTENT_TYPE)
+        super().handle_request()
+
+    def dispatch(self, body: Optional[bytes], data: Any, headers: Dict[str, str]
+                 ) -> Tuple[ReplicaPool, Replica, http.client.HTTPConnection, http.client.HTTPResponse]:
+        """依次尝试模型的各个后端（不可用或过载的排在最后），返回第一个可用的响应"""
+        affinity = object_id(self.path, data)
+        model, targets = self.gateway.targets(self.path, data, affinity)
+        targets = [t for t in targets if t.backend.available] + [t for t in targets if not t.backend.available]
+        key = prefix_key(self.path, data, self.prefix_chars)
+        errors = []
+        for i, target in enumerate(targets):
+            backend = target.backend
+            try:
+                replica, conn, response = backend.pool.forward(
+                    self.command, self.path, backend.prepare(body, data, target.model),
+                    backend.prepare_headers(headers), key, affinity)
+            except NoReplicaError as e:
+                GATEWAY_FAILOVERS.inc(model=model, backend=backend.name, reason="down")
+                errors.append(f"{backend.name}: {e}")
+                continue
+            if response.status in RETRY_STATUSES and i + 1 < len(targets):
+                GATEWAY_FAILOVERS.inc(model=model, backend=backend.name, reason=str(response.status))
+                errors.append(f"{backend.name}: HTTP {response.status}")
+                response.read()
+                backend.pool.finish(replica, conn, response)
+                continue
+            GATEWAY_REQUESTS.inc(model=model, backend=backend.name, status=str(response.status))
+            return backend.pool, replica, conn, response
+        raise NoReplicaError(f"no backend available for model '{model}': " + "; ".join(errors))
+
+    def health_body(self) -> Dict[str, Any]:
+        backends = {name: backend.stats() for name, backend in self.gateway.backends.items()}
+        available = all(b["available"] for b in backends.values())
+        return {"status": "ok" if available else "degraded", "backends": backends}
+
+
+def start_fake_upstreams(gateway: Gateway, statuses: Dict[str, int], delay: float = 0.0) -> List[str]:
+    """在每个后端配置的地址上启动模拟服务（router.StubBackend），statuses指定后端固定返回的状态码"""
+    started = []
+    for backend in gateway.backends.values():
+        for replica in backend.pool.replicas.values():
+            server = start_stub_backend(backend.name, replica.host, replica.port, delay)
+            server.RequestHandlerClass.fail_status = statuses.get(backend.name, 0)
+            started.append(replica.url)
+    return started
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多引擎OpenAI兼容网关（MLX / llama.cpp / LM Studio）")
+    parser.add_argument("--config", type=Path, default=DEFAULT_CONFIG,
+                        help=f"网关配置 (default: {DEFAULT_CONFIG.relative_to(DEFAULT_CONFIG.parent.parent)})")
+    parser.add_argument("--host", type=str, default=None, help="监听地址，覆盖配置中的listen.host")
+    parser.add_argument("--port", type=int, default=None, help="监听端口，覆盖配置中的listen.port")
+    parser.add_argument("--health-interval", type=float, default=2.0, help="健康检查间隔(秒) (default: 2)")
+    parser.add_argument("--timeout", type=float, default=600, help="等待后端响应的超时(秒) (default: 600)")
+    parser.add_argument("--max-idle-connections", type=int, default=16,
+                        help="每个后端地址保留的keep-alive空闲连接数 (default: 16)")
+    parser.add_argument("--prefix-chars", type=int, default=2048,
+                        help="同一后端多个地址之间哈希的对话前缀字符数 (default: 2048)")
+    parser.add_argument("--fake-upstreams", action="store_true",
+                        help="在配置的各后端地址上启动模拟服务（本地验证用）")
+    parser.add_argument("--fake-status", action="append", default=[], metavar="BACKEND=STATUS",
+                        help="模拟后端固定返回的状态码，如 lmstudio=503（可重复）")
+    parser.add_argument("--fake-delay", type=float, default=0.0, help="模拟后端每个请求的耗时(秒) (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        config = load_config(args.config)
+        gateway = build_gateway(config, args.timeout, args.max_idle_connections)
+        statuses = {}
+        for item in args.fake_status:
+            name, _, status = item.partition("=")
+            if name not in gateway.backends or not status.isdigit():
+                raise ConfigError(f"invalid --fake-status '{item}'")
+            statuses[name] = int(status)
+    except ConfigError as e:
+        sys.exit(f"配置错误: {e}")
+
+    listen = config.get("listen") or {}
+    host = args.host or listen.get("host", "127.0.0.1")
+    port = args.port if args.port is not None else int(listen.get("port", 8080))
+    if args.fake_upstreams:
+        start_fake_upstreams(gateway, statuses, args.fake_delay)
+    gateway.start_health_checks(args.health_interval)
+    server = make_server(host, port, GatewayHandler, gateway=gateway, prefix_chars=args.prefix_chars)
+
+    print(f"{'='*60}")
+    print(f"多引擎网关{' (模拟后端)' if args.fake_upstreams else ''}")
+    print(f"{'='*60}")
+    print(f"地址: http://{host}:{port}")
+    print(f"后端:")
+    for backend in gateway.backends.values():
+        for replica in backend.pool.replicas.values():
+            state = "健康" if replica.healthy else "不可用: " + str(replica.last_error)
+            print(f"  • {backend.name} [{backend.type}] {replica.url} ({state})")
+    print(f"模型:")
+    for name, targets in gateway.models.items():
+        chain = " → ".join(f"{t.backend.name}:{t.model}" for t in targets)
+        print(f"  • {name}{' (默认)' if name == gateway.default_model else ''}: {chain}")
+    print(f"健康检查: 每 {args.health_interval:g} 秒")
+    print(f"\n按 Ctrl+C 停止")
+    print(f"{'='*60}\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+分页KV cache的块分配器
+
+KV cache按固定大小的块（block_size个token）分配，每个序列有一张块表
+（逻辑块 -> 物理块）。序列增长时只需要一个新块，而不是整段连续缓冲区，
+内存碎片只出现在每个序列的最后一个块里。
+
+share=True 时块可以被多个序列共享（引用计数）：
+- fork()：n>1 的候选复制父序列的块表，共享全部prompt块
+- allocate()：内容相同的满块按 (前一块哈希, 块内token) 的链式哈希查找，
+  共享同一system prompt的并发请求直接引用已有的块
+向共享的最后一个未满块追加token时先复制该块（copy-on-write）。
+
+这里只做块的记账，不依赖MLX：引擎按块而不是按序列数决定能否再接纳请求，
+并通过 stats() 报告块利用率、共享和碎片情况。记账必须与实际内存一致：
+mlx_lm 的 BatchGenerator 给每个序列（包括n个候选、命中前缀cache的请求）各自
+一份KV cache副本，物理上没有共享，所以引擎使用 share=False，fork() 与相同前缀
+都按完整的块计费。
+"""
+
+from collections import deque
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+
+class BlockAllocationError(Exception):
+    """空闲块不足"""
+
+
+class BlockAllocator:
+    """
+    物理块 0..num_blocks-1 的分配与引用计数。
+
+    只在引擎线程内访问，不加锁；stats() 可以从其他线程读取（只读计数）。
+    """
+
+    def __init__(self, num_blocks: int, block_size: int = 16, watermark: float = 0.01, share: bool = False):
+        if num_blocks <= 0 or block_size <= 0:
+            raise ValueError("num_blocks and block_size must be positive")
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.share = share  # 后端的KV cache是否真的按块共享
+        # 接纳新序列时保留的空闲块，供正在decode的序列继续增长
+        self.watermark_blocks = int(num_blocks * watermark)
+
+        self._free: "deque[int]" = deque(range(num_blocks))
+        self._refs = [0] * num_blocks
+        self._fill = [0] * num_blocks  # 块内已写入的token数
+        self._hash_of: Dict[int, int] = {}  # 满块 -> 内容哈希
+        self._by_hash: Dict[int, int] = {}  # 内容哈希 -> 满块
+
+        # 每个序列：块表、token数、最后一个满块的哈希、未满块中的token
+        self._tables: Dict[Hashable, List[int]] = {}
+        self._lengths: Dict[Hashable, int] = {}
+        self._last_hash: Dict[Hashable, Optional[int]] = {}
+        self._partial: Dict[Hashable, List[int]] = {}
+
+        # 统计
+        self.shared_hits = 0  # allocate() 时按内容复用的块数
+        self.cow_copies = 0
+        self.exhausted = 0  # 因空闲块不足而失败的分配次数
+
+    def __contains__(self, seq_id: Hashable) -> bool:
+        return seq_id in self._tables
+
+    @property
+    def free_blocks(self) -> int:
+        return len(self._free)
+
+    def blocks_needed(self, n_tokens: int, n: int = 1) -> int:
+        """n个候选的prompt各有n_tokens个token时需要的块数（共享时n个候选共用prompt块）"""
+        blocks = -(-n_tokens // self.block_size)
+        return blocks if self.share else blocks * n
+
+    def can_allocate(self, n_tokens: int, n: int = 1) -> bool:
+        """不考虑按内容复用时，分配后空闲块是否仍高于水位线"""
+        return self.blocks_needed(n_tokens, n) + self.watermark_blocks <= len(self._free)
+
+    def block_table(self, seq_id: Hashable) -> List[int]:
+        return list(self._tables[seq_id])
+
+    def length(self, seq_id: Hashable) -> int:
+        """序列已记账的token数"""
+        return self._lengths[seq_id]
+
+    def allocate(self, seq_id: Hashable, tokens: Sequence[int]):
+        """为新序列的prompt分配块，满块优先复用内容相同的已有块"""
+        if seq_id in self._tables:
+            raise ValueError(f"sequence {seq_id!r} already allocated")
+        size = self.block_size
+        n_full = len(tokens) // size
+        hashes = []
+        parent = None
+        for i in range(n_full):
+            parent = hash((parent, tuple(tokens[i * size:(i + 1) * size])))
+            hashes.append(parent)
+        reused = [self._by_hash.get(h) if self.share else None for h in hashes]
+        partial = list(tokens[n_full * size:])
+        needed = sum(1 for b in reused if b is None) + (1 if partial else 0)
+        if needed > len(self._free):
+            self.exhausted += 1
+            raise BlockAllocationError(f"need {needed} KV blocks, {len(self._free)} free")
+
+        table = []
+        for h, block in zip(hashes, reused):
+            if block is None:
+                block = self._take()
+                self._fill[block] = size
+                if self.share:
+                    self._register(block, h)
+            else:
+                self._refs[block] += 1
+                self.shared_hits += 1
+            table.append(block)
+        if partial:
+            block = self._take()
+            self._fill[block] = len(partial)
+            table.append(block)
+
+        self._tables[seq_id] = table
+        self._lengths[seq_id] = len(tokens)
+        self._last_hash[seq_id] = hashes[-1] if hashes else None
+        self._partial[seq_id] = partial
+
+    def fork(self, parent_id: Hashable, child_id: Hashable):
+        """子序列复制父序列的块表（n>1 的候选）：共享时引用同一批块，否则占用等量的新块"""
+        if child_id in self._tables:
+            raise ValueError(f"sequence {child_id!r} already allocated")
+        table = self._tables[parent_id]
+        if self.share:
+            for block in table:
+                self._refs[block] += 1
+            table = list(table)
+        else:
+            if len(table) > len(self._free):
+                self.exhausted += 1
+                raise BlockAllocationError(f"need {len(table)} KV blocks, {len(self._free)} free")
+            copies = []
+            for block in table:
+                copies.append(self._take())
+                self._fill[copies[-1]] = self._fill[block]
+            table = copies
+        self._tables[child_id] = table
+        self._lengths[child_id] = self._lengths[parent_id]
+        self._last_hash[child_id] = self._last_hash[parent_id]
+        self._partial[child_id] = list(self._partial[parent_id])
+
+    def append(self, seq_id: Hashable, token: int) -> bool:
+        """序列追加一个token，需要新块而没有空闲块时返回False（序列状态不变）"""
+        table = self._tables[seq_id]
+        partial = self._partial[seq_id]
+        if not partial:
+            # 最后一个块已满（或序列为空），需要新块
+            if not self._free:
+                self.exhausted += 1
+                return False
+            table.append(self._take())
+        elif self._refs[table[-1]] > 1:
+            # 与其他序列共享的未满块：写入前复制
+            if not self._free:
+                self.exhausted += 1
+                return False
+            old = table[-1]
+            self._refs[old] -= 1
+            table[-1] = self._take()
+            self._fill[table[-1]] = self._fill[old]
+            self.cow_copies += 1
+
+        block = table[-1]
+        partial.append(token)
+        self._fill[block] = len(partial)
+        self._lengths[seq_id] += 1
+        if len(partial) == self.block_size:
+            h = hash((self._last_hash[seq_id], tuple(partial)))
+            self._last_hash[seq_id] = h
+            self._partial[seq_id] = []
+            if self.share and h not in self._by_hash:
+                self._register(block, h)
+        return True
+
+    def free(self, seq_id: Hashable):
+        """释放序列，引用计数归零的块回到空闲列表"""
+        table = self._tables.pop(seq_id, None)
+        if table is None:
+            return
+        del self._lengths[seq_id], self._last_hash[seq_id], self._partial[seq_id]
+        for block in table:
+            self._refs[block] -= 1
+            if self._refs[block] == 0:
+                h = self._hash_of.pop(block, None)
+                if h is not None:
+                    del self._by_hash[h]
+                self._fill[block] = 0
+                self._free.append(block)
+
+    def stats(self) -> Dict[str, Any]:
+        used = self.num_blocks - len(self._free)
+        logical = sum(len(t) for t in list(self._tables.values()))
+        shared = sum(1 for r in self._refs if r > 1)
+        stored = sum(f for r, f in zip(self._refs, self._fill) if r > 0)
+        return {
+            "block_size": self.block_size,
+            "share": self.share,
+            "num_blocks": self.num_blocks,
+            "used_blocks": used,
+            "free_blocks": len(self._free),
+            "utilization": round(used / self.num_blocks, 4),
+            "sequences": len(self._tables),
+            "tokens": sum(list(self._lengths.values())),
+            "shared_blocks": shared,
+            # 共享节省的块数：各序列块表的总长度减去实际占用的物理块
+            "blocks_saved_by_sharing": logical - used,
+            # 内部碎片：已占用块中未写入的token槽位比例
+            "fragmentation": round(1 - stored / (used * self.block_size), 4) if used else 0.0,
+            "shared_hits": self.shared_hits,
+            "cow_copies": self.cow_copies,
+            "exhausted": self.exhausted,
+        }
+
+    def _take(self) -> int:
+        block = self._free.popleft()
+        self._refs[block] = 1
+        return block
+
+    def _register(self, block: int, h: int):
+        self._hash_of[block] = h
+        self._by_hash[h] = block
+
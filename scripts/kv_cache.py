@@ -0,0 +1,91 @@
+"""
+KV cache的长度上限与量化
+
+长对话的KV cache随上下文线性增长。设置 max_kv_size 后每个序列使用滑动窗口
+（RotatingKVCache，保留开头几个token与最近的 max_kv_size 个token），单个会话
+占用的内存有上界。
+
+设置 kv_bits 后，长度达到 quantized_kv_start 的序列的KV按 kv_bits 位分组量化
+（4位约为fp16的1/4，8位约为1/2）。BatchGenerator不支持量化cache，连续批处理中
+正在decode的序列保持全精度；量化作用于序列结束后留在前缀cache中的KV（下一轮
+对话命中时再还原），空闲的长会话因此可以多存几倍。投机解码逐个请求生成，
+prompt已超过起始位置的请求直接在量化cache上生成。滑动窗口cache不量化。
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import mlx.core as mx
+from mlx_lm.models.cache import KVCache, QuantizedKVCache, RotatingKVCache, make_prompt_cache
+
+DEFAULT_QUANTIZED_KV_START = 5000
+
+
+@dataclass
+class KVCacheConfig:
+    max_kv_size: Optional[int] = None  # 每个序列的KV上限（滑动窗口），None表示不限制
+    kv_bits: Optional[int] = None  # KV量化位数，None表示不量化
+    kv_group_size: int = 64
+    quantized_kv_start: int = DEFAULT_QUANTIZED_KV_START  # 序列达到该长度后才量化
+
+    def make_cache(self, model, bounded: bool = True) -> List[Any]:
+        """
+        新的空cache；bounded=False时不使用滑动窗口（投机解码要求cache可裁剪）。
+
+        模型自带make_cache时 make_prompt_cache 会忽略max_kv_size，这里把其中的
+        全长KVCache层换成滑动窗口（模型本身的滑动窗口层保持不变）。
+        """
+        cache = make_prompt_cache(model)
+        if not bounded or self.max_kv_size is None:
+            return cache
+        return [RotatingKVCache(max_size=self.max_kv_size, keep=4) if type(c) is KVCache else c for c in cache]
+
+    def quantize(self, cache: List[Any], n_tokens: int) -> List[Any]:
+        """长度达到起始位置时把全精度的层量化，返回新的cache列表"""
+        if self.kv_bits is None or n_tokens < self.quantized_kv_start:
+            return cache
+        if not any(type(c) is KVCache for c in cache):
+            return cache
+        cache = [
+            c.to_quantized(group_size=self.kv_group_size, bits=self.kv_bits) if type(c) is KVCache else c
+            for c in cache
+        ]
+        # 立即求值，原来的全精度数组随之释放
+        mx.eval([(c.keys, c.values) for c in cache if isinstance(c, QuantizedKVCache) and c.keys is not None])
+        return cache
+
+    @staticmethod
+    def dequantize(cache: List[Any]) -> List[Any]:
+        """把量化的层还原为全精度KVCache（加入连续批处理之前）"""
+        if not any(isinstance(c, QuantizedKVCache) for c in cache):
+            return cache
+        return [_dequantize(c) if isinstance(c, QuantizedKVCache) else c for c in cache]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_kv_size": self.max_kv_size,
+            "kv_bits": self.kv_bits,
+            "quantized_kv_start": self.quantized_kv_start if self.kv_bits else None,
+        }
+
+
+def _dequantize(c: QuantizedKVCache) -> KVCache:
+    kv = KVCache()
+    if c.keys is not None:
+        kv.keys, kv.values = (
+            mx.dequantize(*x, group_size=c.group_size, bits=c.bits)[..., :c.offset, :]
+            for x in (c.keys, c.values)
+        )
+    kv.offset = c.offset
+    return kv
+
+
+def kv_bytes_per_token(model) -> int:
+    """对一个token做一次前向，按cache的分配长度估算每个token的KV字节数"""
+    cache = make_prompt_cache(model)
+    model(mx.array([[0]]), cache=cache)
+    mx.eval([c.state for c in cache])
+    lengths = [c.keys.shape[2] for c in cache if isinstance(c, (KVCache, RotatingKVCache)) and c.keys is not None]
+    if not lengths:
+        return 0
+    return sum(c.nbytes for c in cache) // max(lengths)
@@ -0,0 +1,225 @@
+"""
+Prometheus文本格式的运行时指标（GET /metrics）
+
+不依赖prometheus_client：计数器、仪表和直方图都是带标签的简单累加。
+请求级指标（TTFT、token间延迟、端到端延迟、token数、prefill/decode速度）
+由引擎线程在输出token时更新；队列深度、活跃序列、cache命中和内存等状态
+在抓取时从各模型的引擎统计中采集。
+"""
+
+import bisect
+import math
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 直方图分桶（上界）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2)
+TOKEN_COUNT_BUCKETS = (16, 64, 256, 1024, 4096, 8192, 16384, 32768, 65536, 131072, 262144)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 200, 500, 1000, 2000, 5000)
+
+_metrics: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def clear(self):
+        """删除所有标签组合（例如模型被卸载后）"""
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += [line for key, value in items for line in self._samples(key, value)]
+        return lines
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """导出在别处维护的累计值（如 PrefixCache.hits），抓取时调用"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [每个分桶的计数..., 总和]
+                state = self._values[key] = [0] * len(self.buckets) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def _samples(self, key, state) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state):
+            cumulative += count
+            labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """所有指标的Prometheus文本格式"""
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+REQUEST_LABELS = ("endpoint", "model")
+
+# HTTP层
+HTTP_REQUESTS = Counter(
+    "mlx_http_requests_total", "HTTP requests by route and status code", ("endpoint", "status"))
+CLIENT_DISCONNECTS = Counter(
+    "mlx_client_disconnects_total", "Generations cancelled because the client went away", ("endpoint",))
+
+# 请求级（引擎线程更新）
+GENERATIONS = Counter(
+    "mlx_generations_total", "Finished sequences by finish reason",
+    REQUEST_LABELS + ("finish_reason",))
+TTFT = Histogram(
+    "mlx_time_to_first_token_seconds", "Time from submission to the first token, including queueing",
+    REQUEST_LABELS, LATENCY_BUCKETS)
+INTER_TOKEN_LATENCY = Histogram(
+    "mlx_inter_token_latency_seconds", "Time between consecutive tokens of a sequence",
+    REQUEST_LABELS, TOKEN_LATENCY_BUCKETS)
+REQUEST_DURATION = Histogram(
+    "mlx_request_duration_seconds", "End-to-end generation time of a request",
+    REQUEST_LABELS, LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram(
+    "mlx_request_prompt_tokens", "Prompt tokens per request", REQUEST_LABELS, TOKEN_COUNT_BUCKETS)
+CACHED_PROMPT_TOKENS = Counter(
+    "mlx_prompt_cached_tokens_total", "Prompt tokens served from the prefix cache", REQUEST_LABELS)
+COMPLETION_TOKENS = Histogram(
+    "mlx_request_completion_tokens", "Completion tokens per request (all n candidates)",
+    REQUEST_LABELS, TOKEN_COUNT_BUCKETS)
+PREFILL_TPS = Histogram(
+    "mlx_prefill_tokens_per_second", "Uncached prompt tokens per second until the first token",
+    REQUEST_LABELS, THROUGHPUT_BUCKETS)
+DECODE_TPS = Histogram(
+    "mlx_decode_tokens_per_second", "Completion tokens per second after the first token",
+    REQUEST_LABELS, THROUGHPUT_BUCKETS)
+DRAFT_PROPOSED = Counter(
+    "mlx_draft_tokens_proposed_total", "Speculative decoding: tokens proposed by the draft model",
+    REQUEST_LABELS)
+DRAFT_ACCEPTED = Counter(
+    "mlx_draft_tokens_accepted_total", "Speculative decoding: draft tokens accepted by the model",
+    REQUEST_LABELS)
+QUEUE_WAIT = Histogram(
+    "mlx_queue_wait_seconds", "Time a request waited for a concurrency slot, by priority class",
+    ("model", "priority"), LATENCY_BUCKETS)
+RESPONSE_CACHE_LOOKUPS = Counter(
+    "mlx_response_cache_lookups_total", "temperature=0 response cache lookups by result (hit/miss)",
+    REQUEST_LABELS + ("result",))
+
+# 抓取时采集（按模型）
+QUEUE_DEPTH = Gauge("mlx_queue_depth", "Requests waiting for a concurrency slot", ("model",))
+QUEUED_TOKENS = Gauge("mlx_queued_prompt_tokens", "Prompt tokens of queued requests", ("model",))
+ACTIVE_SEQUENCES = Gauge("mlx_active_sequences", "Sequences currently decoding", ("model",))
+MAX_CONCURRENT = Gauge("mlx_max_concurrent_sequences", "Concurrency limit", ("model",))
+REJECTED = Counter("mlx_rejected_requests_total", "Requests rejected with 429", ("model",))
+CACHE_HITS = Counter("mlx_prompt_cache_hits_total", "Prefix cache lookups that hit", ("model",))
+CACHE_MISSES = Counter("mlx_prompt_cache_misses_total", "Prefix cache lookups that missed", ("model",))
+CACHE_HIT_RATE = Gauge("mlx_prompt_cache_hit_rate", "Prefix cache hit rate since startup", ("model",))
+CACHE_BYTES = Gauge("mlx_prompt_cache_bytes", "Bytes held by the prefix cache", ("model",))
+WEIGHTS_BYTES = Gauge("mlx_model_weights_bytes", "Bytes of loaded model weights", ("model",))
+KV_CACHE_BYTES = Gauge("mlx_kv_cache_bytes", "KV cache bytes of sequences being generated", ("model",))
+KV_CACHE_BYTES_PER_SEQUENCE = Gauge(
+    "mlx_kv_cache_bytes_per_sequence", "Mean KV cache bytes per sequence being generated", ("model",))
+KV_BLOCKS_USED = Gauge("mlx_kv_blocks_used", "KV blocks referenced by at least one sequence", ("model",))
+KV_BLOCKS_TOTAL = Gauge("mlx_kv_blocks_total", "KV blocks in the block allocator", ("model",))
+KV_BLOCKS_SHARED = Gauge("mlx_kv_blocks_shared", "KV blocks shared by more than one sequence", ("model",))
+KV_BLOCK_FRAGMENTATION = Gauge(
+    "mlx_kv_block_fragmentation", "Fraction of token slots left empty in used KV blocks", ("model",))
+QUEUE_DEPTH_BY_PRIORITY = Gauge(
+    "mlx_queue_depth_by_priority", "Requests waiting for a concurrency slot, by priority class",
+    ("model", "priority"))
+TENANT_ACTIVE_SEQUENCES = Gauge(
+    "mlx_tenant_active_sequences", "Sequences currently decoding, by tenant", ("model", "tenant"))
+PER_MODEL = (QUEUE_DEPTH_BY_PRIORITY, TENANT_ACTIVE_SEQUENCES, QUEUE_DEPTH, QUEUED_TOKENS, ACTIVE_SEQUENCES, MAX_CONCURRENT, REJECTED,
+             CACHE_HITS, CACHE_MISSES, CACHE_HIT_RATE, CACHE_BYTES, WEIGHTS_BYTES, KV_CACHE_BYTES,
+             KV_CACHE_BYTES_PER_SEQUENCE, KV_BLOCKS_USED, KV_BLOCKS_TOTAL, KV_BLOCKS_SHARED, KV_BLOCK_FRAGMENTATION)
+
+# 抓取时采集（响应cache）
+RESPONSE_CACHE_ENTRIES = Gauge("mlx_response_cache_entries", "Responses held in memory by the response cache")
+RESPONSE_CACHE_BYTES = Gauge("mlx_response_cache_bytes", "Bytes held in memory by the response cache")
+RESPONSE_CACHE_DISK_BYTES = Gauge("mlx_response_cache_disk_bytes", "Bytes held on disk by the response cache")
+RESPONSE_STORE_ENTRIES = Gauge("mlx_response_store_entries", "Stored responses held in memory")
+RESPONSE_STORE_BYTES = Gauge("mlx_response_store_bytes", "Bytes of conversations and KV caches held in memory by the response store")
+RESPONSE_STORE_DISK_BYTES = Gauge("mlx_response_store_disk_bytes", "Bytes held on disk by the response store")
+
+# 抓取时采集（进程/系统）
+MODEL_LOADS = Counter("mlx_model_loads_total", "Models loaded by the registry")
+MODEL_EVICTIONS = Counter("mlx_model_evictions_total", "Models unloaded to stay within the memory budget")
+MEMORY_USED = Gauge("mlx_memory_used_bytes", "System memory in use")
+MEMORY_TOTAL = Gauge("mlx_memory_total_bytes", "Total system memory")
+MEMORY_BUDGET = Gauge("mlx_memory_budget_bytes", "Memory budget for loaded models")
+SWAP_USED = Gauge("mlx_swap_used_bytes", "Swap in use")
+PROCESS_RSS = Gauge("mlx_process_resident_memory_bytes", "Resident memory of the server process")
+MLX_ACTIVE_MEMORY = Gauge("mlx_active_memory_bytes", "Memory held by MLX arrays")
+MLX_PEAK_MEMORY = Gauge("mlx_peak_memory_bytes", "Peak memory held by MLX arrays")
@@ -0,0 +1,219 @@
+"""
+多模型注册表：按请求的 model 字段选择模型，首次使用时才加载
+
+每个已加载的模型拥有自己的生成引擎线程。加载新模型会使统一内存用量
+（get_memory_usage() 的 used_gb）超出预算时，先卸载最久未使用的空闲模型。
+"""
+
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import mlx.core as mx
+from mlx.utils import tree_flatten
+
+import tracing
+from admission import QueueFullError
+from engine import GenerationEngine
+from utils import get_memory_usage
+
+GB = 1024**3
+
+
+class ModelNotFoundError(Exception):
+    """请求的模型不在配置中 (HTTP 404)"""
+
+
+@dataclass
+class ModelSpec:
+    """一个可用模型的配置"""
+    name: str  # 请求中 model 字段使用的名称
+    path: str  # HuggingFace仓库名或本地路径
+    draft_path: Optional[str] = None  # 投机解码的draft模型
+
+
+@dataclass
+class LoadedModel:
+    """已加载的模型及其生成引擎"""
+    spec: ModelSpec
+    model: Any
+    tokenizer: Any
+    engine: GenerationEngine
+    nbytes: int
+    loaded_at: float
+    last_used: float = 0.0
+    pins: int = 0  # 正在使用该模型构建/提交请求的线程数
+    tool_format: Any = None  # 工具调用格式（tool_parser.ToolCallFormat），不支持时为None
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    @property
+    def idle(self) -> bool:
+        """没有排队、运行中或正在提交的请求，可以卸载"""
+        admission = self.engine.admission
+        return self.pins == 0 and admission.running == 0 and admission.queued == 0
+
+
+def model_nbytes(model) -> int:
+    """模型权重占用的字节数"""
+    return sum(v.nbytes for _, v in tree_flatten(model.parameters()))
+
+
+def estimate_nbytes(path: str) -> int:
+    """加载前估计模型大小：本地目录或HuggingFace缓存中权重文件的大小，未知时为0"""
+    local = Path(path)
+    if not local.exists():
+        try:
+            from huggingface_hub import snapshot_download
+            local = Path(snapshot_download(path, local_files_only=True, allow_patterns=["*.safetensors"]))
+        except Exception:
+            return 0
+    return sum(f.stat().st_size for f in local.glob("*.safetensors"))
+
+
+def parse_model_spec(value: str) -> ModelSpec:
+    """解析命令行中的模型配置：'名称=路径' 或 '路径'（名称即路径）"""
+    name, sep, path = value.partition("=")
+    if not sep:
+        return ModelSpec(name=value, path=value)
+    return ModelSpec(name=name, path=path)
+
+
+class ModelRegistry:
+    """
+    第一个spec是默认模型：请求未指定model，或只配置了一个模型时使用它。
+
+    use() 在with块内固定模型，保证提交请求前它不会被卸载；
+    提交之后请求已计入引擎的排队/运行数，同样不会被卸载。
+    """
+
+    def __init__(
+        self,
+        specs: List[ModelSpec],
+        loader: Callable[[ModelSpec], LoadedModel],
+        memory_budget_gb: float,
+    ):
+        self.specs: Dict[str, ModelSpec] = {s.name: s for s in specs}
+        self.default = specs[0].name
+        self.loader = loader
+        self.memory_budget_gb = memory_budget_gb
+
+        self._loaded: Dict[str, LoadedModel] = {}
+        self._lock = threading.Lock()  # 保护 _loaded 与 pins
+        self._load_lock = threading.Lock()  # 同一时间只加载一个模型
+        self._sizes: Dict[str, int] = {}  # 上次加载时测得的模型大小
+
+        # 统计
+        self.loads = 0
+        self.evictions = 0
+
+    def resolve(self, name: Optional[str]) -> ModelSpec:
+        """按名称（或路径）查找模型配置"""
+        if name in self.specs:
+            return self.specs[name]
+        for spec in self.specs.values():
+            if name == spec.path:
+                return spec
+        # 只有一个模型时兼容客户端随意填写的model字段
+        if not name or len(self.specs) == 1:
+            return self.specs[self.default]
+        raise ModelNotFoundError(
+            f"model '{name}' not found, available: {', '.join(self.specs)}"
+        )
+
+    @contextmanager
+    def use(self, name: Optional[str] = None) -> Iterator[LoadedModel]:
+        """取得模型（必要时先加载），with块内不会被卸载"""
+        entry = self._acquire(self.resolve(name))
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry.pins -= 1
+
+    def get_loaded(self, name: str) -> Optional[LoadedModel]:
+        with self._lock:
+            return self._loaded.get(name)
+
+    def loaded_models(self) -> List[LoadedModel]:
+        with self._lock:
+            return list(self._loaded.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            loaded = sorted(self._loaded.values(), key=lambda e: -e.last_used)
+            return {
+                "loaded": [e.name for e in loaded],
+                "loaded_gb": round(sum(e.nbytes for e in loaded) / GB, 2),
+                "used_gb": get_memory_usage()["used_gb"],
+                "memory_budget_gb": self.memory_budget_gb,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def _acquire(self, spec: ModelSpec) -> LoadedModel:
+        entry = self._pin(spec.name)
+        if entry is not None:
+            return entry
+
+        with self._load_lock:
+            # 等待加载锁期间可能已被其他请求加载
+            entry = self._pin(spec.name)
+            if entry is not None:
+                return entry
+
+            self._make_room(self._sizes.get(spec.name) or estimate_nbytes(spec.path))
+            with tracing.span("load_model", model=spec.name):
+                entry = self.loader(spec)
+            self._sizes[spec.name] = entry.nbytes
+            with self._lock:
+                entry.pins += 1
+                entry.last_used = time.time()
+                self._loaded[spec.name] = entry
+                self.loads += 1
+
+            # 实际占用可能超过估计，再检查一次
+            self._make_room(0, keep=spec.name)
+            return entry
+
+    def _pin(self, name: str) -> Optional[LoadedModel]:
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None:
+                entry.pins += 1
+                entry.last_used = time.time()
+            return entry
+
+    def _make_room(self, needed_bytes: int, keep: Optional[str] = None):
+        """按LRU卸载空闲模型，直到内存用量加上needed_bytes不超过预算"""
+        budget = self.memory_budget_gb * GB
+        while get_memory_usage()["used_gb"] * GB + needed_bytes > budget:
+            with self._lock:
+                others = [e for e in self._loaded.values() if e.name != keep]
+                idle = [e for e in others if e.idle]
+                if not idle:
+                    if others and keep is None:
+                        # 其他模型都在处理请求，稍后重试
+                        raise QueueFullError(
+                            "Server overloaded: not enough memory to load another model "
+                            "while the loaded models are busy",
+                            retry_after=10,
+                        )
+                    return
+                victim = min(idle, key=lambda e: e.last_used)
+                del self._loaded[victim.name]
+            self._unload(victim)
+
+    def _unload(self, entry: LoadedModel):
+        print(f"卸载模型 {entry.name} (约 {entry.nbytes / GB:.1f} GB，最近最少使用)")
+        entry.engine.stop()
+        entry.model = entry.tokenizer = entry.engine = None
+        gc.collect()
+        mx.clear_cache()
+        self.evictions += 1
@@ -0,0 +1,235 @@
+"""
+基于token前缀的KV cache复用（radix树 + LRU淘汰）
+
+Agent流量每一轮都会重发相同的system prompt和不断增长的历史消息。
+这里把已经计算过的KV cache按token序列存进一棵radix树，新请求只需要
+prefill与最长已缓存前缀不同的那一段后缀。
+"""
+
+import copy
+import itertools
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from mlx_lm.models.cache import can_trim_prompt_cache, trim_prompt_cache
+
+
+def cache_nbytes(cache: List[Any]) -> int:
+    """一个prompt cache（每层一个cache对象）占用的字节数"""
+    return sum(c.nbytes for c in cache)
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class _Node:
+    """radix树节点，edge是从父节点到本节点的token片段"""
+
+    __slots__ = ("edge", "children", "parent", "cache", "nbytes", "last_used")
+
+    def __init__(self, edge: Tuple[int, ...], parent: Optional["_Node"]):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}
+        self.cache: Optional[List[Any]] = None
+        self.nbytes = 0
+        self.last_used = 0
+
+
+class PrefixCache:
+    """
+    按token前缀索引的KV cache，超过内存预算时淘汰最久未使用的条目。
+
+    只在引擎线程内访问，不加锁。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._root = _Node((), None)
+        self._entries: Dict[int, _Node] = {}  # id(node) -> node
+        self._clock = itertools.count(1)
+
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.cached_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "cached_tokens": self.cached_tokens,
+        }
+
+    def fetch(self, tokens: Sequence[int]) -> Tuple[Optional[List[Any]], int]:
+        """
+        查找与tokens共享最长前缀的cache。
+
+        返回 (cache副本, 已缓存的token数)；调用方只需prefill tokens[n:]。
+        至少保留一个token给调用方处理，以便产生下一个token的logits。
+        """
+        path, matched, subtree = self._match(tokens)
+        limit = min(matched, len(tokens) - 1)
+
+        # 优先：可裁剪的更长条目，裁剪到limit即可完全复用公共前缀
+        longer = [(d, n) for d, n in path if d > limit]
+        if subtree is not None:
+            node = self._any_entry(subtree)
+            if node is not None:
+                longer.append((self._depth(node), node))
+        for depth, node in longer:
+            if can_trim_prompt_cache(node.cache):
+                cache = copy.deepcopy(node.cache)
+                trim_prompt_cache(cache, depth - limit)
+                return self._hit(node, cache, limit)
+
+        # 其次：路径上不超过limit的最深条目
+        for depth, node in reversed(path):
+            if depth <= limit:
+                return self._hit(node, copy.deepcopy(node.cache), depth)
+
+        self.misses += 1
+        return None, 0
+
+    def insert(self, tokens: Sequence[int], cache: List[Any]):
+        """存入tokens对应的cache（调用方不再修改该cache对象）"""
+        if not tokens:
+            return
+        node = self._node_for(tuple(tokens))
+        if node.cache is not None:
+            self._remove(node, prune=False)
+
+        node.cache = cache
+        node.nbytes = cache_nbytes(cache)
+        node.last_used = next(self._clock)
+        self._entries[id(node)] = node
+        self.nbytes += node.nbytes
+
+        # 可裁剪的cache包含了所有祖先条目的内容，祖先条目变得多余
+        if can_trim_prompt_cache(cache):
+            ancestor = node.parent
+            while ancestor is not None:
+                parent = ancestor.parent
+                if ancestor.cache is not None:
+                    self._remove(ancestor)
+                ancestor = parent
+
+        self.trim_to(self.max_bytes)
+
+    def trim_to(self, max_bytes: int):
+        """按LRU淘汰，直到总字节数不超过max_bytes"""
+        while self.nbytes > max_bytes and self._entries:
+            oldest = min(self._entries.values(), key=lambda n: n.last_used)
+            self._remove(oldest)
+
+    def clear(self):
+        self.trim_to(-1)
+
+    def _hit(self, node: _Node, cache: List[Any], n_tokens: int):
+        node.last_used = next(self._clock)
+        self.hits += 1
+        self.cached_tokens += n_tokens
+        return cache, n_tokens
+
+    def _match(self, tokens: Sequence[int]):
+        """
+        沿树匹配tokens。
+
+        返回 (路径上的条目 [(深度, 节点)], 公共前缀长度, 分叉处的子树)。
+        分叉处子树中的条目比公共前缀更长，可以裁剪后复用。
+        """
+        path = []
+        node = self._root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                return path, i, None
+            n = common_prefix_length(child.edge, tokens[i:])
+            if n < len(child.edge):
+                return path, i + n, child
+            i += n
+            node = child
+            if node.cache is not None:
+                path.append((i, node))
+        # tokens已全部匹配，更长的条目在node的子树中
+        subtree = next(iter(node.children.values()), None)
+        return path, i, subtree
+
+    def _any_entry(self, node: _Node) -> Optional[_Node]:
+        """子树中最近使用的条目"""
+        best = None
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if n.cache is not None and (best is None or n.last_used > best.last_used):
+                best = n
+            stack.extend(n.children.values())
+        return best
+
+    @staticmethod
+    def _depth(node: _Node) -> int:
+        depth = 0
+        while node is not None:
+            depth += len(node.edge)
+            node = node.parent
+        return depth
+
+    def _node_for(self, tokens: Tuple[int, ...]) -> _Node:
+        """找到或创建与tokens完全对应的节点（必要时分裂边）"""
+        node = self._root
+        i = 0
+        while i < len(tokens):
+            child = node.children.get(tokens[i])
+            if child is None:
+                new = _Node(tokens[i:], node)
+                node.children[tokens[i]] = new
+                return new
+            n = common_prefix_length(child.edge, tokens[i:])
+            if n < len(child.edge):
+                # 分裂: node -> mid -> child
+                mid = _Node(child.edge[:n], node)
+                node.children[tokens[i]] = mid
+                child.edge = child.edge[n:]
+                child.parent = mid
+                mid.children[child.edge[0]] = child
+                child = mid
+            i += n
+            node = child
+        return node
+
+    def _remove(self, node: _Node, prune: bool = True):
+        del self._entries[id(node)]
+        self.nbytes -= node.nbytes
+        node.cache = None
+        node.nbytes = 0
+        if prune:
+            self._prune(node)
+
+    def _prune(self, node: _Node):
+        """删除空叶子，并合并只剩一个子节点的空内部节点"""
+        while node is not self._root and node.cache is None:
+            parent = node.parent
+            if not node.children:
+                del parent.children[node.edge[0]]
+            elif len(node.children) == 1:
+                (child,) = node.children.values()
+                child.edge = node.edge + child.edge
+                child.parent = parent
+                parent.children[child.edge[0]] = child
+            else:
+                break
+            node = parent
@@ -0,0 +1,215 @@
+"""
+temperature=0 请求的响应cache
+
+greedy解码的输出只由模型、prompt token和采样参数决定。Agent和CI经常发送
+完全相同的请求，这里按这些输入的哈希保存生成结果（每个候选的完整文本、
+结束原因和token数），命中时不经过引擎，直接回放给任意端点（流式或非流式）。
+
+内存层按LRU淘汰并限制总字节数，条目超过TTL后失效；配置了目录时每个条目
+同时写入磁盘（一个JSON文件），重启后或被挤出内存后仍可命中。
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from engine import GenerationOutput, GenerationRequest, RequestHandle
+
+
+def cache_key(model: str, request: GenerationRequest) -> str:
+    """模型、prompt token与影响输出的采样参数的哈希"""
+    payload = json.dumps({
+        "model": model,
+        "prompt_tokens": request.prompt_tokens,
+        "max_tokens": request.max_tokens,
+        "stop": request.stop,
+        "stop_after": request.stop_after,
+        "n": request.n,
+        # 约束解码的schema哈希（JSONConstraint.key）
+        "constraint": getattr(request.logits_processor, "key", None),
+    })
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@dataclass
+class _Entry:
+    outputs: List[GenerationOutput]
+    nbytes: int
+    created: float  # time.time()，磁盘条目同样使用墙上时间
+
+
+def _entry_nbytes(outputs: Sequence[GenerationOutput]) -> int:
+    return sum(len(out.text.encode()) + 64 for out in outputs)
+
+
+class ResponseCache:
+    """线程安全：HTTP处理线程直接读写"""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float = 3600,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 1024**3,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.disk_bytes = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_bytes = sum(f.stat().st_size for f in self.disk_dir.glob("*.json"))
+
+        # 统计
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[GenerationOutput]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.outputs
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._insert(key, entry)
+            return entry.outputs
+
+    def put(self, key: str, outputs: Sequence[GenerationOutput]):
+        entry = _Entry(list(outputs), _entry_nbytes(outputs), time.time())
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._insert(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _insert(self, key: str, entry: _Entry):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        self.nbytes -= self._entries.pop(key).nbytes
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.json"
+
+    def _read_disk(self, key: str, now: float) -> Optional[_Entry]:
+        if self.disk_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            payload = path.read_text(encoding="utf-8")
+        except OSError:
+            return None
+        try:
+            data = json.loads(payload)
+            created = data["created"]
+            expired = now - created > self.ttl
+            outputs = [] if expired else [GenerationOutput(**out) for out in data["outputs"]]
+        except (ValueError, KeyError, TypeError):
+            # 写到一半的文件或其他程序的文件：当作未命中并删除
+            expired = True
+        if expired:
+            with self._lock:
+                self._remove_file(path)
+            return None
+        # 更新mtime，磁盘层超出上限时按mtime淘汰
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return _Entry(outputs, _entry_nbytes(outputs), created)
+
+    def _write_disk(self, key: str, entry: _Entry):
+        if self.disk_dir is None:
+            return
+        path = self._path(key)
+        payload = json.dumps({
+            "created": entry.created,
+            "outputs": [dataclasses.asdict(out) for out in entry.outputs],
+        }, ensure_ascii=False)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            tmp.write_text(payload, encoding="utf-8")
+            old = path.stat().st_size if path.exists() else 0
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self._lock:
+            self.disk_bytes += path.stat().st_size - old
+            if self.disk_bytes > self.disk_max_bytes:
+                self._prune_disk()
+
+    def _prune_disk(self):
+        """删除最久未访问的文件，直到磁盘层回到上限的90%"""
+        files = sorted(self.disk_dir.glob("*.json"), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                break
+            self._remove_file(f)
+
+    def _remove_file(self, path: Path):
+        """调用方须持有_lock"""
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        self.disk_bytes -= size
+
+
+class CachedHandle(RequestHandle):
+    """命中响应cache的请求句柄：输出已全部就绪，不经过引擎，也不计入引擎的延迟指标"""
+
+    def __init__(self, engine, request: GenerationRequest, outputs: Sequence[GenerationOutput], loop=None):
+        super().__init__(engine, request, loop)
+        self.cached_tokens = len(request.prompt_tokens)
+        self.started_at = self.first_token_at = self.finished_at = self.submitted_at
+        self._remaining = 0
+        for out in outputs:
+            self._deliver(out)
+
+    def cancel(self):
+        pass
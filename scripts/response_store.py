@@ -0,0 +1,356 @@
+"""
+/v1/responses 的有状态会话（store / previous_response_id）
+
+store=true 的响应保存两部分：
+- 对话记录：本轮完整的输入消息与模型输出，后续请求带 previous_response_id 时
+  拼在新输入之前，客户端不必重发整段历史
+- KV cache：本轮结束时的 (token, cache)，后续请求只需prefill与之不同的后缀
+  （通常就是新的输入消息），长会话每轮的prefill不再随历史长度增长
+
+两者都保存在内存中，按LRU限制总字节数；配置了目录时对话记录同时写入磁盘，
+被挤出内存的KV cache溢出到磁盘（safetensors），重启后仍可使用。条目超过TTL
+未被引用后失效。
+
+引擎线程只在内存中存取KV cache（put_cache/load_cache），不做磁盘读写：被挤出
+内存的cache交给后台线程写盘，写完之前仍可命中；只在磁盘上的cache由请求线程在
+提交前读入内存（preload_cache）。对话记录由HTTP处理线程读写。
+"""
+
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx_lm.models.cache import load_prompt_cache, save_prompt_cache
+
+from prompt_cache import cache_nbytes
+
+SWEEP_INTERVAL = 60  # 清理过期磁盘文件的最小间隔(秒)
+_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,128}")  # id会成为文件名，拒绝路径分隔符等字符
+
+
+@dataclass
+class StoredResponse:
+    """一个已保存的响应"""
+    id: str
+    messages: List[Dict[str, Any]]  # 完整对话：历史与本轮输入，加上本轮的assistant输出
+    body: Dict[str, Any]  # GET /v1/responses/{id} 返回的响应体
+    created: float  # time.time()
+
+
+@dataclass
+class _KV:
+    model: str  # 模型路径，KV只对同一模型有效
+    tokens: List[int]
+    cache: List[Any]
+
+
+@dataclass
+class _Entry:
+    record: Optional[StoredResponse] = None
+    kv: Optional[_KV] = None
+    record_bytes: int = 0
+    kv_bytes: int = 0
+    last_used: float = 0.0
+
+
+class ResponseStore:
+    """线程安全；KV cache的磁盘读写在后台写盘线程与调用preload_cache的请求线程"""
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float = 3600,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 8 * 1024**3,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.nbytes = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept_at = 0.0
+        self._spilling: Dict[str, _KV] = {}  # 已移出内存、等待写盘的KV cache
+        self._spill_queue: "queue.Queue[str]" = queue.Queue()
+
+        self.disk_bytes = 0
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_bytes = sum(f.stat().st_size for f in self.disk_dir.iterdir() if f.is_file())
+            threading.Thread(target=self._spill_writer, name="response-spill", daemon=True).start()
+
+        # 统计
+        self.kv_hits = 0
+        self.kv_disk_hits = 0
+        self.kv_misses = 0
+        self.spilled = 0
+
+    # 对话记录（HTTP处理线程）
+
+    def put(self, record: StoredResponse):
+        """保存对话记录；只有引擎线程按内存上限淘汰，记录很小，这里不淘汰"""
+        payload = json.dumps(asdict(record), ensure_ascii=False)
+        with self._lock:
+            self._set_record(record.id, record, len(payload.encode()))
+        if self.disk_dir is not None:
+            path, _ = self._paths(record.id)
+            self._write_file(path, lambda tmp: tmp.write_text(payload, encoding="utf-8"))
+
+    def get(self, response_id: str) -> Optional[StoredResponse]:
+        if not _ID_PATTERN.fullmatch(response_id):
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(response_id)
+            if entry is not None and now - entry.last_used > self.ttl:
+                self._drop(response_id)
+                entry = None
+            if entry is not None and entry.record is not None:
+                self._touch(response_id)
+                return entry.record
+        record, nbytes = self._read_record(response_id, now)
+        if record is not None:
+            with self._lock:
+                self._set_record(response_id, record, nbytes)
+        return record
+
+    def delete(self, response_id: str) -> bool:
+        if not _ID_PATTERN.fullmatch(response_id):
+            return False
+        with self._lock:
+            found = response_id in self._entries
+            if found:
+                self._drop(response_id)
+            found = self._spilling.pop(response_id, None) is not None or found
+            if self.disk_dir is not None:
+                for path in self._paths(response_id):
+                    found = self._remove_file(path) or found
+        return found
+
+    # KV cache
+
+    def put_cache(self, response_id: str, model: str, tokens: List[int], cache: List[Any]):
+        """请求结束时由引擎调用；调用方不再修改cache对象"""
+        # 在引擎线程求值：写盘线程不能求值引擎线程的stream上未完成的计算
+        mx.eval([c.state for c in cache])
+        with self._lock:
+            self._spilling.pop(response_id, None)
+            self._set_kv(response_id, _KV(model, tokens, cache))
+            self._evict()
+        self._sweep()
+
+    def preload_cache(self, response_id: str, model: str):
+        """
+        请求线程在提交前调用：KV cache只在磁盘上时读入内存，
+        使引擎线程的load_cache不必读盘
+        """
+        with self._lock:
+            entry = self._entries.get(response_id)
+            if (entry is not None and entry.kv is not None) or response_id in self._spilling:
+                return
+        kv = self._read_cache(response_id)
+        if kv is None or kv.model != model:
+            return
+        with self._lock:
+            entry = self._entries.get(response_id)
+            if (entry is not None and entry.kv is not None) or response_id in self._spilling:
+                return
+            self.kv_disk_hits += 1
+            self._set_kv(response_id, kv)
+            # 已经在磁盘上，即使马上被挤出也不必再写一次
+            self._evict(skip=response_id)
+
+    def load_cache(self, response_id: str, model: str) -> Optional[Tuple[List[int], List[Any]]]:
+        """
+        取得保存的 (tokens, cache)，调用方须复制后再使用；不在内存中（没有preload_cache）
+        或属于其他模型时返回None。由引擎线程调用，不读写磁盘。
+        """
+        with self._lock:
+            entry = self._entries.get(response_id)
+            kv = entry.kv if entry is not None else None
+            if kv is None:
+                # 正在等待写盘：放回内存，写盘线程会跳过它
+                kv = self._spilling.pop(response_id, None)
+                if kv is not None:
+                    self._set_kv(response_id, kv)
+                    self._evict()
+            if kv is None or kv.model != model:
+                self.kv_misses += 1
+                return None
+            self.kv_hits += 1
+            if response_id in self._entries:
+                self._touch(response_id)
+            return kv.tokens, kv.cache
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "kv_entries": sum(1 for e in self._entries.values() if e.kv is not None),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "disk_bytes": self.disk_bytes,
+                "kv_hits": self.kv_hits,
+                "kv_disk_hits": self.kv_disk_hits,
+                "kv_misses": self.kv_misses,
+                "spilled": self.spilled,
+            }
+
+    # 以下方法的调用方须持有_lock（文件读写除外）
+
+    def _touch(self, key: str):
+        """更新LRU顺序与最后使用时间"""
+        self._entries[key].last_used = time.time()
+        self._entries.move_to_end(key)
+
+    def _set_record(self, key: str, record: StoredResponse, nbytes: int):
+        entry = self._entries.setdefault(key, _Entry())
+        self.nbytes += nbytes - entry.record_bytes
+        entry.record, entry.record_bytes = record, nbytes
+        self._touch(key)
+
+    def _set_kv(self, key: str, kv: Optional[_KV]):
+        entry = self._entries.setdefault(key, _Entry())
+        nbytes = cache_nbytes(kv.cache) if kv is not None else 0
+        self.nbytes += nbytes - entry.kv_bytes
+        entry.kv, entry.kv_bytes = kv, nbytes
+        if kv is not None:
+            self._touch(key)
+
+    def _evict(self, skip: Optional[str] = None):
+        """
+        超出内存上限时先移出最久未使用的KV cache（配置了目录时交给写盘线程，
+        skip已在磁盘上不再写），对话记录很小，仍超出时才丢弃整个条目（配置了目录时
+        记录仍在磁盘上）。移出KV后没有对话记录的条目直接删除。
+        """
+        for key, entry in list(self._entries.items()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if entry.kv is None:
+                continue
+            if self.disk_dir is not None and key != skip:
+                self._spilling[key] = entry.kv
+                self._spill_queue.put(key)
+            self._set_kv(key, None)
+            if entry.record is None:
+                self._drop(key)
+        while self.nbytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry.record_bytes + entry.kv_bytes
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.disk_dir / f"{key}.json", self.disk_dir / f"{key}.safetensors"
+
+    def _read_record(self, key: str, now: float) -> Tuple[Optional[StoredResponse], int]:
+        if self.disk_dir is None:
+            return None, 0
+        path, _ = self._paths(key)
+        try:
+            if now - path.stat().st_mtime > self.ttl:
+                return None, 0
+            payload = path.read_text(encoding="utf-8")
+            record = StoredResponse(**json.loads(payload))
+            # mtime即最后使用时间，TTL与磁盘淘汰都按它计算
+            os.utime(path)
+        except (OSError, ValueError, TypeError):
+            return None, 0
+        return record, len(payload.encode())
+
+    def _spill_writer(self):
+        """后台写盘线程：依次写出被移出内存的KV cache"""
+        while True:
+            key = self._spill_queue.get()
+            with self._lock:
+                kv = self._spilling.get(key)
+            if kv is None:
+                continue  # 写盘前又被放回内存或被删除
+            self._write_cache(key, kv)
+            with self._lock:
+                if self._spilling.get(key) is kv:
+                    del self._spilling[key]
+
+    def _write_cache(self, key: str, kv: _KV):
+        _, path = self._paths(key)
+        metadata = {"model": kv.model, "tokens": json.dumps(kv.tokens)}
+        if self._write_file(path, lambda tmp: save_prompt_cache(str(tmp), kv.cache, metadata)):
+            with self._lock:
+                self.spilled += 1
+
+    def _read_cache(self, key: str) -> Optional[_KV]:
+        if self.disk_dir is None:
+            return None
+        _, path = self._paths(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            cache, metadata = load_prompt_cache(str(path), return_metadata=True)
+            # 在调用线程中完成读取，而不是等到引擎线程第一次使用时
+            mx.eval([c.state for c in cache])
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return _KV(metadata["model"], json.loads(metadata["tokens"]), cache)
+
+    def _write_file(self, path: Path, write) -> bool:
+        # safetensors要求.safetensors后缀，临时文件保留原后缀
+        tmp = path.with_name(f".{threading.get_ident()}.{path.name}")
+        try:
+            write(tmp)
+            old = path.stat().st_size if path.exists() else 0
+            os.replace(tmp, path)
+            size = path.stat().st_size
+        except OSError:
+            return False
+        with self._lock:
+            self.disk_bytes += size - old
+            if self.disk_bytes > self.disk_max_bytes:
+                self._prune_disk()
+        return True
+
+    def _sweep(self):
+        """删除过期的内存条目与磁盘文件（至多每SWEEP_INTERVAL秒一次）"""
+        now = time.time()
+        if now - self._swept_at < min(SWEEP_INTERVAL, self.ttl):
+            return
+        self._swept_at = now
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if now - e.last_used > self.ttl]:
+                self._drop(key)
+            if self.disk_dir is not None:
+                for path in list(self.disk_dir.iterdir()):
+                    try:
+                        expired = now - path.stat().st_mtime > self.ttl
+                    except OSError:
+                        continue
+                    if expired:
+                        self._remove_file(path)
+
+    def _prune_disk(self):
+        """删除最久未使用的文件，直到磁盘层回到上限的90%。调用方须持有_lock"""
+        files = sorted((f for f in self.disk_dir.iterdir() if f.is_file()), key=lambda f: f.stat().st_mtime)
+        for f in files:
+            if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                break
+            self._remove_file(f)
+
+    def _remove_file(self, path: Path) -> bool:
+        """调用方须持有_lock"""
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return False
+        self.disk_bytes -= size
+        return True
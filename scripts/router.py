@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+"""
+多副本请求路由（前缀感知的一致性哈希）
+
+在N个 api_server.py 副本（或多台Mac）之前运行，把OpenAI兼容的请求转发给其中之一：
+
+- 路由键是对话的前缀（system与第一条user消息、或prompt的开头），按一致性哈希映射
+  到副本，同一会话的后续轮次落在已持有其前缀KV cache的副本上；增删副本时只有
+  约1/N的键改变去向
+- 有界负载：哈希选中的副本负载超过平均值的 --load-factor 倍时顺延到环上的下一个
+  副本，热点前缀不会压垮单个副本
+- 每个副本维护keep-alive连接池，后台定期请求 /health 获取健康状态与队列深度
+- 连接失败或副本返回429/503时（尚未向客户端发送任何数据）自动转给下一个候选
+- /v1/responses 与 /v1/batches 返回的id记住所在副本，previous_response_id 续接与
+  按id查询都回到该副本（会话记录与批处理任务只在那里）
+- 流式响应（SSE）按块原样转发
+
+只使用标准库（ThreadingHTTPServer + http.client）。本地测试可用 --stub-backends
+启动若干个模拟副本：
+
+    python scripts/router.py --replicas http://127.0.0.1:8001 http://127.0.0.1:8002 --port 8000
+    python scripts/router.py --stub-backends 3 --port 8000
+"""
+
+import argparse
+import bisect
+import hashlib
+import http.client
+import json
+import math
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import metrics
+
+# 逐跳首部，不转发
+HOP_HEADERS = frozenset((
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "content-length", "host",
+))
+# 转发响应时不复制的首部：BaseHTTPRequestHandler.send_response已经写了Server和Date
+RELAY_SKIP_HEADERS = HOP_HEADERS | {"server", "date"}
+RETRY_STATUSES = (429, 503)  # 副本饱和或不可用，换下一个候选
+MAX_AFFINITY = 100_000  # 记住所在副本的响应/批处理id数
+
+ROUTER_REQUESTS = metrics.Counter(
+    "mlx_router_requests_total", "Requests forwarded by the router", ("replica", "status"))
+ROUTER_FAILOVERS = metrics.Counter(
+    "mlx_router_failovers_total", "Requests retried on another replica", ("replica", "reason"))
+ROUTER_UPSTREAM_LATENCY = metrics.Histogram(
+    "mlx_router_upstream_latency_seconds", "Time until the replica returned response headers",
+    ("replica",), metrics.LATENCY_BUCKETS)
+ROUTER_REPLICA_HEALTHY = metrics.Gauge(
+    "mlx_router_replica_healthy", "Whether the replica passed its last health check", ("replica",))
+ROUTER_REPLICA_LOAD = metrics.Gauge(
+    "mlx_router_replica_load", "Requests in flight or queued on the replica", ("replica",))
+ROUTER_METRICS = (ROUTER_REQUESTS, ROUTER_FAILOVERS, ROUTER_UPSTREAM_LATENCY,
+                  ROUTER_REPLICA_HEALTHY, ROUTER_REPLICA_LOAD)
+
+
+class NoReplicaError(Exception):
+    """没有可用的副本 (HTTP 503)"""
+
+
+class Replica:
+    """一个后端副本：keep-alive连接池、健康状态与负载"""
+
+    def __init__(self, url: str, timeout: float = 600, max_idle: int = 16):
+        parts = urlsplit(url if "://" in url else f"http://{url}")
+        self.url = f"{parts.scheme}://{parts.netloc}"
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or (443 if self.https else 80)
+        self.timeout = timeout
+        self.healthy = True
+        self.in_flight = 0  # 本路由转发中的请求数
+        self.backend_load = 0  # 副本/health报告的运行中+排队请求数（含其他来源）
+        self.last_error: Optional[str] = None
+        self.checked_at = 0.0
+        self._idle: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(max_idle)
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.url
+
+    @property
+    def load(self) -> int:
+        return max(self.in_flight, self.backend_load)
+
+    def connect(self) -> http.client.HTTPConnection:
+        """取一个空闲连接，没有时新建"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            return cls(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn: http.client.HTTPConnection, response: Optional[http.client.HTTPResponse]):
+        """响应已读完且连接可复用时放回连接池，否则关闭"""
+        if response is None or response.will_close or not response.isclosed():
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]
+                ) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """发送请求并等待响应头；复用的连接已被副本关闭时用新连接重试一次"""
+        for attempt in range(2):
+            conn = self.connect()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                if not reused or attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+        raise AssertionError("unreachable")
+
+    def get_json(self, path: str, timeout: float) -> Tuple[int, Any]:
+        """健康检查等小请求，使用独立的短超时连接"""
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=timeout)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            payload = response.read()
+            return response.status, json.loads(payload) if payload else None
+        finally:
+            conn.close()
+
+    def add_in_flight(self, delta: int):
+        with self._lock:
+            self.in_flight += delta
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "backend_load": self.backend_load,
+            "idle_connections": self._idle.qsize(),
+            "last_error": self.last_error,
+        }
+
+
+class HashRing:
+    """一致性哈希环：每个副本放置vnodes个虚拟节点"""
+
+    def __init__(self, names: List[str], vnodes: int = 64):
+        points = sorted(
+            (_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes)
+        )
+        self._hashes = [h for h, _ in points]
+        self._names = [name for _, name in points]
+        self._count = len(set(names))
+
+    def walk(self, key: str) -> List[str]:
+        """从key的位置顺时针经过的各个副本（不重复），第一个即哈希选中的副本"""
+        if not self._hashes:
+            return []
+        start = bisect.bisect(self._hashes, _hash(key))
+        order: List[str] = []
+        for i in range(len(self._names)):
+            name = self._names[(start + i) % len(self._names)]
+            if name not in order:
+                order.append(name)
+                if len(order) == self._count:
+                    break
+        return order
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def prefix_key(path: str, data: Any, prefix_chars: int = 2048) -> Optional[str]:
+    """
+    请求的路由键：模型名加上对话前缀。
+
+    chat/responses取到第一条user消息为止（system prompt与首轮提问），会话后续轮次的
+    键不变；completions取prompt的前prefix_chars个字符。无法确定时返回None（按负载选择）。
+    """
+    if not isinstance(data, dict):
+        return None
+    model = str(data.get("model") or "")
+    prefix: Any = None
+    if path.startswith("/v1/completions"):
+        prompt = data.get("prompt")
+        prefix = prompt if isinstance(prompt, str) else json.dumps(prompt)
+    else:
+        messages = data.get("messages", data.get("input"))
+        if isinstance(messages, str):
+            prefix = messages
+        elif isinstance(messages, list):
+            head = []
+            for message in messages:
+                head.append(message)
+                if isinstance(message, dict) and message.get("role") == "user":
+                    break
+            prefix = json.dumps(head, sort_keys=True, ensure_ascii=False)
+    if not prefix:
+        return None
+    return f"{model}\n{prefix[:prefix_chars]}"
+
+
+class ReplicaPool:
+    """
+    副本集合：一致性哈希选择、有界负载、健康检查、id亲和与失败转移。
+
+    线程安全；router与gateway的HTTP处理线程共用。
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        vnodes: int = 64,
+        load_factor: float = 1.25,
+        timeout: float = 600,
+        max_idle: int = 16,
+        health_path: str = "/health",
+    ):
+        if not urls:
+            raise ValueError("at least one replica is required")
+        self.replicas: Dict[str, Replica] = {}
+        for url in urls:
+            replica = Replica(url, timeout, max_idle)
+            self.replicas[replica.name] = replica
+        self.ring = HashRing(list(self.replicas), vnodes)
+        self.load_factor = load_factor
+        self.health_path = health_path
+        self._affinity: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # 选择
+
+    def candidates(self, key: Optional[str] = None, affinity: Optional[str] = None) -> List[Replica]:
+        """
+        按优先顺序排列的候选副本：亲和副本、哈希选中且未过载的副本、环上其余副本；
+        不健康的副本放在最后（健康状态可能已过时，全部不健康时仍然尝试）。
+        """
+        if key is None:
+            order = sorted(self.replicas.values(), key=lambda r: r.load)
+        else:
+            order = [self.replicas[name] for name in self.ring.walk(key)]
+            # 有界负载：负载超过平均值load_factor倍的副本让给后面的副本；
+            # 多留一个请求的余量，低负载时（平均值不到1）会话不会因为一个在途请求而换副本
+            healthy = [r for r in order if r.healthy]
+            if healthy:
+                bound = math.ceil((sum(r.load for r in healthy) + 1) / len(healthy) * self.load_factor) + 1
+                order = [r for r in order if r.load < bound] + [r for r in order if r.load >= bound]
+        if affinity is not None:
+            pinned = self.lookup_affinity(affinity)
+            if pinned is not None:
+                order = [pinned] + [r for r in order if r is not pinned]
+        return [r for r in order if r.healthy] + [r for r in order if not r.healthy]
+
+    def remember(self, object_id: str, replica: Replica):
+        """记住响应/批处理id所在的副本"""
+        with self._lock:
+            self._affinity[object_id] = replica.name
+            self._affinity.move_to_end(object_id)
+            while len(self._affinity) > MAX_AFFINITY:
+                self._affinity.popitem(last=False)
+
+    def lookup_affinity(self, object_id: str) -> Optional[Replica]:
+        with self._lock:
+            name = self._affinity.get(object_id)
+        return self.replicas.get(name) if name else None
+
+    # 转发
+
+    def forward(
+        self,
+        method: str,
+        path: str,
+        body: Optional[bytes],
+        headers: Dict[str, str],
+        key: Optional[str] = None,
+        affinity: Optional[str] = None,
+    ) -> Tuple[Replica, http.client.HTTPConnection, http.client.HTTPResponse]:
+        """
+        把请求发给第一个能响应的候选副本，返回 (副本, 连接, 响应)；调用方读完响应后
+        调用 finish()。连接失败或429/503时换下一个候选，都失败时返回最后一个响应，
+        或抛出NoReplicaError。
+        """
+        last: Optional[Tuple[Replica, http.client.HTTPConnection, http.client.HTTPResponse]] = None
+        errors = []
+        candidates = self.candidates(key, affinity)
+        for i, replica in enumerate(candidates):
+            replica.add_in_flight(1)
+            started = time.perf_counter()
+            try:
+                conn, response = replica.request(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                replica.add_in_flight(-1)
+                self._mark(replica, False, f"{type(e).__name__}: {e}")
+                ROUTER_FAILOVERS.inc(replica=replica.name, reason="connect")
+                errors.append(f"{replica.name}: {e}")
+                continue
+            ROUTER_UPSTREAM_LATENCY.observe(time.perf_counter() - started, replica=replica.name)
+            if response.status in RETRY_STATUSES and i + 1 < len(candidates):
+                ROUTER_FAILOVERS.inc(replica=replica.name, reason=str(response.status))
+                response.read()
+                self.finish(replica, conn, response)
+                continue
+            last = (replica, conn, response)
+            break
+        if last is None:
+            raise NoReplicaError("no replica available: " + "; ".join(errors or ["no replicas"]))
+        return last
+
+    def finish(self, replica: Replica, conn: http.client.HTTPConnection,
+               response: Optional[http.client.HTTPResponse]):
+        """请求结束：记录指标、归还连接"""
+        replica.add_in_flight(-1)
+        ROUTER_REQUESTS.inc(replica=replica.name, status=str(response.status) if response else "error")
+        replica.release(conn, response)
+
+    # 健康检查
+
+    def check(self, timeout: float = 2.0):
+        """请求每个副本的健康检查端点，更新健康状态与队列深度"""
+        for replica in list(self.replicas.values()):
+            try:
+                status, body = replica.get_json(self.health_path, timeout)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                self._mark(replica, False, f"{type(e).__name__}: {e}")
+                continue
+            if status != 200:
+                self._mark(replica, False, f"health check returned {status}")
+                continue
+            replica.backend_load = _backend_load(body)
+            self._mark(replica, True)
+
+    def start_health_checks(self, interval: float = 2.0) -> "ReplicaPool":
+        def run():
+            while not self._stop.is_set():
+                self.check(timeout=min(interval, 5.0))
+                self._stop.wait(interval)
+
+        self.check(timeout=min(interval, 5.0))
+        threading.Thread(target=run, name="replica-health", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _mark(self, replica: Replica, healthy: bool, error: Optional[str] = None):
+        replica.healthy = healthy
+        replica.checked_at = time.time()
+        if error is not None:
+            replica.last_error = error
+        ROUTER_REPLICA_HEALTHY.set(1 if healthy else 0, replica=replica.name)
+        ROUTER_REPLICA_LOAD.set(replica.load, replica=replica.name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            affinity = len(self._affinity)
+        return {
+            "replicas": [r.stats() for r in self.replicas.values()],
+            "healthy": sum(1 for r in self.replicas.values() if r.healthy),
+            "affinity_entries": affinity,
+        }
+
+
+def _backend_load(health: Any) -> int:
+    """api_server /health 中队列的运行中与排队请求数；其他后端没有时为0"""
+    queue_stats = health.get("queue") if isinstance(health, dict) else None
+    if not isinstance(queue_stats, dict):
+        return 0
+    return int(queue_stats.get("running", 0)) + int(queue_stats.get("queued", 0))
+
+
+def object_id(path: str, data: Any) -> Optional[str]:
+    """需要回到原副本的对象id：previous_response_id，或 /v1/responses/{id}、/v1/batches/{id}"""
+    if isinstance(data, dict) and data.get("previous_response_id"):
+        return str(data["previous_response_id"])
+    parts = path.split("?")[0].strip("/").split("/")
+    if len(parts) >= 3 and parts[0] == "v1" and parts[1] in ("responses", "batches"):
+        return parts[2]
+    return None
+
+
+def created_id(path: str, payload: bytes) -> Optional[str]:
+    """POST /v1/responses、/v1/batches 的JSON响应中新建对象的id"""
+    if path.split("?")[0].rstrip("/") not in ("/v1/responses", "/v1/batches"):
+        return None
+    try:
+        body = json.loads(payload)
+    except ValueError:
+        return None
+    return body.get("id") if isinstance(body, dict) and isinstance(body.get("id"), str) else None
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """
+    把请求转发给ReplicaPool选出的副本，响应头与响应体原样返回。
+
+    子类可以覆盖 dispatch() 改变副本集合的选择与转发的请求（见gateway.py）。
+    """
+
+    protocol_version = "HTTP/1.1"
+    server_version = "mlx-router"
+    pool: ReplicaPool  # 由make_server设置
+    prefix_chars = 2048
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Headers", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        if self.command == "GET" and self.path == "/health":
+            return self.send_json(200, self.health_body())
+        if self.command == "GET" and self.path == "/metrics":
+            return self.send_bytes(200, render_metrics().encode(), metrics.CONTENT_TYPE)
+
+        length = self.headers.get("Content-Length")
+        if self.headers.get("Transfer-Encoding") and length is None:
+            return self.send_json(411, {"error": "Content-Length required"})
+        body = self.rfile.read(int(length)) if length else None
+        data = None
+        if body:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return self.send_json(400, {"error": "invalid JSON body"})
+
+        # http.client按请求体重新计算Content-Length
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+        try:
+            pool, replica, conn, response = self.dispatch(body, data, headers)
+        except LookupError as e:
+            return self.send_json(404, {"error": str(e)})
+        except NoReplicaError as e:
+            return self.send_json(503, {"error": str(e)})
+        self.relay(pool, replica, conn, response)
+
+    def dispatch(self, body: Optional[bytes], data: Any, headers: Dict[str, str]
+                 ) -> Tuple[ReplicaPool, Replica, http.client.HTTPConnection, http.client.HTTPResponse]:
+        """
+        选择副本并转发请求，返回 (副本集合, 副本, 连接, 响应)。
+
+        子类覆盖以改变副本集合的选择与请求体（见gateway.py）；找不到目标时抛出LookupError(404)。
+        """
+        key = prefix_key(self.path, data, self.prefix_chars)
+        replica, conn, response = self.pool.forward(
+            self.command, self.path, body, headers, key, object_id(self.path, data))
+        return self.pool, replica, conn, response
+
+    def relay(self, pool: ReplicaPool, replica: Replica, conn: http.client.HTTPConnection,
+              response: http.client.HTTPResponse):
+        """把副本的响应转发给客户端；没有Content-Length的响应（SSE）按chunked逐块转发"""
+        finished = None
+        try:
+            self.send_response(response.status, response.reason)
+            for header, value in response.getheaders():
+                if header.lower() not in RELAY_SKIP_HEADERS:
+                    self.send_header(header, value)
+            self.send_header("X-Replica", replica.name)
+            length = response.getheader("Content-Length")
+            if length is not None:
+                payload = response.read()
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                created = created_id(self.path, payload) if self.command == "POST" else None
+                if created:
+                    pool.remember(created, replica)
+            else:
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in iter_chunks(response):
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            finished = response
+        except OSError:
+            # 客户端断开：关闭上游连接，副本据此取消生成
+            self.close_connection = True
+        finally:
+            pool.finish(replica, conn, finished)
+
+    def health_body(self) -> Dict[str, Any]:
+        stats = self.pool.stats()
+        return {"status": "ok" if stats["healthy"] else "degraded", **stats}
+
+    def send_json(self, status: int, body: Any):
+        self.send_bytes(status, json.dumps(body).encode(), "application/json")
+
+    def send_bytes(self, status: int, payload: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def iter_chunks(response: http.client.HTTPResponse, size: int = 65536) -> Iterator[bytes]:
+    """边到达边读取响应体（read1不等待凑满size）"""
+    while True:
+        chunk = response.read1(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def render_metrics() -> str:
+    """只输出路由器自己的指标"""
+    return "\n".join(line for metric in ROUTER_METRICS for line in metric.render()) + "\n"
+
+
+class ProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 默认的listen backlog(5)在突发连接时会拒绝连接
+
+
+def make_server(host: str, port: int, handler: type, **attributes) -> ProxyServer:
+    """创建多线程HTTP服务器，attributes设置到handler子类上（如pool）"""
+    handler = type(handler.__name__, (handler,), attributes)
+    return ProxyServer((host, port), handler)
+
+
+class StubBackend(BaseHTTPRequestHandler):
+    """
+    本地测试用的模拟副本：实现 /health、/v1/models、chat completions（含流式）、
+    completions与有状态的responses，回复内容标明处理请求的副本。
+    """
+
+    protocol_version = "HTTP/1.1"
+    name = "stub"
+    delay = 0.0  # 每个请求的模拟生成时间(秒)
+    fail_status = 0  # 非0时所有POST返回该状态码（模拟饱和或故障的副本）
+    running = 0
+    responses: set
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self.send_json({"status": "ok", "model": self.name,
+                                   "queue": {"running": type(self).running, "queued": 0}})
+        if self.path == "/v1/models":
+            return self.send_json({"object": "list", "data": [{"id": self.name, "object": "model"}]})
+        response_id = self.path.rsplit("/", 1)[-1]
+        if self.path.startswith("/v1/responses/") and response_id in self.responses:
+            return self.send_json({"id": response_id, "object": "response", "replica": self.name})
+        self.send_json({"error": f"{self.path} not found on {self.name}"}, 404)
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.fail_status:
+            return self.send_json({"error": f"{self.name} unavailable"}, self.fail_status)
+        type(self).running += 1
+        try:
+            time.sleep(self.delay)
+            if self.path == "/v1/responses":
+                previous = data.get("previous_response_id")
+                if previous and previous not in self.responses:
+                    return self.send_json({"error": f"previous response {previous} not found"}, 400)
+                response_id = f"resp_{uuid.uuid4().hex[:12]}"
+                self.responses.add(response_id)
+                return self.send_json({"id": response_id, "object": "response", "replica": self.name,
+                                       "model": data.get("model", self.name),
+                                       "output": [{"type": "message", "content": [
+                                           {"type": "output_text", "text": f"hello from {self.name}"}]}]})
+            if data.get("stream"):
+                return self.send_stream(data.get("model", self.name))
+            self.send_json({
+                "id": f"chatcmpl-{uuid.uuid4().hex[:8]}", "object": "chat.completion",
+                "model": data.get("model", self.name), "replica": self.name,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": f"hello from {self.name}"}}],
+            })
+        finally:
+            type(self).running -= 1
+
+    def send_stream(self, model: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for word in ("hello", " from", f" {self.name}"):
+            chunk = {"object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def send_json(self, body: Any, status: int = 200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_stub_backend(name: str, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0) -> ProxyServer:
+    """在后台线程启动一个模拟副本；server.RequestHandlerClass 上可调整 delay、fail_status"""
+    server = make_server(host, port, StubBackend, name=name, delay=delay, running=0, responses=set())
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return server
+
+
+def start_stub_backends(count: int, host: str = "127.0.0.1", port: int = 0, delay: float = 0.0) -> List[str]:
+    """在后台线程启动count个模拟副本（port为0时使用随机端口，否则从port开始依次递增），返回URL"""
+    urls = []
+    for i in range(count):
+        server = start_stub_backend(f"stub-{i}", host, port + i if port else 0, delay)
+        urls.append(f"http://{host}:{server.server_address[1]}")
+    return urls
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MLX 多副本请求路由（前缀一致性哈希）")
+    parser.add_argument("--replicas", nargs="*", default=[], help="副本地址，如 http://127.0.0.1:8001")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="监听地址 (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口 (default: 8000)")
+    parser.add_argument("--vnodes", type=int, default=64, help="每个副本在哈希环上的虚拟节点数 (default: 64)")
+    parser.add_argument("--load-factor", type=float, default=1.25,
+                        help="副本负载超过平均值的该倍数时顺延到下一个副本 (default: 1.25)")
+    parser.add_argument("--prefix-chars", type=int, default=2048,
+                        help="参与哈希的对话前缀字符数 (default: 2048)")
+    parser.add_argument("--health-interval", type=float, default=2.0, help="健康检查间隔(秒) (default: 2)")
+    parser.add_argument("--timeout", type=float, default=600, help="等待副本响应的超时(秒) (default: 600)")
+    parser.add_argument("--max-idle-connections", type=int, default=16,
+                        help="每个副本保留的keep-alive空闲连接数 (default: 16)")
+    parser.add_argument("--stub-backends", type=int, default=0,
+                        help="启动N个本地模拟副本并路由到它们（测试用）(default: 0)")
+    parser.add_argument("--stub-delay", type=float, default=0.0, help="模拟副本每个请求的耗时(秒) (default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    urls = list(args.replicas)
+    if args.stub_backends:
+        urls += start_stub_backends(args.stub_backends, args.host, args.port + 1, args.stub_delay)
+    if not urls:
+        sys.exit("至少需要一个副本（--replicas 或 --stub-backends）")
+
+    pool = ReplicaPool(urls, args.vnodes, args.load_factor, args.timeout, args.max_idle_connections)
+    pool.start_health_checks(args.health_interval)
+    server = make_server(args.host, args.port, ProxyHandler, pool=pool, prefix_chars=args.prefix_chars)
+
+    print(f"{'='*60}")
+    print(f"MLX 请求路由")
+    print(f"{'='*60}")
+    print(f"地址: http://{args.host}:{args.port}")
+    for replica in pool.replicas.values():
+        print(f"  • {replica.url} ({'健康' if replica.healthy else '不可用: ' + str(replica.last_error)})")
+    print(f"一致性哈希: 每副本 {args.vnodes} 个虚拟节点, 前缀 {args.prefix_chars} 字符, 负载上限 {args.load_factor:g}x 平均值")
+    print(f"健康检查: 每 {args.health_interval:g} 秒")
+    print(f"\n按 Ctrl+C 停止")
+    print(f"{'='*60}\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
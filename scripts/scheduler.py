@@ -0,0 +1,171 @@
+"""
+按优先级和租户的加权公平调度
+
+等待并发槽位的请求按 (优先级, 租户) 分成若干流，流内先到先服务，流之间用
+start-time fair queuing：每个请求的开始标签 S = max(虚拟时间, 该流上一个请求
+的结束标签)，结束标签 F = S + 代价 / 优先级权重，每次放行开始标签最小的请求。
+代价是请求的预估工作量（prompt token数 + n * max_tokens），所以交互请求不会被
+大批量任务的长prompt挤到队尾；同一优先级内各租户平分。
+
+每个租户还可以设置并发序列上限，达到上限的租户的请求留在队列中，
+不阻塞其他租户。只在引擎线程内访问，不加锁。
+"""
+
+import argparse
+import itertools
+from collections import deque
+from typing import Any, Callable, Dict, Optional, Tuple
+
+DEFAULT_PRIORITY = "interactive"
+DEFAULT_WEIGHTS = {"interactive": 8.0, "batch": 1.0}
+DEFAULT_TENANT = "default"
+
+
+class _Flow:
+    __slots__ = ("queue", "last_finish")
+
+    def __init__(self):
+        self.queue: deque = deque()  # (开始标签, 序号, handle)
+        self.last_finish = 0.0
+
+
+def _split_weight(value: str) -> Tuple[str, float]:
+    name, sep, weight = value.partition("=")
+    try:
+        parsed = float(weight) if sep and name else None
+    except ValueError:
+        parsed = None
+    # 权重为0时结束标签会除零，为负或inf时该优先级会一直排在最前
+    if parsed is None or not 0 < parsed < float("inf"):
+        raise ValueError(f"invalid priority weight {value!r}: expected name=weight with weight > 0")
+    return name, parsed
+
+
+def weight_arg(value: str) -> str:
+    """argparse的type：校验 '优先级=权重'，格式错误时由argparse报错退出"""
+    try:
+        _split_weight(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def parse_weights(values) -> Dict[str, float]:
+    """解析命令行中的 '优先级=权重' 列表"""
+    return dict(_split_weight(value) for value in values)
+
+
+def parse_tenant_caps(values) -> Tuple[int, Dict[str, int]]:
+    """解析命令行中的租户并发上限：'N'（每个租户的默认上限）或 '租户=N'"""
+    default, caps = 0, {}
+    for value in values:
+        name, sep, cap = value.partition("=")
+        if sep:
+            caps[name] = int(cap)
+        else:
+            default = int(name)
+    return default, caps
+
+
+class FairScheduler:
+    """
+    push() 加入等待队列，pop() 取出下一个可以开始的请求，
+    finish() 在请求的每个序列结束时调用，释放租户的并发计数。
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        tenant_max_concurrent: int = 0,
+        tenant_caps: Optional[Dict[str, int]] = None,
+    ):
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.tenant_max_concurrent = tenant_max_concurrent  # 0表示不限制
+        self.tenant_caps = dict(tenant_caps or {})
+        self._flows: Dict[Tuple[str, str], _Flow] = {}
+        self._running: Dict[str, int] = {}  # 租户 -> 运行中的序列数
+        self._vtime = 0.0
+        self._seq = itertools.count()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, handle):
+        req = handle.request
+        flow_key = (req.priority, req.tenant or DEFAULT_TENANT)
+        flow = self._flows.get(flow_key)
+        if flow is None:
+            flow = self._flows[flow_key] = _Flow()
+        cost = len(req.prompt_tokens) + req.n * req.max_tokens
+        start = max(self._vtime, flow.last_finish)
+        flow.last_finish = start + cost / self.weights.get(req.priority, 1.0)
+        flow.queue.append((start, next(self._seq), handle))
+        self._count += 1
+
+    def pop(self, can_start: Callable[[Any], bool]) -> Optional[Any]:
+        """
+        取出开始标签最小、且租户未达并发上限的请求。
+
+        全局并发槽位或KV块不足（can_start(request)返回False）时不跳过它去放行
+        更小的请求，避免n>1或长prompt的请求一直等不到足够的资源。
+        """
+        best = None
+        for key, flow in list(self._flows.items()):
+            if not flow.queue:
+                # 空闲且标签已落后于虚拟时间的流不再影响调度，删除以免租户越积越多
+                if flow.last_finish <= self._vtime:
+                    del self._flows[key]
+                continue
+            head = flow.queue[0]
+            req = head[2].request
+            if not self._tenant_has_room(req.tenant or DEFAULT_TENANT, req.n):
+                continue
+            if best is None or head[:2] < best.queue[0][:2]:
+                best = flow
+        if best is None or not can_start(best.queue[0][2].request):
+            return None
+
+        start, _, handle = best.queue.popleft()
+        self._count -= 1
+        self._vtime = max(self._vtime, start)
+        tenant = handle.request.tenant or DEFAULT_TENANT
+        self._running[tenant] = self._running.get(tenant, 0) + handle.request.n
+        return handle
+
+    def remove(self, handle) -> bool:
+        """从等待队列中移除（排队中被取消），返回是否找到"""
+        req = handle.request
+        flow = self._flows.get((req.priority, req.tenant or DEFAULT_TENANT))
+        if flow is None:
+            return False
+        for item in flow.queue:
+            if item[2] is handle:
+                flow.queue.remove(item)
+                self._count -= 1
+                return True
+        return False
+
+    def finish(self, handle):
+        """请求的一个序列结束"""
+        tenant = handle.request.tenant or DEFAULT_TENANT
+        running = self._running.get(tenant, 0) - 1
+        if running > 0:
+            self._running[tenant] = running
+        else:
+            self._running.pop(tenant, None)
+
+    def stats(self) -> Dict[str, Any]:
+        queued: Dict[str, int] = {}
+        for (priority, _), flow in list(self._flows.items()):
+            queued[priority] = queued.get(priority, 0) + len(flow.queue)
+        return {
+            "weights": self.weights,
+            "queued_by_priority": queued,
+            "running_by_tenant": dict(self._running),
+        }
+
+    def _tenant_has_room(self, tenant: str, n: int) -> bool:
+        cap = self.tenant_caps.get(tenant, self.tenant_max_concurrent)
+        # 上限小于n时仍允许单独运行，否则这个请求永远无法开始
+        return not cap or self._running.get(tenant, 0) + n <= cap or not self._running.get(tenant)
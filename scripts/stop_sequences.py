@@ -0,0 +1,53 @@
+"""
+stop序列匹配（OpenAI的 stop 参数）
+
+在反tokenize后的文本上做滚动后缀匹配：每次只检查上次暂存的尾部加上新文本，
+一旦出现任一stop字符串就截断并结束生成。可能是stop字符串开头的尾部文本会被
+暂存，确保stop字符串的任何部分都不会被流式发送给客户端。
+
+stop_after中的字符串同样结束生成，但本身保留在输出中（例如工具调用的结束标签）。
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+
+class StopSequenceMatcher:
+    """feed() 返回 (可以安全输出的文本, 是否遇到stop字符串)"""
+
+    def __init__(self, stops: Sequence[str], stop_after: Sequence[str] = ()):
+        self.stop_after: List[str] = [s for s in stop_after if s]
+        self.stops: List[str] = [s for s in stops if s] + self.stop_after
+        self._held = ""
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        window = self._held + text
+        hit = self._find(window)
+        if hit is not None:
+            self._held = ""
+            # stop_after的字符串保留在输出中
+            end = min((hit + len(s) for s in self.stop_after if window.startswith(s, hit)), default=hit)
+            return window[:end], True
+
+        keep = self._partial_length(window)
+        self._held = window[len(window) - keep:] if keep else ""
+        return window[:len(window) - keep], False
+
+    def flush(self) -> str:
+        """生成因其他原因结束时，输出暂存的尾部"""
+        text, self._held = self._held, ""
+        return text
+
+    def _find(self, window: str) -> Optional[int]:
+        """window中最早出现的stop字符串的位置"""
+        positions = [i for i in (window.find(s) for s in self.stops) if i >= 0]
+        return min(positions) if positions else None
+
+    def _partial_length(self, window: str) -> int:
+        """window末尾可能是某个stop字符串开头的最长长度"""
+        longest = 0
+        for stop in self.stops:
+            for n in range(min(len(stop) - 1, len(window)), longest, -1):
+                if window.endswith(stop[:n]):
+                    longest = n
+                    break
+        return longest
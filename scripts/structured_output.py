@@ -0,0 +1,680 @@
+"""
+response_format (json_object / json_schema) 的约束解码
+
+JSON schema编译为按字节前进的下推自动机：状态是一组栈（anyOf、数字或字面量
+何时结束等不确定性由多个栈并存表示），每个栈帧描述正在生成的对象、数组、
+字符串、数字或字面量。每一步只允许能让自动机继续前进的token：
+
+- 某个状态允许的token集合（mask）在第一次遇到时计算，之后按状态缓存。计算时
+  在按字节排序的token表上遍历，一个前缀被拒绝就跳过所有以它开头的token；
+  字符串内部先直接放行不含引号、反斜杠和控制字符的token，只逐个模拟其余的
+- 编译结果（自动机与已计算的mask）按 (模型, schema哈希) 放在LRU中，相同schema
+  的后续请求每个token只需一次状态转移和一次查表
+
+支持 type（含类型列表）、properties、required、additionalProperties、items、
+minItems/maxItems、enum、const、anyOf/oneOf、allOf（合并）、$ref（#/$defs、
+#/definitions、#）。pattern、format、数值范围、长度等其他关键字不做约束。
+空白只允许出现在JSON的结构位置，连续空白不超过 MAX_WHITESPACE 个字节。
+"""
+
+import bisect
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import mlx.core as mx
+import numpy as np
+from mlx_lm.tokenizer_utils import BPEStreamingDetokenizer, SPMStreamingDetokenizer
+
+MAX_WHITESPACE = 20  # 结构位置上连续空白字节的上限，避免模型陷入无限换行
+MAX_DIGITS = 16  # 整数/小数部分的位数上限（例如避免无限循环的0.3333…）
+MAX_EXPONENT_DIGITS = 3
+MAX_MASKS = 1024  # 每个编译后的schema缓存的mask数
+MAX_TRANSITIONS = 200_000  # 每个schema缓存的 (状态, 字节) 转移数，满了整体清空
+
+WHITESPACE = frozenset(b" \t\n\r")
+DIGITS = frozenset(b"0123456789")
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+ESCAPES = frozenset(b'"\\/bfnrt')
+END = ("END",)  # 栈底：顶层值已结束，只允许EOS
+
+State = FrozenSet[Tuple[tuple, ...]]
+
+
+class SchemaError(ValueError):
+    """schema无效或使用了无法约束的结构"""
+
+
+def response_format_schema(response_format: Any) -> Optional[Dict[str, Any]]:
+    """
+    把OpenAI的response_format（chat completions）或text.format（Responses API）
+    转换为JSON schema；type为text或未指定时返回None。
+    """
+    if response_format is None:
+        return None
+    if not isinstance(response_format, dict):
+        raise SchemaError("response_format must be an object")
+    kind = response_format.get("type", "text")
+    if kind == "text":
+        return None
+    if kind == "json_object":
+        return {"type": "object"}
+    if kind == "json_schema":
+        # chat completions: {"type": "json_schema", "json_schema": {"name", "schema", "strict"}}
+        # Responses API:    {"type": "json_schema", "name", "schema", "strict"}
+        spec = response_format.get("json_schema", response_format)
+        schema = spec.get("schema") if isinstance(spec, dict) else None
+        if not isinstance(schema, dict):
+            raise SchemaError("json_schema.schema must be an object")
+        return schema
+    raise SchemaError(f"unsupported response_format type {kind!r}")
+
+
+def schema_key(schema: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+
+def _gpt2_byte_decoder() -> Dict[str, int]:
+    """GPT-2字节级BPE：把token字符串中的可见字符映射回原始字节"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1))
+    printable += list(range(ord("®"), ord("ÿ") + 1))
+    decoder = {chr(b): b for b in printable}
+    n = 0
+    for b in range(256):
+        if b not in printable:
+            decoder[chr(256 + n)] = b
+            n += 1
+    return decoder
+
+
+def token_bytes(tokenizer) -> List[bytes]:
+    """每个token id解码后的原始字节（与流式detokenizer一致）"""
+    detokenizer = tokenizer.detokenizer
+    if isinstance(detokenizer, BPEStreamingDetokenizer):
+        decoder = _gpt2_byte_decoder()
+        return [
+            bytes(decoder[c] for c in token) if all(c in decoder for c in token) else token.encode("utf-8")
+            for token in detokenizer.tokenmap
+        ]
+    if isinstance(detokenizer, SPMStreamingDetokenizer):
+        return [t.replace("▁".encode("utf-8"), b" ") for t in detokenizer.tokenmap]
+    return [tokenizer.decode([i]).encode("utf-8") for i in range(len(tokenizer))]
+
+
+class TokenVocab:
+    """一个tokenizer的token字节表，按字节排序以便按前缀剪枝（构建一次，所有schema共用）"""
+
+    def __init__(self, tokenizer):
+        self.token_bytes = token_bytes(tokenizer)
+        self.size = len(self.token_bytes)
+        self.eos_ids = sorted(i for i in tokenizer.eos_token_ids if i < self.size)
+        # 特殊token（含<think>、工具调用标记等added token）不参与约束解码
+        excluded = set(tokenizer.all_special_ids) | set(getattr(tokenizer, "added_tokens_decoder", None) or ())
+        entries = sorted((b, i) for i, b in enumerate(self.token_bytes) if b and i not in excluded)
+        self.keys = [b for b, _ in entries]
+        self.ids = [i for _, i in entries]
+
+        # 字符串内部：不含引号、反斜杠和控制字符的token总是允许，其余的逐个模拟
+        special = [(b, i) for b, i in entries if any(c == 0x22 or c == 0x5C or c < 0x20 for c in b)]
+        self.string_keys = [b for b, _ in special]
+        self.string_ids = [i for _, i in special]
+        special_ids = set(self.string_ids)
+        self.string_plain = np.zeros(self.size, dtype=bool)
+        self.string_plain[[i for i in self.ids if i not in special_ids]] = True
+
+
+class JSONGrammar:
+    """
+    一个schema编译后的自动机，以及按状态缓存的mask。
+
+    编译在HTTP处理线程完成；状态转移与mask只在引擎线程中使用。
+    """
+
+    def __init__(self, schema: Dict[str, Any], vocab: TokenVocab, key: str = ""):
+        self.vocab = vocab
+        self.key = key or schema_key(schema)
+        self._root_schema = schema
+        self._nodes: List[Optional[tuple]] = []
+        self._refs: Dict[str, int] = {}
+        self._any = self._compile_any()
+        root = self._compile(schema)
+        self.initial: State = frozenset([(END, ("V", root, 0))])
+        self._masks: "OrderedDict[State, np.ndarray]" = OrderedDict()
+        self._transitions: Dict[Tuple[State, int], State] = {}
+
+    # 编译
+
+    def _new(self, node: Optional[tuple] = None) -> int:
+        self._nodes.append(node)
+        return len(self._nodes) - 1
+
+    def _compile_any(self) -> int:
+        any_id = self._new()
+        obj = self._new(("object", {}, frozenset(), any_id))
+        arr = self._new(("array", any_id, 0, None))
+        string = self._new(("string",))
+        number = self._new(("number", False))
+        literal = self._new(("literal", (b"true", b"false", b"null")))
+        self._nodes[any_id] = ("anyof", (obj, arr, string, number, literal))
+        return any_id
+
+    def _compile(self, schema: Any, slot: Optional[int] = None) -> int:
+        node = self._compile_node(schema)
+        if slot is None:
+            return self._new(node) if isinstance(node, tuple) else node
+        self._nodes[slot] = node if isinstance(node, tuple) else ("anyof", (node,))
+        return slot
+
+    def _compile_node(self, schema: Any):
+        """返回节点元组，或已有节点的id"""
+        if schema is True or schema == {}:
+            return self._any
+        if not isinstance(schema, dict):
+            raise SchemaError(f"invalid schema: {schema!r}")
+        if "$ref" in schema:
+            return self._ref(schema["$ref"])
+        if "const" in schema:
+            return ("literal", (_literal(schema["const"]),))
+        if "enum" in schema:
+            if not schema["enum"]:
+                raise SchemaError("enum must not be empty")
+            return ("literal", tuple(_literal(v) for v in schema["enum"]))
+        for keyword in ("anyOf", "oneOf"):
+            if keyword in schema:
+                return ("anyof", tuple(self._compile(s) for s in schema[keyword]))
+        if "allOf" in schema:
+            merged = {k: v for k, v in schema.items() if k != "allOf"}
+            for part in schema["allOf"]:
+                merged = _merge(merged, self._resolve(part["$ref"]) if "$ref" in part else part)
+            return self._compile_node(merged)
+
+        kind = schema.get("type")
+        if kind is None:
+            if "properties" in schema or "additionalProperties" in schema:
+                kind = "object"
+            elif "items" in schema:
+                kind = "array"
+            else:
+                return self._any
+        if isinstance(kind, list):
+            return ("anyof", tuple(self._compile(dict(schema, type=k)) for k in kind))
+        if schema.get("nullable"):
+            rest = {k: v for k, v in schema.items() if k != "nullable"}
+            return ("anyof", (self._compile(rest), self._new(("literal", (b"null",)))))
+
+        if kind == "object":
+            props = {
+                json.dumps(name, ensure_ascii=False)[1:-1].encode("utf-8"): self._compile(sub)
+                for name, sub in (schema.get("properties") or {}).items()
+            }
+            required = frozenset(json.dumps(name, ensure_ascii=False)[1:-1].encode("utf-8")
+                                 for name in schema.get("required", ()))
+            missing = required - props.keys()
+            additional = schema.get("additionalProperties", True)
+            if additional is False:
+                if missing:
+                    raise SchemaError(f"required properties not defined: {sorted(k.decode() for k in missing)}")
+                additional_id = None
+            else:
+                additional_id = self._compile(additional)
+                # 必需但未声明的属性按additionalProperties的schema作为已声明属性处理，
+                # 否则它们只能走任意键的路径，不会记入seen，对象永远无法闭合
+                for name in missing:
+                    props[name] = additional_id
+            return ("object", props, required, additional_id)
+        if kind == "array":
+            items = self._compile(schema.get("items", True))
+            max_items = schema.get("maxItems")
+            if max_items is not None and schema.get("minItems", 0) > max_items:
+                raise SchemaError("minItems is greater than maxItems")
+            return ("array", items, schema.get("minItems", 0), max_items)
+        if kind == "string":
+            return ("string",)
+        if kind in ("number", "integer"):
+            return ("number", kind == "integer")
+        if kind == "boolean":
+            return ("literal", (b"true", b"false"))
+        if kind == "null":
+            return ("literal", (b"null",))
+        raise SchemaError(f"unsupported type {kind!r}")
+
+    def _ref(self, ref: str) -> int:
+        if ref not in self._refs:
+            self._refs[ref] = slot = self._new()
+            self._compile(self._resolve(ref), slot)
+        return self._refs[ref]
+
+    def _resolve(self, ref: str) -> Any:
+        if ref == "#":
+            return self._root_schema
+        if not ref.startswith("#/"):
+            raise SchemaError(f"only local $ref is supported: {ref!r}")
+        target: Any = self._root_schema
+        for part in ref[2:].split("/"):
+            part = part.replace("~1", "/").replace("~0", "~")
+            if not isinstance(target, dict) or part not in target:
+                raise SchemaError(f"unresolvable $ref {ref!r}")
+            target = target[part]
+        return target
+
+    # 状态转移
+
+    def advance(self, state: State, data: bytes) -> State:
+        for b in data:
+            if not state:
+                break
+            state = self._advance(state, b)
+        return state
+
+    def _advance(self, state: State, b: int) -> State:
+        key = (state, b)
+        nxt = self._transitions.get(key)
+        if nxt is None:
+            out = []
+            for stack in state:
+                out.extend(self._step(stack, b))
+            nxt = frozenset(out)
+            if len(self._transitions) >= MAX_TRANSITIONS:
+                self._transitions.clear()
+            self._transitions[key] = nxt
+        return nxt
+
+    def accepting(self, state: State) -> bool:
+        for stack in state:
+            if stack[-1] == END or (len(stack) == 2 and self._can_end(stack[-1])):
+                return True
+        return False
+
+    def _can_end(self, frame: tuple) -> bool:
+        if frame[0] == "N":
+            return frame[2][0] in ("0", "int", "frac", "exp")
+        if frame[0] == "L":
+            return frame[2] in self._nodes[frame[1]][1]
+        return False
+
+    def _step(self, stack: tuple, b: int) -> List[tuple]:
+        """一个栈读入一个字节后的所有可能的栈"""
+        frame = stack[-1]
+        rest = stack[:-1]
+        kind = frame[0]
+
+        if kind == "S":
+            esc = frame[1]
+            if esc == 0:
+                if b == 0x22:  # "
+                    return [rest]
+                if b == 0x5C:  # \
+                    return [rest + (("S", 1),)]
+                return [stack] if b >= 0x20 else []
+            if esc == 1:
+                if b in ESCAPES:
+                    return [rest + (("S", 0),)]
+                return [rest + (("S", 5),)] if b == 0x75 else []  # \u + 4个十六进制数字
+            return [rest + (("S", esc - 1 if esc > 2 else 0),)] if b in HEX_DIGITS else []
+
+        if kind == "V":
+            _, node, ws = frame
+            if b in WHITESPACE:
+                return [rest + (("V", node, ws + 1),)] if ws < MAX_WHITESPACE else []
+            return self._begin(node, b, rest)
+
+        if kind == "O":
+            return self._step_object(frame, b, rest)
+        if kind == "K":
+            return self._step_key(frame, b, rest)
+        if kind == "C":
+            _, node, seen, value, ws = frame
+            if b in WHITESPACE:
+                return [rest + (("C", node, seen, value, ws + 1),)] if ws < MAX_WHITESPACE else []
+            if b == 0x3A:  # :
+                return [rest + (("O", node, seen, "after", 0), ("V", value, 0))]
+            return []
+        if kind == "A":
+            return self._step_array(frame, b, rest)
+        if kind == "N":
+            return self._step_number(frame, b, rest)
+        if kind == "L":
+            _, node, prefix = frame
+            candidates = self._nodes[node][1]
+            extended = prefix + bytes([b])
+            out = []
+            if any(c.startswith(extended) for c in candidates):
+                out.append(rest + (("L", node, extended),))
+            if prefix in candidates:
+                out.extend(self._step(rest, b))
+            return out
+        return []  # END
+
+    def _begin(self, node_id: int, b: int, rest: tuple, depth: int = 0) -> List[tuple]:
+        """以字节b开始一个node的值"""
+        node = self._nodes[node_id]
+        kind = node[0]
+        if kind == "anyof":
+            if depth > 32:  # 不消耗输入的递归（如 {"$ref": "#"}）
+                return []
+            out = []
+            for alt in node[1]:
+                out.extend(self._begin(alt, b, rest, depth + 1))
+            return out
+        if kind == "object":
+            return [rest + (("O", node_id, frozenset(), "start", 0),)] if b == 0x7B else []  # {
+        if kind == "array":
+            return [rest + (("A", node_id, 0, "start", 0),)] if b == 0x5B else []  # [
+        if kind == "string":
+            return [rest + (("S", 0),)] if b == 0x22 else []
+        if kind == "number":
+            if b == 0x2D:  # -
+                return [rest + (("N", node_id, ("-",)),)]
+            if b == 0x30:
+                return [rest + (("N", node_id, ("0",)),)]
+            if b in DIGITS:
+                return [rest + (("N", node_id, ("int", 1)),)]
+            return []
+        if kind == "literal":
+            first = bytes([b])
+            return [rest + (("L", node_id, first),)] if any(c.startswith(first) for c in node[1]) else []
+        return []
+
+    def _step_object(self, frame: tuple, b: int, rest: tuple) -> List[tuple]:
+        _, node_id, seen, phase, ws = frame
+        _, props, required, additional = self._nodes[node_id]
+        if b in WHITESPACE:
+            return [rest + (("O", node_id, seen, phase, ws + 1),)] if ws < MAX_WHITESPACE else []
+        if b == 0x7D:  # }
+            return [rest] if phase in ("start", "after") and required <= seen else []
+        if phase == "after":
+            if b == 0x2C and (additional is not None or len(seen) < len(props)):  # ,
+                return [rest + (("O", node_id, seen, "next", 0),)]
+            return []
+        if b == 0x22:  # 开始一个键
+            return [rest + (("K", node_id, seen, b""),)]
+        return []
+
+    def _step_key(self, frame: tuple, b: int, rest: tuple) -> List[tuple]:
+        """K帧：正在输入键名；prefix为None表示已不可能是已声明的属性（任意键，esc同S帧）"""
+        _, node_id, seen, prefix = frame[:4]
+        _, props, _, additional = self._nodes[node_id]
+        if prefix is None:
+            esc = frame[4]
+            if esc == 0 and b == 0x22:
+                return [rest + (("C", node_id, seen, additional, 0),)]
+            return [rest + (("K", node_id, seen, None, s[0][1]),) for s in self._step((("S", esc),), b) if s]
+        if b == 0x22 and not _open_escape(prefix):
+            if prefix in props:
+                return [rest + (("C", node_id, seen | {prefix}, props[prefix], 0),)] if prefix not in seen else []
+            if additional is not None:
+                return [rest + (("C", node_id, seen, additional, 0),)]
+            return []
+        extended = prefix + bytes([b])
+        # 允许额外属性时已出现过的属性名也要跟踪：它们的前缀仍可能是新的任意键
+        names = props if additional is not None else [name for name in props if name not in seen]
+        out = []
+        if any(name.startswith(extended) for name in names):
+            out.append(rest + (("K", node_id, seen, extended),))
+        if additional is not None and not any(name.startswith(extended) for name in props):
+            # 不再可能是已声明的属性：转入任意键模式，只需跟踪转义状态
+            free = self.advance(frozenset([(("S", 0),)]), extended)
+            out.extend(rest + (("K", node_id, seen, None, s[0][1]),) for s in free if s)
+        return out
+
+    def _step_array(self, frame: tuple, b: int, rest: tuple) -> List[tuple]:
+        _, node_id, count, phase, ws = frame
+        _, items, min_items, max_items = self._nodes[node_id]
+        if b in WHITESPACE:
+            return [rest + (("A", node_id, count, phase, ws + 1),)] if ws < MAX_WHITESPACE else []
+        if phase == "after":
+            if b == 0x5D:  # ]
+                return [rest] if count >= min_items else []
+            if b == 0x2C and (max_items is None or count < max_items):
+                return [rest + (("A", node_id, count, "next", 0),)]
+            return []
+        if phase == "start" and b == 0x5D:
+            return [rest] if min_items <= 0 else []
+        if max_items is not None and count >= max_items:
+            return []
+        # 只有设置了minItems/maxItems时才计数，否则状态与元素个数无关
+        bounded = min_items or max_items is not None
+        parent = rest + (("A", node_id, count + 1 if bounded else 0, "after", 0),)
+        return self._begin(items, b, parent)
+
+    def _step_number(self, frame: tuple, b: int, rest: tuple) -> List[tuple]:
+        _, node_id, phase = frame
+        integer = self._nodes[node_id][1]
+        name = phase[0]
+        nxt = None
+        if name == "-":
+            nxt = ("0",) if b == 0x30 else ("int", 1) if b in DIGITS else None
+        elif name in ("0", "int"):
+            if name == "int" and b in DIGITS:
+                nxt = ("int", phase[1] + 1) if phase[1] < MAX_DIGITS else None
+            elif not integer and b == 0x2E:  # .
+                nxt = (".",)
+            elif not integer and b in (0x65, 0x45):  # e E
+                nxt = ("e",)
+        elif name == ".":
+            nxt = ("frac", 1) if b in DIGITS else None
+        elif name == "frac":
+            if b in DIGITS:
+                nxt = ("frac", phase[1] + 1) if phase[1] < MAX_DIGITS else None
+            elif b in (0x65, 0x45):
+                nxt = ("e",)
+        elif name == "e":
+            nxt = ("e+",) if b in (0x2B, 0x2D) else ("exp", 1) if b in DIGITS else None
+        elif name == "e+":
+            nxt = ("exp", 1) if b in DIGITS else None
+        elif name == "exp" and b in DIGITS and phase[1] < MAX_EXPONENT_DIGITS:
+            nxt = ("exp", phase[1] + 1)
+        if nxt is not None:
+            return [rest + (("N", node_id, nxt),)]
+        if name in ("0", "int", "frac", "exp"):
+            # 数字结束，这个字节属于外层
+            return self._step(rest, b)
+        return []
+
+    # mask
+
+    def mask(self, state: State) -> np.ndarray:
+        """状态允许的token（长度为词表大小的bool数组），按状态缓存"""
+        mask = self._masks.get(state)
+        if mask is not None:
+            self._masks.move_to_end(state)
+            return mask
+        mask = self._compute_mask(state)
+        self._masks[state] = mask
+        if len(self._masks) > MAX_MASKS:
+            self._masks.popitem(last=False)
+        return mask
+
+    def _compute_mask(self, state: State) -> np.ndarray:
+        vocab = self.vocab
+        if state and all(self._accepts_plain(stack[-1]) for stack in state):
+            allowed = vocab.string_plain.copy()
+            keys, ids = vocab.string_keys, vocab.string_ids
+        else:
+            allowed = np.zeros(vocab.size, dtype=bool)
+            keys, ids = vocab.keys, vocab.ids
+        allowed[self._walk(state, keys, ids)] = True
+        if self.accepting(state):
+            allowed[vocab.eos_ids] = True
+        if not allowed.any():
+            # 无路可走（词表中没有需要的字节）：只能结束
+            allowed[vocab.eos_ids] = True
+        return allowed
+
+    def _accepts_plain(self, frame: tuple) -> bool:
+        """在字符串内容中、不在转义序列里：任何不含引号、反斜杠和控制字符的token都合法"""
+        if frame[0] == "S":
+            return frame[1] == 0
+        if frame[0] == "K":
+            if frame[3] is None:
+                return frame[4] == 0
+            # 跟踪已声明属性名的键：允许额外属性时不匹配的字节转入任意键
+            return self._nodes[frame[1]][3] is not None and not _open_escape(frame[3])
+        return False
+
+    def _walk(self, state: State, keys: Sequence[bytes], ids: Sequence[int]) -> List[int]:
+        """在排序的token表上按共享前缀推进状态，前缀被拒绝时跳过以它开头的所有token"""
+        allowed = []
+        states = [state]  # states[d]：读入当前前缀的前d个字节后的状态
+        prev = b""
+        i = 0
+        n = len(keys)
+        while i < n:
+            token = keys[i]
+            common = 0
+            limit = min(len(prev), len(token), len(states) - 1)
+            while common < limit and prev[common] == token[common]:
+                common += 1
+            del states[common + 1:]
+            for d in range(common, len(token)):
+                nxt = self._advance(states[d], token[d])
+                if not nxt:
+                    prefix = token[:d + 1]
+                    i = bisect.bisect_left(keys, _prefix_end(prefix), i + 1) if _prefix_end(prefix) else n
+                    prev = token[:d]
+                    break
+                states.append(nxt)
+            else:
+                allowed.append(ids[i])
+                prev = token
+                i += 1
+        return allowed
+
+
+class GrammarCache:
+    """按 (模型, schema哈希) 缓存编译后的自动机（含已计算的mask）的LRU，线程安全"""
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._grammars: "OrderedDict[Tuple[str, str], JSONGrammar]" = OrderedDict()
+        self._vocabs: Dict[str, TokenVocab] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model: str, tokenizer, schema: Dict[str, Any]) -> JSONGrammar:
+        key = (model, schema_key(schema))
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+                return grammar
+            self.misses += 1
+            vocab = self._vocabs.get(model)
+            if vocab is None:
+                vocab = self._vocabs[model] = TokenVocab(tokenizer)
+        grammar = JSONGrammar(schema, vocab, key[1])
+        with self._lock:
+            self._grammars[key] = grammar
+            while len(self._grammars) > self.max_entries:
+                self._grammars.popitem(last=False)
+        return grammar
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._grammars),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class JSONConstraint:
+    """
+    GenerationRequest.logits_processor：每个候选调用一次，得到独立的logits processor。
+
+    wait_for给出时（prompt以<think>结尾），推理内容不受约束，生成wait_for之后才开始约束。
+    """
+
+    def __init__(self, grammar: JSONGrammar, wait_for: Optional[str] = None):
+        self.grammar = grammar
+        self.key = grammar.key  # 响应cache键的一部分
+        self.wait_for = wait_for.encode("utf-8") if wait_for else None
+
+    def __call__(self) -> "JSONLogitsProcessor":
+        return JSONLogitsProcessor(self.grammar, self.wait_for)
+
+
+class JSONLogitsProcessor:
+    """按自动机状态屏蔽不合法的token；在引擎线程中每步调用一次"""
+
+    def __init__(self, grammar: JSONGrammar, wait_for: Optional[bytes] = None):
+        self.grammar = grammar
+        self.state = grammar.initial
+        self.waiting = wait_for
+        self._tail = b""  # 等待wait_for时已生成的字节
+        self._consumed: Optional[int] = None  # 已处理的上下文token数
+        self._mask: Optional[mx.array] = None
+        self._mask_state: Optional[State] = None
+
+    def __call__(self, tokens: mx.array, logits: mx.array) -> mx.array:
+        n = tokens.shape[0]
+        if self._consumed is None:
+            # 第一次调用时上下文只有prompt
+            self._consumed = n
+        elif n > self._consumed:
+            for token in tokens[self._consumed:].tolist():
+                self._feed(token)
+            self._consumed = n
+        if self.waiting is not None:
+            return logits
+        if self._mask is None or self._mask_state is not self.state:
+            allowed = self.grammar.mask(self.state)
+            if logits.shape[-1] > allowed.shape[0]:
+                # 模型的词表维度可能大于tokenizer（填充的embedding）
+                allowed = np.pad(allowed, (0, logits.shape[-1] - allowed.shape[0]))
+            self._mask = mx.array(allowed[: logits.shape[-1]])
+            self._mask_state = self.state
+        return mx.where(self._mask, logits, -mx.inf)
+
+    def _feed(self, token: int):
+        vocab = self.grammar.vocab
+        data = vocab.token_bytes[token] if token < vocab.size else b""
+        if self.waiting is not None:
+            self._tail += data
+            index = self._tail.find(self.waiting)
+            if index < 0:
+                self._tail = self._tail[-len(self.waiting):]
+                return
+            data = self._tail[index + len(self.waiting):]
+            self.waiting = None
+            self._tail = b""
+        if data:
+            self.state = self.grammar.advance(self.state, data)
+
+
+def _literal(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _merge(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """allOf：浅合并，properties与required取并集"""
+    merged = dict(a)
+    for key, value in b.items():
+        if key == "properties":
+            merged[key] = {**merged.get(key, {}), **value}
+        elif key == "required":
+            merged[key] = list(dict.fromkeys(list(merged.get(key, [])) + list(value)))
+        else:
+            merged[key] = value
+    return merged
+
+
+def _open_escape(prefix: bytes) -> bool:
+    """键名前缀是否停在转义序列中间（末尾是奇数个反斜杠）"""
+    count = len(prefix) - len(prefix.rstrip(b"\\"))
+    return count % 2 == 1
+
+
+def _prefix_end(prefix: bytes) -> Optional[bytes]:
+    """大于所有以prefix开头的字节串的最小字节串；不存在时返回None"""
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
@@ -27,7 +27,7 @@ def parse_args():
 def test_health(base_url):
     """测试健康检查"""
     print("\n" + "="*60)
-    print("测试 1/5: 健康检查")
+    print("测试 1/6: 健康检查")
     print("="*60)
 
     try:
@@ -59,7 +59,7 @@ def test_health(base_url):
 def test_models(base_url):
     """测试模型列表"""
     print("\n" + "="*60)
-    print("测试 2/5: 模型列表")
+    print("测试 2/6: 模型列表")
     print("="*60)
 
     try:
@@ -89,7 +89,7 @@ def test_models(base_url):
 def test_chat_simple(base_url):
     """测试简单对话"""
     print("\n" + "="*60)
-    print("测试 3/5: 简单对话")
+    print("测试 3/6: 简单对话")
     print("="*60)
 
     prompt = "你好"
@@ -141,7 +141,7 @@ def test_chat_simple(base_url):
 def test_chat_complex(base_url):
     """测试复杂对话"""
     print("\n" + "="*60)
-    print("测试 4/5: 复杂对话（代码生成）")
+    print("测试 4/6: 复杂对话（代码生成）")
     print("="*60)
 
     prompt = "写一个Python冒泡排序算法"
@@ -202,7 +202,7 @@ def test_chat_complex(base_url):
 def test_completions(base_url):
     """测试completions API"""
     print("\n" + "="*60)
-    print("测试 5/5: Completions API")
+    print("测试 5/6: Completions API")
     print("="*60)
 
     prompt = "人工智能的定义是："
@@ -238,6 +238,63 @@ def test_completions(base_url):
         return False
 
 
+def test_stream_cache(base_url):
+    """测试响应缓存：temperature=0 的流式请求未命中后，相同的非流式请求命中并返回完整的相同文本"""
+    print("\n" + "="*60)
+    print("测试 6/6: 流式响应写入缓存")
+    print("="*60)
+
+    health_url = base_url.replace("/v1", "") + "/health"
+    payload = {
+        # 时间戳保证第一次请求未命中
+        "messages": [{"role": "user", "content": f"用三句话介绍一下你自己 ({time.time():.6f})"}],
+        "max_tokens": 40,
+        "temperature": 0,
+    }
+
+    try:
+        if not (requests.get(health_url, timeout=5).json().get("response_cache")):
+            print(f"⚠ 服务器未启用响应缓存 (--response-cache-mb 0)，跳过")
+            return True
+
+        response = requests.post(f"{base_url}/chat/completions", json={**payload, "stream": True},
+                                 stream=True, timeout=60)
+        if response.status_code != 200:
+            print(f"✗ 流式请求失败: HTTP {response.status_code}")
+            return False
+        streamed = {"content": "", "reasoning_content": ""}
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            for choice in json.loads(line[6:]).get("choices", []):
+                for field in streamed:
+                    streamed[field] += choice.get("delta", {}).get(field) or ""
+
+        hits = requests.get(health_url, timeout=5).json()["response_cache"]["hits"]
+        response = requests.post(f"{base_url}/chat/completions", json=payload, timeout=60)
+        if response.status_code != 200:
+            print(f"✗ 非流式请求失败: HTTP {response.status_code}")
+            return False
+        message = response.json()["choices"][0]["message"]
+        cached = {field: message.get(field) or "" for field in streamed}
+        hit = requests.get(health_url, timeout=5).json()["response_cache"]["hits"] > hits
+
+        print(f"  流式回复: {streamed['content'][:100]!r}")
+        print(f"  缓存回复: {cached['content'][:100]!r}")
+        if not hit:
+            print(f"✗ 第二次请求未命中响应缓存")
+            return False
+        if cached != streamed:
+            print(f"✗ 缓存命中的文本与流式输出不一致")
+            return False
+        print(f"✓ 命中缓存且文本一致")
+        return True
+
+    except Exception as e:
+        print(f"✗ 错误: {e}")
+        return False
+
+
 def main():
     args = parse_args()
 
@@ -263,6 +320,7 @@ def main():
     results.append(("简单对话", test_chat_simple(args.base_url)))
     results.append(("复杂对话", test_chat_complex(args.base_url)))
     results.append(("Completions", test_completions(args.base_url)))
+    results.append(("流式响应缓存", test_stream_cache(args.base_url)))
 
     # 总结
     print("\n" + "="*60)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+测试多引擎网关（gateway.py）：模型名改写、字段过滤、后端间失败转移、id亲和与SSE转发
+
+使用本地模拟后端（router.StubBackend），不需要模型:
+    python scripts/test_gateway.py
+    python -m pytest scripts/test_gateway.py
+"""
+
+import http.client
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from gateway import ConfigError, GatewayHandler, build_gateway
+from router import make_server, start_stub_backend
+
+
+@contextmanager
+def gateway_with(statuses=None):
+    """
+    按configs/gateway.json的结构启动网关：mlx、lmstudio、llamacpp各一个模拟后端。
+    statuses指定后端固定返回的状态码。返回 (网关端口, {后端名: 地址}, {后端名: 模拟服务器})
+    """
+    stubs = {name: start_stub_backend(name) for name in ("mlx", "lmstudio", "llamacpp")}
+    urls = {name: f"http://127.0.0.1:{server.server_address[1]}" for name, server in stubs.items()}
+    for name, status in (statuses or {}).items():
+        stubs[name].RequestHandlerClass.fail_status = status
+    gateway = build_gateway({
+        "default_model": "minimax-m2",
+        "backends": {
+            "mlx": {"type": "mlx", "urls": [urls["mlx"]]},
+            "lmstudio": {"type": "lmstudio", "urls": [urls["lmstudio"]], "max_load": 4},
+            "llamacpp": {"type": "llamacpp", "urls": [urls["llamacpp"]], "max_load": 4},
+        },
+        "models": {
+            "minimax-m2": [{"backend": "mlx", "model": "minimax-m2"}],
+            "qwen3-coder": [
+                {"backend": "lmstudio", "model": "qwen3-coder-next"},
+                {"backend": "llamacpp", "model": "qwen3-coder"},
+            ],
+        },
+    }, timeout=10, max_idle=4)
+    server = make_server("127.0.0.1", 0, GatewayHandler, gateway=gateway, prefix_chars=2048)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield server.server_address[1], urls, stubs
+    finally:
+        for s in [server, *stubs.values()]:
+            s.shutdown()
+            s.server_close()
+
+
+def request(port, method, path, body=None):
+    """返回 (状态码, 响应头字典, 响应体)"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        conn.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def chat(model, content="hi", **fields):
+    return {"model": model, "messages": [{"role": "user", "content": content}], **fields}
+
+
+def test_model_rewrite():
+    """请求中的公开模型名改写为后端的上游模型名"""
+    with gateway_with() as (port, urls, _):
+        status, headers, payload = request(port, "POST", "/v1/chat/completions", chat("qwen3-coder"))
+        assert status == 200 and headers["X-Replica"] == urls["lmstudio"]
+        assert json.loads(payload)["model"] == "qwen3-coder-next"
+
+
+def test_default_model():
+    with gateway_with() as (port, urls, _):
+        status, headers, _ = request(port, "POST", "/v1/chat/completions",
+                                     {"messages": [{"role": "user", "content": "hi"}]})
+        assert status == 200 and headers["X-Replica"] == urls["mlx"]
+
+
+def test_unknown_model():
+    with gateway_with() as (port, _, _):
+        status, _, payload = request(port, "POST", "/v1/chat/completions", chat("nope"))
+        assert status == 404 and b"nope" in payload
+
+
+def test_drop_fields():
+    """只有api_server认识的字段发给其他引擎前去掉，发给MLX后端时保留"""
+    gateway = build_gateway({
+        "backends": {"mlx": {"type": "mlx", "url": "http://127.0.0.1:1"},
+                     "llamacpp": {"type": "llamacpp", "url": "http://127.0.0.1:2"}},
+        "models": {"m": ["mlx"]},
+    })
+    data = chat("m", priority="batch", tenant="t", mlx_trace=True, temperature=0)
+    body = json.dumps(data).encode()
+    sent = json.loads(gateway.backends["llamacpp"].prepare(body, data, "upstream"))
+    assert sent == chat("upstream", temperature=0)
+    # 无需改动时原样转发请求体
+    assert gateway.backends["mlx"].prepare(body, data, "m") is body
+    assert json.loads(gateway.backends["mlx"].prepare(body, data, "other"))["priority"] == "batch"
+
+
+def test_api_key_header():
+    gateway = build_gateway({
+        "backends": {"openai": {"type": "openai", "url": "http://127.0.0.1:1", "api_key": "secret"}},
+        "models": {"m": ["openai"]},
+    })
+    headers = gateway.backends["openai"].prepare_headers({"authorization": "Bearer client", "Accept": "*/*"})
+    assert headers == {"Accept": "*/*", "Authorization": "Bearer secret"}
+
+
+def test_failover_to_next_backend():
+    """第一个后端返回503/429时转给下一个后端，并改写为该后端的模型名"""
+    for status in (503, 429):
+        with gateway_with({"lmstudio": status}) as (port, urls, _):
+            code, headers, payload = request(port, "POST", "/v1/chat/completions", chat("qwen3-coder"))
+            assert code == 200 and headers["X-Replica"] == urls["llamacpp"]
+            assert json.loads(payload)["model"] == "qwen3-coder"
+
+
+def test_failover_when_backend_down():
+    """连接失败（第一个后端的端口没有监听）时同样转给下一个后端"""
+    stub = start_stub_backend("llamacpp")
+    try:
+        gateway = build_gateway({
+            "backends": {
+                "lmstudio": {"type": "lmstudio", "url": "http://127.0.0.1:1"},
+                "llamacpp": {"type": "llamacpp", "url": f"http://127.0.0.1:{stub.server_address[1]}"},
+            },
+            "models": {"qwen3-coder": [{"backend": "lmstudio", "model": "a"}, {"backend": "llamacpp", "model": "b"}]},
+        }, timeout=10)
+        server = make_server("127.0.0.1", 0, GatewayHandler, gateway=gateway, prefix_chars=2048)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            status, _, payload = request(server.server_address[1], "POST", "/v1/chat/completions",
+                                         chat("qwen3-coder"))
+            assert status == 200 and json.loads(payload)["model"] == "b"
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+
+def test_all_backends_saturated():
+    with gateway_with({"lmstudio": 503, "llamacpp": 429}) as (port, _, _):
+        status, _, _ = request(port, "POST", "/v1/chat/completions", chat("qwen3-coder"))
+        assert status == 429
+
+
+def test_previous_response_affinity():
+    """续接previous_response_id与按id查询时回到保存该响应的后端"""
+    with gateway_with({"lmstudio": 503}) as (port, urls, stubs):
+        # 首选后端饱和，会话保存在第二个后端上
+        status, headers, payload = request(port, "POST", "/v1/responses",
+                                           {"model": "qwen3-coder", "input": "first"})
+        assert status == 200 and headers["X-Replica"] == urls["llamacpp"]
+        response_id = json.loads(payload)["id"]
+        # 首选后端恢复后，续接的请求仍然回到保存会话的后端（模拟后端找不到会话时返回400）
+        stubs["lmstudio"].RequestHandlerClass.fail_status = 0
+        status, headers, _ = request(port, "POST", "/v1/responses",
+                                     {"model": "qwen3-coder", "input": "next", "previous_response_id": response_id})
+        assert status == 200 and headers["X-Replica"] == urls["llamacpp"]
+        # 没有model字段的请求按id找到后端
+        status, headers, _ = request(port, "GET", f"/v1/responses/{response_id}")
+        assert status == 200 and headers["X-Replica"] == urls["llamacpp"]
+
+
+def test_sse_passthrough():
+    with gateway_with() as (port, _, _):
+        status, headers, payload = request(port, "POST", "/v1/chat/completions",
+                                           chat("qwen3-coder", stream=True))
+        assert status == 200 and headers["Content-Type"] == "text/event-stream"
+        events = [line[len(b"data: "):] for line in payload.split(b"\n\n") if line.startswith(b"data: ")]
+        assert events[-1] == b"[DONE]"
+        assert all(json.loads(e)["model"] == "qwen3-coder-next" for e in events[:-1])
+
+
+def test_models_and_health():
+    with gateway_with({"lmstudio": 503}) as (port, _, _):
+        status, _, payload = request(port, "GET", "/v1/models")
+        assert status == 200
+        assert {m["id"] for m in json.loads(payload)["data"]} == {"minimax-m2", "qwen3-coder"}
+        status, _, payload = request(port, "GET", "/health")
+        assert status == 200 and set(json.loads(payload)["backends"]) == {"mlx", "lmstudio", "llamacpp"}
+
+
+def test_config_errors():
+    for config in (
+        {"backends": {}},
+        {"backends": {"a": {"type": "vllm", "url": "http://x"}}},
+        {"backends": {"a": {"type": "mlx"}}},
+        {"backends": {"a": {"type": "mlx", "url": "http://x"}}, "models": {"m": ["b"]}},
+        {"backends": {"a": {"type": "mlx", "url": "http://x"}}, "default_model": "m"},
+    ):
+        try:
+            build_gateway(config)
+        except ConfigError:
+            continue
+        raise AssertionError(f"config should be rejected: {config}")
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
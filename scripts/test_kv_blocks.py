@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+测试KV块分配器（kv_blocks.py）与引擎按块接纳请求
+
+分配器的测试不依赖MLX；引擎测试需要一个小模型，在CPU上运行:
+    python scripts/test_kv_blocks.py
+    python scripts/test_kv_blocks.py --model /path/to/tiny-model
+
+也可以用pytest运行（引擎测试读取环境变量 MLX_TEST_MODEL，未设置时跳过）。
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from kv_blocks import BlockAllocationError, BlockAllocator
+
+
+def test_allocate_free():
+    """prompt按块向上取整占用，释放后全部回到空闲列表"""
+    alloc = BlockAllocator(8, block_size=4, watermark=0)
+    alloc.allocate("a", list(range(10)))  # 2个满块 + 1个未满块
+    stats = alloc.stats()
+    assert alloc.block_table("a") == [0, 1, 2]
+    assert stats["used_blocks"] == 3 and stats["free_blocks"] == 5
+    assert stats["tokens"] == 10
+    assert stats["utilization"] == 0.375
+    # 12个槽位写入了10个token
+    assert stats["fragmentation"] == round(1 - 10 / 12, 4)
+
+    alloc.free("a")
+    stats = alloc.stats()
+    assert stats["used_blocks"] == 0 and stats["sequences"] == 0
+    assert stats["fragmentation"] == 0.0
+    alloc.free("a")  # 重复释放无副作用
+
+
+def test_append_grows_by_block():
+    alloc = BlockAllocator(3, block_size=4, watermark=0)
+    alloc.allocate("a", [1, 2, 3])
+    assert alloc.append("a", 4)  # 填满第一个块
+    assert alloc.stats()["used_blocks"] == 1
+    assert alloc.append("a", 5)  # 需要第二个块
+    assert alloc.stats()["used_blocks"] == 2
+    assert alloc.stats()["fragmentation"] == round(1 - 5 / 8, 4)
+
+
+def test_append_exhausted():
+    """没有空闲块时append失败且序列状态不变"""
+    alloc = BlockAllocator(1, block_size=2, watermark=0)
+    alloc.allocate("a", [1, 2])
+    assert not alloc.append("a", 3)
+    assert alloc.stats()["tokens"] == 2
+    assert alloc.stats()["exhausted"] == 1
+
+
+def test_allocate_exhausted():
+    alloc = BlockAllocator(2, block_size=4, watermark=0)
+    try:
+        alloc.allocate("a", list(range(9)))
+    except BlockAllocationError:
+        pass
+    else:
+        raise AssertionError("allocate should fail when blocks run out")
+    assert "a" not in alloc
+    assert alloc.free_blocks == 2
+
+
+def test_unshared_charges_full_blocks():
+    """share=False（引擎的用法）：相同前缀与fork都占用各自完整的块"""
+    alloc = BlockAllocator(16, block_size=4, watermark=0)
+    prompt = list(range(10))
+    alloc.allocate("a", prompt)
+    alloc.allocate("b", prompt)
+    assert alloc.stats()["used_blocks"] == 6
+    alloc.fork("a", "a1")
+    stats = alloc.stats()
+    assert stats["used_blocks"] == 9
+    assert stats["shared_blocks"] == 0 and stats["blocks_saved_by_sharing"] == 0
+    assert not set(alloc.block_table("a")) & set(alloc.block_table("a1"))
+    assert alloc.blocks_needed(10, n=3) == 9
+    assert not alloc.can_allocate(10, n=3)  # 剩余7块
+
+    for seq in ("a", "a1", "b"):
+        alloc.free(seq)
+    assert alloc.stats()["used_blocks"] == 0
+
+
+def test_unshared_fork_exhausted():
+    alloc = BlockAllocator(4, block_size=4, watermark=0)
+    alloc.allocate("a", list(range(10)))
+    try:
+        alloc.fork("a", "a1")
+    except BlockAllocationError:
+        pass
+    else:
+        raise AssertionError("fork should fail when blocks run out")
+    assert "a1" not in alloc and alloc.free_blocks == 1
+
+
+def test_shared_prefix_and_fork():
+    """share=True：满块按内容复用，fork共享全部块，未满块写时复制"""
+    alloc = BlockAllocator(16, block_size=4, watermark=0, share=True)
+    prompt = list(range(10))
+    alloc.allocate("a", prompt)
+    alloc.allocate("b", prompt[:8] + [99, 98])
+    stats = alloc.stats()
+    assert stats["used_blocks"] == 4  # 2个共享的满块 + 各自的未满块
+    assert stats["shared_hits"] == 2 and stats["shared_blocks"] == 2
+    assert stats["blocks_saved_by_sharing"] == 2
+
+    alloc.fork("a", "a1")
+    assert alloc.block_table("a1") == alloc.block_table("a")
+    assert alloc.stats()["used_blocks"] == 4
+    assert alloc.append("a1", 7)  # 共享的未满块：复制后写入
+    assert alloc.stats()["cow_copies"] == 1
+    assert alloc.block_table("a1")[:2] == alloc.block_table("a")[:2]
+    assert alloc.block_table("a1")[2] != alloc.block_table("a")[2]
+    assert alloc.blocks_needed(10, n=3) == 3
+
+    for seq in ("a", "a1", "b"):
+        alloc.free(seq)
+    stats = alloc.stats()
+    assert stats["used_blocks"] == 0 and stats["shared_blocks"] == 0
+
+
+def test_watermark():
+    alloc = BlockAllocator(100, block_size=4, watermark=0.1)
+    assert alloc.can_allocate(4 * 90)
+    assert not alloc.can_allocate(4 * 91)
+
+
+def test_engine_admission(model_path=None):
+    """引擎按 n×prompt块 接纳请求，结束后块全部释放（需要小模型，CPU）"""
+    model_path = model_path or os.environ.get("MLX_TEST_MODEL")
+    if not model_path:
+        try:
+            import pytest
+        except ImportError:
+            print("  跳过: 未指定模型 (--model 或 MLX_TEST_MODEL)")
+            return
+        pytest.skip("MLX_TEST_MODEL not set")
+
+    import mlx.core as mx
+    from mlx_lm import load
+
+    from admission import AdmissionController
+    from engine import GenerationEngine, GenerationRequest
+
+    mx.set_default_device(mx.cpu)
+    model, tokenizer = load(model_path)
+    alloc = BlockAllocator(7, block_size=16, watermark=0)
+    engine = GenerationEngine(
+        model, tokenizer, admission=AdmissionController(max_concurrent=4), block_allocator=alloc,
+    ).start()
+    try:
+        prompt = tokenizer.encode("hello " * 30)[:40]  # 3个块
+        try:
+            engine.submit(GenerationRequest(prompt, max_tokens=4, n=3))  # 9块 > 7块
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("n=3 should need more blocks than configured")
+
+        handle = engine.submit(GenerationRequest(prompt, max_tokens=4, n=2))  # 6块
+        outputs = list(handle)
+        assert {out.index for out in outputs} == {0, 1}
+        assert alloc.stats()["used_blocks"] == 0
+    finally:
+        engine.stop()
+
+
+def test_engine_sliding_window(model_path=None):
+    """--max-kv-size时每个序列最多按窗口记账：长prompt可以接纳，生成不会因块用尽提前结束"""
+    model_path = model_path or os.environ.get("MLX_TEST_MODEL")
+    if not model_path:
+        try:
+            import pytest
+        except ImportError:
+            print("  跳过: 未指定模型 (--model 或 MLX_TEST_MODEL)")
+            return
+        pytest.skip("MLX_TEST_MODEL not set")
+
+    import mlx.core as mx
+    from mlx_lm import load
+
+    from admission import AdmissionController
+    from engine import GenerationEngine, GenerationRequest
+    from kv_cache import KVCacheConfig
+
+    mx.set_default_device(mx.cpu)
+    model, tokenizer = load(model_path)
+    alloc = BlockAllocator(2, block_size=16, watermark=0)  # 32个token
+    engine = GenerationEngine(
+        model, tokenizer, admission=AdmissionController(max_concurrent=4), block_allocator=alloc,
+        kv_config=KVCacheConfig(max_kv_size=32),
+    ).start()
+    try:
+        prompt = tokenizer.encode("hello " * 30)[:40]  # 超过窗口
+        handle = engine.submit(GenerationRequest(prompt, max_tokens=16))
+        outputs = list(handle)
+        last = outputs[-1]
+        assert last.finish_reason == "stop" or last.generation_tokens == 16
+
+        handle = engine.submit(GenerationRequest(prompt[:20], max_tokens=30))  # 生成超过窗口
+        last = list(handle)[-1]
+        assert last.finish_reason == "stop" or last.generation_tokens == 30
+        assert alloc.stats()["exhausted"] == 0 and alloc.stats()["used_blocks"] == 0
+    finally:
+        engine.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="测试KV块分配器")
+    parser.add_argument("--model", type=str, default=None, help="引擎测试使用的小模型路径")
+    args = parser.parse_args()
+
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn(args.model) if name.startswith("test_engine_") else fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.stdout.flush()
+    # 引擎线程用过的MLX stream在解释器退出时析构会abort，直接退出以保留退出码
+    os._exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
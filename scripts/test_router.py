@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+测试多副本请求路由（router.py）：一致性哈希、有界负载、失败转移、id亲和与SSE转发
+
+使用本地模拟副本（StubBackend），不需要模型:
+    python scripts/test_router.py
+    python -m pytest scripts/test_router.py
+"""
+
+import http.client
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from router import HashRing, ProxyHandler, ReplicaPool, make_server, prefix_key, start_stub_backend
+
+
+@contextmanager
+def routed(count=3, **pool_options):
+    """启动count个模拟副本与路由，返回 (路由端口, 副本集合, {副本URL: 模拟服务器})"""
+    stubs = {}
+    for i in range(count):
+        server = start_stub_backend(f"stub-{i}")
+        stubs[f"http://127.0.0.1:{server.server_address[1]}"] = server
+    pool = ReplicaPool(list(stubs), timeout=10, max_idle=4, **pool_options)
+    router = make_server("127.0.0.1", 0, ProxyHandler, pool=pool, prefix_chars=2048)
+    threading.Thread(target=router.serve_forever, daemon=True).start()
+    try:
+        yield router.server_address[1], pool, stubs
+    finally:
+        for server in [router, *stubs.values()]:
+            server.shutdown()
+            server.server_close()
+
+
+def request(port, method, path, body=None):
+    """返回 (状态码, 响应头列表, 响应体)"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        conn.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        return response.status, response.getheaders(), response.read()
+    finally:
+        conn.close()
+
+
+def replica_of(headers):
+    return dict(headers)["X-Replica"]
+
+
+def chat(content, system="you are helpful"):
+    return {"model": "m", "messages": [{"role": "system", "content": system},
+                                       {"role": "user", "content": content}]}
+
+
+def test_ring_stable_when_replica_removed():
+    """一致性哈希：去掉一个副本时，只有原来落在它上面的键换副本"""
+    names = [f"r{i}" for i in range(4)]
+    full, reduced = HashRing(names), HashRing(names[:3])
+    keys = [f"key-{i}" for i in range(200)]
+    for key in keys:
+        before = full.walk(key)
+        assert sorted(before) == sorted(names)
+        if before[0] != "r3":
+            assert reduced.walk(key)[0] == before[0]
+
+
+def test_prefix_key_ignores_later_turns():
+    """同一会话的后续轮次（第一条user消息之后的内容）不改变路由键"""
+    first = chat("question")
+    later = dict(first, messages=first["messages"] + [{"role": "assistant", "content": "a"},
+                                                      {"role": "user", "content": "more"}])
+    assert prefix_key("/v1/chat/completions", first) == prefix_key("/v1/chat/completions", later)
+    assert prefix_key("/v1/chat/completions", first) != prefix_key("/v1/chat/completions", chat("other"))
+    assert prefix_key("/v1/chat/completions", "not a dict") is None
+
+
+def test_sticky_by_prefix():
+    with routed() as (port, pool, _):
+        for content in ("alpha", "beta", "gamma"):
+            seen = set()
+            for turn in range(3):
+                body = chat(content)
+                body["messages"] += [{"role": "assistant", "content": "x"}] * turn
+                status, headers, _ = request(port, "POST", "/v1/chat/completions", body)
+                assert status == 200
+                seen.add(replica_of(headers))
+            key = prefix_key("/v1/chat/completions", chat(content))
+            assert seen == {pool.candidates(key)[0].name}
+
+
+def test_bounded_load_spillover():
+    """哈希选中的副本负载超过上限时，候选顺序中让给其他副本"""
+    pool = ReplicaPool([f"http://127.0.0.1:{port}" for port in (1, 2, 3)], load_factor=1.25)
+    key = "m\nsome prompt"
+    first = pool.candidates(key)[0]
+    first.in_flight = 10
+    order = pool.candidates(key)
+    assert order[0] is not first and order[-1] is first
+    # 负载回落后回到原副本
+    first.in_flight = 0
+    assert pool.candidates(key)[0] is first
+
+
+def test_unhealthy_last():
+    pool = ReplicaPool([f"http://127.0.0.1:{port}" for port in (1, 2)])
+    key = "m\nprompt"
+    first = pool.candidates(key)[0]
+    first.healthy = False
+    assert pool.candidates(key)[-1] is first
+
+
+def test_failover_on_429_and_503():
+    """哈希选中的副本返回429/503时，在向客户端发送任何数据之前换下一个副本"""
+    with routed() as (port, pool, stubs):
+        body = chat("failover")
+        key = prefix_key("/v1/chat/completions", body)
+        first, second = pool.candidates(key)[:2]
+        stubs[first.name].RequestHandlerClass.fail_status = 429
+        status, headers, payload = request(port, "POST", "/v1/chat/completions", body)
+        assert status == 200 and replica_of(headers) != first.name
+        assert json.loads(payload)["choices"][0]["message"]["content"].startswith("hello from")
+
+        stubs[second.name].RequestHandlerClass.fail_status = 503
+        status, headers, _ = request(port, "POST", "/v1/chat/completions", body)
+        assert status == 200 and replica_of(headers) not in (first.name, second.name)
+
+
+def test_all_replicas_saturated():
+    """全部副本返回429时把最后一个响应原样返回"""
+    with routed(2) as (port, _, stubs):
+        for server in stubs.values():
+            server.RequestHandlerClass.fail_status = 429
+        status, _, payload = request(port, "POST", "/v1/chat/completions", chat("busy"))
+        assert status == 429 and b"unavailable" in payload
+
+
+def test_previous_response_affinity():
+    """previous_response_id与GET /v1/responses/{id} 回到保存该响应的副本"""
+    with routed() as (port, _, _):
+        status, headers, payload = request(port, "POST", "/v1/responses", {"model": "m", "input": "first"})
+        assert status == 200
+        origin, response_id = replica_of(headers), json.loads(payload)["id"]
+        for content in ("second", "third", "fourth"):
+            # 新输入的路由键不同，模拟副本找不到previous_response_id时返回400
+            status, headers, _ = request(port, "POST", "/v1/responses",
+                                         {"model": "m", "input": content, "previous_response_id": response_id})
+            assert status == 200 and replica_of(headers) == origin
+        status, headers, _ = request(port, "GET", f"/v1/responses/{response_id}")
+        assert status == 200 and replica_of(headers) == origin
+
+
+def test_sse_passthrough():
+    with routed(2) as (port, _, _):
+        body = dict(chat("stream"), stream=True)
+        status, headers, payload = request(port, "POST", "/v1/chat/completions", body)
+        assert status == 200
+        headers = dict(headers)
+        assert headers["Content-Type"] == "text/event-stream"
+        assert headers["Transfer-Encoding"] == "chunked"
+        events = [line[len(b"data: "):] for line in payload.split(b"\n\n") if line.startswith(b"data: ")]
+        assert events[-1] == b"[DONE]"
+        text = "".join(json.loads(e)["choices"][0]["delta"]["content"] for e in events[:-1])
+        assert text.startswith("hello from")
+
+
+def test_relay_headers_not_duplicated():
+    with routed(1) as (port, _, _):
+        _, headers, _ = request(port, "POST", "/v1/chat/completions", chat("headers"))
+        names = [name.lower() for name, _ in headers]
+        assert names.count("server") == 1 and names.count("date") == 1
+        assert dict(headers)["Server"].startswith("mlx-router")
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
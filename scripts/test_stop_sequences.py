@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+测试stop序列匹配（stop_sequences.py）：stop字符串被拆分到多个token中时不会有任何部分
+流式发送给客户端，stop_after的字符串保留在输出中
+
+    python scripts/test_stop_sequences.py
+    python -m pytest scripts/test_stop_sequences.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from stop_sequences import StopSequenceMatcher
+
+
+def run(chunks, stops, stop_after=()):
+    """逐块feed直到命中，返回 (每次输出的文本, 是否命中, 命中时已feed的块数)"""
+    matcher = StopSequenceMatcher(stops, stop_after)
+    outputs = []
+    for n, chunk in enumerate(chunks, 1):
+        text, hit = matcher.feed(chunk)
+        outputs.append(text)
+        if hit:
+            return outputs, True, n
+    outputs.append(matcher.flush())
+    return outputs, False, len(chunks)
+
+
+def test_stop_in_one_chunk():
+    outputs, hit, _ = run(["Hello END world"], ["END"])
+    assert hit and outputs == ["Hello "]
+
+
+def test_stop_split_across_tokens():
+    """stop字符串的开头部分被暂存，命中后整个stop字符串都不输出"""
+    outputs, hit, n = run(["Hello ", "<|e", "nd", "|> ignored"], ["<|end|>"])
+    assert hit and n == 4
+    assert outputs == ["Hello ", "", "", ""]
+
+
+def test_every_split():
+    """把文本拆成任意大小的块，拼接的输出都相同"""
+    text = "abc STOP def"
+    for size in range(1, len(text) + 1):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        outputs, hit, _ = run(chunks, ["STOP"])
+        assert hit and "".join(outputs) == "abc ", size
+
+
+def test_false_prefix_released():
+    """暂存的尾部确定不是stop字符串后继续输出"""
+    matcher = StopSequenceMatcher(["###"])
+    assert matcher.feed("a#") == ("a", False)
+    assert matcher.feed("#b") == ("##b", False)
+    assert matcher.feed("##") == ("", False)
+    assert matcher.flush() == "##"
+    assert matcher.flush() == ""
+
+
+def test_earliest_stop_wins():
+    outputs, hit, _ = run(["x", "yz", "w"], ["zw", "y"])
+    assert hit and "".join(outputs) == "x"
+
+
+def test_overlapping_prefixes():
+    """多个stop字符串共享前缀时，按最长的可能前缀暂存"""
+    matcher = StopSequenceMatcher(["abc", "abd", "b"])
+    assert matcher.feed("xa") == ("x", False)
+    assert matcher.feed("bd") == ("", True)
+
+
+def test_stop_after_kept_in_output():
+    """stop_after（如工具调用的结束标签）结束生成但保留在输出中，其后的文本丢弃"""
+    outputs, hit, n = run(["<invoke>", "</inv", "oke>", "tail"], [], ["</invoke>"])
+    assert hit and n == 3
+    assert "".join(outputs) == "<invoke></invoke>"
+    outputs, hit, _ = run(["a</invoke>b"], [], ["</invoke>"])
+    assert hit and outputs == ["a</invoke>"]
+
+
+def test_stop_before_stop_after():
+    """普通stop先出现时截断在stop之前"""
+    outputs, hit, _ = run(["x STOP </invoke>"], ["STOP"], ["</invoke>"])
+    assert hit and outputs == ["x "]
+    outputs, hit, _ = run(["x </invoke> STOP"], ["STOP"], ["</invoke>"])
+    assert hit and outputs == ["x </invoke>"]
+
+
+def test_no_hit_flushes_everything():
+    outputs, hit, _ = run(["hello wor", "ld EN"], ["END"])
+    assert not hit and "".join(outputs) == "hello world EN"
+
+
+def test_empty_stops_ignored():
+    matcher = StopSequenceMatcher(["", "x"], [""])
+    assert matcher.stops == ["x"] and matcher.stop_after == []
+    assert matcher.feed("abc") == ("abc", False)
+
+
+def test_unicode():
+    outputs, hit, _ = run(["你好", "。再", "见"], ["再见"])
+    assert hit and "".join(outputs) == "你好。"
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+测试response_format的约束解码（structured_output.py）：schema编译错误、自动机状态转移、
+各状态的token mask与logits processor
+
+使用一个小的字节级词表代替真实tokenizer，不需要模型:
+    python scripts/test_structured_output.py
+    python -m pytest scripts/test_structured_output.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import mlx.core as mx
+
+from structured_output import (
+    GrammarCache, JSONConstraint, JSONGrammar, SchemaError, TokenVocab, response_format_schema,
+)
+
+TOKENS = ["{", "}", "[", "]", ":", ",", '"', " ", "\n", "a", "b", "1", "2", "-", ".",
+          "name", '"name"', '":', "true", "false", "null", "\\", "ab", "<eos>"]
+EOS = len(TOKENS) - 1
+
+
+class FakeTokenizer:
+    """token_bytes按decode逐个解码的最小tokenizer"""
+    detokenizer = None
+    eos_token_ids = [EOS]
+    all_special_ids = [EOS]
+    added_tokens_decoder = {}
+
+    def __len__(self):
+        return len(TOKENS)
+
+    def decode(self, ids):
+        return "".join(TOKENS[i] for i in ids)
+
+
+VOCAB = TokenVocab(FakeTokenizer())
+
+PERSON = {
+    "type": "object",
+    "properties": {"name": {"type": "string"}, "age": {"type": "integer"}},
+    "required": ["name"],
+    "additionalProperties": False,
+}
+
+
+def grammar(schema):
+    return JSONGrammar(schema, VOCAB)
+
+
+def allowed(g, text=""):
+    """读入text后允许的token（字符串形式）"""
+    state = g.advance(g.initial, text.encode())
+    return {TOKENS[i] for i in g.mask(state).nonzero()[0]}
+
+
+def accepts(g, text):
+    return g.accepting(g.advance(g.initial, text.encode()))
+
+
+def test_response_format_schema():
+    assert response_format_schema(None) is None
+    assert response_format_schema({"type": "text"}) is None
+    assert response_format_schema({"type": "json_object"}) == {"type": "object"}
+    # chat completions与Responses API两种写法
+    assert response_format_schema({"type": "json_schema", "json_schema": {"schema": PERSON}}) == PERSON
+    assert response_format_schema({"type": "json_schema", "name": "p", "schema": PERSON}) == PERSON
+    for bad in ("json", {"type": "xml"}, {"type": "json_schema", "json_schema": {"name": "p"}}):
+        try:
+            response_format_schema(bad)
+        except SchemaError:
+            continue
+        raise AssertionError(f"response_format should be rejected: {bad!r}")
+
+
+def test_schema_compile_errors():
+    for schema in (
+        {"type": "object", "properties": {}, "required": ["x"], "additionalProperties": False},
+        {"type": "array", "minItems": 3, "maxItems": 1},
+        {"type": "date"},
+        {"enum": []},
+        {"$ref": "https://example.com/schema.json"},
+        {"$ref": "#/$defs/missing"},
+        {"properties": {"a": 1}},
+    ):
+        try:
+            grammar(schema)
+        except SchemaError:
+            continue
+        raise AssertionError(f"schema should be rejected: {schema}")
+    # SchemaError是ValueError，api_server按400返回
+    assert issubclass(SchemaError, ValueError)
+
+
+def test_object_masks_per_state():
+    g = grammar(PERSON)
+    assert allowed(g) == {"{", " ", "\n"}
+    # 键只能是声明的属性名（不允许额外属性），必需属性未出现前不能闭合
+    assert allowed(g, "{") == {'"', '"name"', " ", "\n"}
+    assert allowed(g, '{"') == {"a", "name"}  # "age"与"name"的前缀
+    assert allowed(g, '{"name"') == {":", " ", "\n"}
+    # 值的开头：token可以跨越多个字节（'":' 是空字符串开头加一个冒号字符）
+    assert allowed(g, '{"name":') == {'"', '":', '"name"', " ", "\n"}
+    # 字符串内容：除控制字符外都可以，引号结束字符串
+    inside = allowed(g, '{"name":"')
+    assert {"a", "b", "ab", "1", "name", "{", '"', "\\", " "} <= inside
+    assert "\n" not in inside and "<eos>" not in inside
+    assert allowed(g, '{"name":"ab"') == {",", "}", " ", "\n"}
+    # 顶层值结束后只允许EOS
+    assert allowed(g, '{"name":"ab"}') == {"<eos>"}
+
+
+def test_object_accepts():
+    g = grammar(PERSON)
+    assert accepts(g, '{"name":"a","age":-12}')
+    assert accepts(g, '{ "age" : 1 , "name" : "b" }')
+    assert not accepts(g, '{"age":1}')  # 缺少必需属性
+    assert not g.advance(g.initial, b'{"other"')  # 未声明的属性
+    assert not g.advance(g.initial, b'{"name":1')  # 类型不符
+    assert not g.advance(g.initial, b'{"name":"a","name"')  # 重复的键
+
+
+def test_required_not_in_properties():
+    """必需但未在properties中声明的属性按additionalProperties处理，对象可以闭合"""
+    g = grammar({"type": "object", "properties": {}, "required": ["a"], "additionalProperties": {"type": "integer"}})
+    assert "}" not in allowed(g, "{")
+    assert "}" in allowed(g, '{"a":1')
+    assert accepts(g, '{"a":12}')
+    assert not g.advance(g.initial, b'{"a":"x"')
+
+
+def test_array_bounds():
+    g = grammar({"type": "array", "items": {"type": "integer"}, "minItems": 1, "maxItems": 2})
+    assert "]" not in allowed(g, "[")
+    assert {",", "]"} <= allowed(g, "[1")
+    assert "," not in allowed(g, "[1,2") and "]" in allowed(g, "[1,2")
+    assert accepts(g, "[1, 2]") and not accepts(g, "[]")
+
+
+def test_number_states():
+    g = grammar({"type": "number"})
+    assert "<eos>" not in allowed(g, "-")
+    assert {"1", "2", "."} <= allowed(g, "1") and "<eos>" in allowed(g, "1")
+    assert "1" not in allowed(g, "0")  # 前导0之后不能再有数字
+    assert "<eos>" not in allowed(g, "1.")
+    assert accepts(g, "-0.5") and not accepts(g, "01")
+    assert "." not in allowed(grammar({"type": "integer"}), "1")
+
+
+def test_enum_anyof_ref():
+    g = grammar({"enum": ["ab", 1, None]})
+    assert accepts(g, '"ab"') and accepts(g, "1") and accepts(g, "null")
+    assert not g.advance(g.initial, b'"b')
+    g = grammar({"anyOf": [{"type": "boolean"}, {"$ref": "#/$defs/item"}],
+                 "$defs": {"item": {"type": "array", "items": {"$ref": "#"}}}})
+    assert accepts(g, "[true,[false]]") and not accepts(g, '["a"]')
+    assert allowed(g) == {"[", "true", "false", " ", "\n"}
+
+
+def test_escape_in_string():
+    g = grammar({"type": "string"})
+    # 只允许合法的转义字符：" \\ / b f n r t u 开头的token
+    assert allowed(g, '"\\') == {'"', '":', '"name"', "\\", "b", "false", "name", "null", "true"}
+    assert accepts(g, '"a\\"b"')
+    assert not g.advance(g.initial, b'"\\a')
+
+
+def test_mask_cached_per_state():
+    g = grammar(PERSON)
+    # 不同的输入到达同一状态（键后的空白不计入状态）时复用同一个mask
+    first = g.advance(g.initial, b'{"name":')
+    second = g.advance(g.initial, b'{"name" :')
+    assert first == second and g.mask(first) is g.mask(second)
+
+
+def test_logits_processor():
+    """processor跟踪生成的token，不允许的token的logit为-inf"""
+    processor = JSONConstraint(grammar(PERSON))()
+    prompt = [EOS, EOS]
+    logits = mx.zeros((1, len(TOKENS)))
+    out = processor(mx.array(prompt), logits)
+    assert {TOKENS[i] for i in range(len(TOKENS)) if out[0, i].item() == 0} == {"{", " ", "\n"}
+    generated = [TOKENS.index(t) for t in ("{", '"name"', ":", '"', "ab", '"', "}")]
+    out = processor(mx.array(prompt + generated), logits)
+    assert [TOKENS[i] for i in range(len(TOKENS)) if out[0, i].item() == 0] == ["<eos>"]
+    # 模型的词表维度大于tokenizer时，多出的位置被屏蔽
+    processor = JSONConstraint(grammar(PERSON))()
+    out = processor(mx.array(prompt), mx.zeros((1, len(TOKENS) + 3)))
+    assert out.shape[-1] == len(TOKENS) + 3 and out[0, -1].item() == float("-inf")
+
+
+def test_logits_processor_wait_for():
+    """prompt以<think>结尾时，推理内容不受约束，出现wait_for之后才开始约束"""
+    processor = JSONConstraint(grammar(PERSON), wait_for="name")()
+    logits = mx.zeros((1, len(TOKENS)))
+    prompt = [EOS]
+    assert processor(mx.array(prompt), logits).min().item() == 0
+    thinking = [TOKENS.index(t) for t in ("a", "b", "a")]
+    assert processor(mx.array(prompt + thinking), logits).min().item() == 0
+    done = thinking + [TOKENS.index("name")]
+    out = processor(mx.array(prompt + done), logits)
+    assert {TOKENS[i] for i in range(len(TOKENS)) if out[0, i].item() == 0} == {"{", " ", "\n"}
+
+
+def test_grammar_cache():
+    cache = GrammarCache(max_entries=1)
+    first = cache.get("m", FakeTokenizer(), PERSON)
+    assert cache.get("m", FakeTokenizer(), dict(PERSON)) is first
+    other = cache.get("m", FakeTokenizer(), {"type": "string"})
+    assert other.vocab is first.vocab  # 同一模型的词表只构建一次
+    assert cache.get("m", FakeTokenizer(), PERSON) is not first  # 已被LRU淘汰
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["hits"] == 1 and stats["misses"] == 3
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+测试<think>块的增量解析（think_parser.py）：流式增量与一次性解析的结果一致
+
+    python scripts/test_think_parser.py
+    python -m pytest scripts/test_think_parser.py
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from think_parser import ThinkStreamParser, parse_think_text
+
+
+def stream(chunks, in_reasoning=False, hold_chars=8192):
+    """逐块feed，返回 (每次的增量, 拼接后的流式结果, result())"""
+    parser = ThinkStreamParser(in_reasoning, hold_chars)
+    deltas = [parser.feed(chunk) for chunk in chunks]
+    deltas.append(parser.finish())
+    joined = ("".join(d[0] for d in deltas), "".join(d[1] for d in deltas))
+    return deltas, joined, parser.result()
+
+
+def test_no_opening_tag():
+    """MiniMax省略<think>时，</think>之前的文本不能作为content流出"""
+    deltas, joined, result = stream(["think", "ing</th", "ink>ans", "wer"])
+    assert result == ("thinking", "answer")
+    assert joined == result
+    assert all(content == "" for _, content in deltas[:2])
+    assert parse_think_text("thinking</think>answer") == result
+
+
+def test_no_opening_tag_whitespace():
+    _, joined, result = stream(["\n  reasoning  \n", "</think>", "\n\n  answer  "])
+    assert result == ("reasoning", "answer")
+    assert joined == result
+
+
+def test_split_tags():
+    chunks = ["<", "thi", "nk>", " step 1 ", "</", "think", ">", "\n\n", "done"]
+    _, joined, result = stream(chunks)
+    assert result == ("step 1", "done")
+    assert joined == result
+    assert parse_think_text("".join(chunks)) == result
+
+
+def test_prompt_opens_think():
+    _, joined, result = stream(["plan", "</thi", "nk>", "go"], in_reasoning=True)
+    assert result == ("plan", "go")
+    assert joined == result
+
+
+def test_plain_content_unchanged():
+    """没有任何标签的回复原样保留（包括首尾空白）"""
+    _, joined, result = stream(["  hello ", "world  "])
+    assert result == ("", "  hello world  ")
+    assert joined == result
+
+
+def test_content_before_open_tag():
+    _, joined, result = stream(["a<think>b</think>c"])
+    assert result == ("b", "ac")
+    assert joined == result
+
+
+def test_no_hold_streams_immediately():
+    """hold_chars=0（不会输出推理的模型）：内容立即输出"""
+    deltas, joined, _ = stream(["hello", " world"], hold_chars=0)
+    assert deltas[0] == ("", "hello")
+    assert joined == ("", "hello world")
+
+
+def test_hold_limit():
+    """超过暂存上限后按回复输出，不再等待标签"""
+    deltas, _, _ = stream(["abcdef", "gh"], hold_chars=4)
+    assert deltas[0] == ("", "abcdef")
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+测试工具调用的增量解析（tool_parser.py）：MiniMax M2 与 Qwen3-Coder 格式的标签与参数
+被拆分到任意多个chunk时，流式增量与一次性解析的结果一致
+
+    python scripts/test_tool_parser.py
+    python -m pytest scripts/test_tool_parser.py
+"""
+
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from tool_parser import (
+    MINIMAX, QWEN3_CODER, ToolCallDelta, ToolCallStreamParser, convert_parameter, detect_tool_format,
+)
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "get_weather",
+        "parameters": {"type": "object", "properties": {
+            "city": {"type": "string"},
+            "days": {"type": "integer"},
+            "options": {"type": "object"},
+            "zip": {"type": "string"},
+        }},
+    },
+}]
+
+MINIMAX_TEXT = (
+    "让我查一下。\n"
+    "<minimax:tool_call>\n"
+    '<invoke name="get_weather">\n'
+    '<parameter name="city">北京</parameter>\n'
+    '<parameter name="days">3</parameter>\n'
+    '<parameter name="zip">100000</parameter>\n'
+    "</invoke>\n"
+    '<invoke name="get_time">\n'
+    "</invoke>\n"
+    "</minimax:tool_call>"
+)
+
+QWEN_TEXT = (
+    "<tool_call>\n"
+    "<function=get_weather>\n"
+    "<parameter=city>\n"
+    "New\nYork\n"
+    "</parameter>\n"
+    "<parameter=options>\n"
+    '{"unit": "c"}\n'
+    "</parameter>\n"
+    "</function>\n"
+    "</tool_call>"
+)
+
+MINIMAX_CALLS = [
+    ("get_weather", {"city": "北京", "days": 3, "zip": "100000"}),
+    ("get_time", {}),
+]
+QWEN_CALLS = [("get_weather", {"city": "New\nYork", "options": {"unit": "c"}})]
+
+
+def stream(fmt, chunks, tools=TOOLS):
+    """逐块feed，返回 (拼接的content增量, 按index合并的调用 [(name, arguments)], parser)"""
+    parser = ToolCallStreamParser(fmt, tools)
+    content, calls = [], {}
+    deltas = []
+    for chunk in chunks:
+        text, new = parser.feed(chunk)
+        content.append(text)
+        deltas += new
+    text, new = parser.finish()
+    content.append(text)
+    deltas += new
+    for delta in deltas:
+        if delta.id is not None:
+            assert delta.index not in calls, "each call starts exactly once"
+            calls[delta.index] = [delta.name, ""]
+        calls[delta.index][1] += delta.arguments
+    merged = [(calls[i][0], calls[i][1]) for i in sorted(calls)]
+    return "".join(content), merged, parser
+
+
+def split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def decoded(calls):
+    return [(name, json.loads(arguments)) for name, arguments in calls]
+
+
+def test_minimax_any_split():
+    """标签、参数名与参数值被拆分到任意大小的chunk中，结果都相同"""
+    for size in (1, 2, 3, 5, 7, 11, len(MINIMAX_TEXT)):
+        content, calls, parser = stream(MINIMAX, split_every(MINIMAX_TEXT, size))
+        assert content == "让我查一下。\n", size
+        assert decoded(calls) == MINIMAX_CALLS, size
+        result_content, result_calls = parser.result()
+        assert result_content == "让我查一下。"
+        assert [(c.name, c.arguments) for c in result_calls] == calls
+        assert parser.completed_calls == 2
+
+
+def test_qwen3_coder_any_split():
+    """Qwen3-Coder：参数值只去掉首尾各一个换行，值内部的换行保留"""
+    for size in (1, 2, 3, 4, 9, len(QWEN_TEXT)):
+        content, calls, parser = stream(QWEN3_CODER, split_every(QWEN_TEXT, size))
+        assert content == "", size
+        assert decoded(calls) == QWEN_CALLS, size
+        assert all(call.complete for call in parser.calls)
+
+
+def test_arguments_stream_per_parameter():
+    """每个参数闭合时输出一段arguments，第一个增量带id与name"""
+    parser = ToolCallStreamParser(MINIMAX, TOOLS)
+    _, deltas = parser.feed('<minimax:tool_call>\n<invoke name="get_weather">\n')
+    assert len(deltas) == 1 and deltas[0].name == "get_weather" and deltas[0].id.startswith("call_")
+    _, deltas = parser.feed('<parameter name="city">上')
+    assert deltas == []  # 参数值尚未闭合
+    _, deltas = parser.feed('海</parameter>\n')
+    assert [d.arguments for d in deltas] == ['{"city": "上海"']
+    _, deltas = parser.feed("</invoke>\n</minimax:tool_call>after")
+    assert [d.arguments for d in deltas] == ["}"]
+    assert parser.result() == ("after", parser.calls)
+
+
+def test_content_holds_partial_open_tag():
+    """content末尾可能是块开头标签的前缀时暂存，确定不是标签后再输出"""
+    parser = ToolCallStreamParser(MINIMAX)
+    assert parser.feed("hello <mini") == ("hello ", [])
+    assert parser.feed("mal") == ("<minimal", [])
+    assert parser.feed(" <") == (" ", [])
+    assert parser.finish() == ("<", [])
+    assert parser.result() == ("hello <minimal <", [])
+
+
+def test_interrupted_call():
+    """生成在调用中途结束：已输出的部分保留，调用标记为未完成"""
+    text = '<tool_call>\n<function=get_weather>\n<parameter=city>\nParis\n</parameter>\n<parameter=days>\n2'
+    content, calls, parser = stream(QWEN3_CODER, split_every(text, 4))
+    assert content == ""
+    assert calls == [("get_weather", '{"city": "Paris"')]
+    assert parser.completed_calls == 0 and not parser.calls[0].complete
+
+
+def test_text_after_block():
+    text = 'a<minimax:tool_call><invoke name="f"></invoke></minimax:tool_call>b'
+    content, calls, _ = stream(MINIMAX, split_every(text, 3))
+    assert content == "ab"
+    assert calls == [("f", "{}")]
+
+
+def test_parameter_types():
+    assert convert_parameter("3", {"type": "integer"}) == 3
+    assert convert_parameter("3", {"type": "string"}) == "3"
+    assert convert_parameter("null", {"type": ["string", "null"]}) is None
+    assert convert_parameter("[1, 2]", None) == [1, 2]
+    assert convert_parameter("not json", {"type": "object"}) == "not json"
+    # 未声明的函数或参数按JSON解析，失败时保留原文
+    _, calls, _ = stream(MINIMAX, ['<minimax:tool_call><invoke name="other"><parameter name="x">007'
+                                   '</parameter><parameter name="y">true</parameter></invoke></minimax:tool_call>'])
+    assert decoded(calls) == [("other", {"x": "007", "y": True})]
+
+
+def test_delta_to_dict():
+    first = ToolCallDelta(0, "call_1", "f", "")
+    assert first.to_dict() == {"index": 0, "id": "call_1", "type": "function",
+                               "function": {"name": "f", "arguments": ""}}
+    assert ToolCallDelta(1, arguments="}").to_dict() == {"index": 1, "function": {"arguments": "}"}}
+
+
+def test_detect_tool_format():
+    class Tokenizer:
+        def __init__(self, template="", vocab=None):
+            self.chat_template = template
+            self.vocab = vocab or {}
+
+    assert detect_tool_format(Tokenizer("{{ '<minimax:tool_call>' }}")) is MINIMAX
+    assert detect_tool_format(Tokenizer(vocab={"<minimax:tool_call>": 1})) is MINIMAX
+    assert detect_tool_format(Tokenizer("<function=x> <parameter=y>")) is QWEN3_CODER
+    assert detect_tool_format(Tokenizer("plain template")) is None
+
+
+def main():
+    tests = [(name, fn) for name, fn in globals().items() if name.startswith("test_") and callable(fn)]
+    failed = 0
+    for name, fn in tests:
+        try:
+            fn()
+            print(f"✓ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"✗ {name}: {type(e).__name__}: {e}")
+    print(f"\n总计: {len(tests) - failed}/{len(tests)} 测试通过")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
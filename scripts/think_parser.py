@@ -0,0 +1,173 @@
+"""
+<think> 推理块的增量解析器
+
+边接收token文本边把 <think>…</think> 内的内容路由到 reasoning，
+其余内容路由到 content。标签可能被拆分到多个token中，解析器会暂存
+可能是标签前缀的尾部文本，直到能确定为止。整个解析只线性扫描一遍文本。
+
+MiniMax 有时省略开头标签直接输出推理（thinking</think>answer）。prompt没有以
+<think> 结尾时，开头的文本是推理还是回复要等看到第一个标签才能确定：解析器
+暂存最多 hold_chars 个字符，遇到 </think> 按推理处理、遇到 <think> 或超过上限
+按回复处理，流式输出与 result() 一致。
+"""
+
+from typing import List, Tuple
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+DEFAULT_HOLD_CHARS = 8192  # 无法确定开头文本是否为推理时最多暂存的字符数
+
+REASONING = "reasoning"
+CONTENT = "content"
+
+
+def partial_tag_length(text: str, tags: Tuple[str, ...]) -> int:
+    """text末尾可能是某个标签开头的最长长度"""
+    longest = 0
+    for tag in tags:
+        for n in range(min(len(tag) - 1, len(text)), longest, -1):
+            if text.endswith(tag[:n]):
+                longest = n
+                break
+    return longest
+
+
+class ThinkStreamParser:
+    """
+    增量状态机：feed() 返回本次新增的 (reasoning_delta, content_delta)。
+
+    in_reasoning=True 表示prompt已经以 <think> 结尾（如MiniMax M2.1的chat template），
+    模型输出从推理内容开始、没有开头标签。否则在看到第一个标签之前最多暂存
+    hold_chars 个字符（0表示不暂存，按回复输出；不会输出推理的模型使用）。
+
+    空白处理与原先的正则版本一致：没有任何标签时原样输出；否则推理块与最终回复
+    首尾的空白被去掉，</think> 之后的空白被去掉，多个推理块之间用换行连接。
+    """
+
+    def __init__(self, in_reasoning: bool = False, hold_chars: int = DEFAULT_HOLD_CHARS):
+        self._reset(in_reasoning)
+        # 开头文本是推理还是回复尚未确定时暂存的原始文本
+        self._held = "" if not in_reasoning and hold_chars > 0 else None
+        self.hold_chars = hold_chars
+
+    def _reset(self, in_reasoning: bool):
+        self.state = REASONING if in_reasoning else CONTENT
+        self.saw_open = in_reasoning
+        self.saw_tag = in_reasoning
+        self.reasoning: List[str] = []
+        self.content: List[str] = []
+        # 没有开头标签却遇到 </think> 时，在此之前的content实际上是推理内容
+        self.orphan_close_at = None
+
+        self._buffer = ""
+        self._pending_ws = {REASONING: "", CONTENT: ""}
+        self._block_start = in_reasoning
+
+    def feed(self, text: str) -> Tuple[str, str]:
+        if self._held is not None:
+            self._held += text
+            close = self._held.find(THINK_CLOSE)
+            opened = self._held.find(THINK_OPEN)
+            if close >= 0 and (opened < 0 or close < opened):
+                # 没有开头标签的推理：按prompt以<think>结尾的情况重新解析
+                return self._decide(True)
+            if opened >= 0 or len(self._held) > self.hold_chars:
+                return self._decide(False)
+            return "", ""
+        return self._feed(text)
+
+    def _decide(self, in_reasoning: bool) -> Tuple[str, str]:
+        held, self._held = self._held, None
+        self._reset(in_reasoning)
+        return self._feed(held)
+
+    def _feed(self, text: str) -> Tuple[str, str]:
+        self._buffer += text
+        deltas = {REASONING: [], CONTENT: []}
+
+        while self._buffer:
+            tags = (THINK_OPEN, THINK_CLOSE) if self.state == CONTENT else (THINK_CLOSE,)
+            found = [(self._buffer.find(tag), tag) for tag in tags]
+            found = [(i, tag) for i, tag in found if i >= 0]
+
+            if not found:
+                # 保留可能是标签开头的尾部
+                keep = partial_tag_length(self._buffer, tags)
+                ready = self._buffer[:len(self._buffer) - keep]
+                self._buffer = self._buffer[len(ready):]
+                self._emit(ready, deltas)
+                break
+
+            i, tag = min(found)
+            self._emit(self._buffer[:i], deltas)
+            self._buffer = self._buffer[i + len(tag):]
+            self._switch(tag)
+
+        return "".join(deltas[REASONING]), "".join(deltas[CONTENT])
+
+    def finish(self) -> Tuple[str, str]:
+        """输出被暂存的尾部文本（生成结束时调用）"""
+        head = ("", "")
+        if self._held is not None:
+            # 直到结束都没有标签：普通回复
+            head = self._decide(False)
+        deltas = {REASONING: [head[0]], CONTENT: [head[1]]}
+        rest, self._buffer = self._buffer, ""
+        self._emit(rest, deltas)
+        if not self.saw_tag and self._pending_ws[CONTENT]:
+            # 普通回复（没有任何标签）保持原样
+            deltas[CONTENT].append(self._pending_ws[CONTENT])
+            self.content.append(self._pending_ws[CONTENT])
+            self._pending_ws[CONTENT] = ""
+        return "".join(deltas[REASONING]), "".join(deltas[CONTENT])
+
+    def result(self) -> Tuple[str, str]:
+        """完整的 (reasoning, content)"""
+        if self.orphan_close_at is not None:
+            # 模型直接输出thinking后跟</think>
+            head = "".join(self.content[:self.orphan_close_at]).strip()
+            reasoning = "\n".join(x for x in (head, "".join(self.reasoning)) if x)
+            return reasoning, "".join(self.content[self.orphan_close_at:]).strip()
+        content = "".join(self.content)
+        return "".join(self.reasoning), content.strip() if self.saw_tag else content
+
+    def _switch(self, tag: str):
+        self.saw_tag = True
+        if tag == THINK_OPEN:
+            self.state = REASONING
+            self.saw_open = True
+        elif self.state == REASONING:
+            self.state = CONTENT
+            self._pending_ws[REASONING] = ""
+        elif not self.saw_open and self.orphan_close_at is None:
+            self.orphan_close_at = len(self.content)
+            self._pending_ws[CONTENT] = ""
+        self._block_start = True
+
+    def _emit(self, text: str, deltas):
+        if not text:
+            return
+        state = self.state
+        if self._block_start:
+            text = text.lstrip()
+            if not text:
+                return
+            self._block_start = False
+            if state == REASONING and self.reasoning:
+                text = "\n" + text
+
+        # 尾部空白暂存，后面出现非空白内容时再输出
+        text = self._pending_ws[state] + text
+        stripped = text.rstrip()
+        self._pending_ws[state] = text[len(stripped):]
+        if stripped:
+            deltas[state].append(stripped)
+            (self.reasoning if state == REASONING else self.content).append(stripped)
+
+
+def parse_think_text(text: str, in_reasoning: bool = False, hold_chars: int = DEFAULT_HOLD_CHARS) -> Tuple[str, str]:
+    """一次性解析完整文本，返回 (reasoning, content)；hold_chars需与流式解析时相同，结果才一致"""
+    parser = ThinkStreamParser(in_reasoning, hold_chars)
+    parser.feed(text)
+    parser.finish()
+    return parser.result()
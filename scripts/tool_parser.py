@@ -0,0 +1,274 @@
+"""
+工具调用的增量解析器（MiniMax M2 与 Qwen3-Coder 的XML风格格式）
+
+MiniMax M2:
+    <minimax:tool_call>
+    <invoke name="get_weather">
+    <parameter name="city">北京</parameter>
+    </invoke>
+    </minimax:tool_call>
+
+Qwen3-Coder:
+    <tool_call>
+    <function=get_weather>
+    <parameter=city>
+    北京
+    </parameter>
+    </function>
+    </tool_call>
+
+与 ThinkStreamParser 一样边接收文本边解析：工具调用块之外的文本作为content输出，
+块内的调用一识别出函数名就发出带id与name的增量，每个参数闭合时发出arguments
+的JSON片段，调用结束时补上右括号。客户端按OpenAI的方式拼接arguments即可得到
+完整的JSON。参数值按tools中声明的类型转换（string原样保留，其他类型按JSON解析）。
+"""
+
+import json
+import re
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+
+from think_parser import partial_tag_length
+
+CONTENT = "content"
+BLOCK = "block"  # 工具调用块内、调用之间
+INVOKE = "invoke"  # 调用内、参数之间
+PARAMETER = "parameter"  # 参数值内
+
+
+@dataclass(frozen=True)
+class ToolCallFormat:
+    """一种模型的工具调用标记"""
+    name: str
+    block_open: str
+    block_close: str
+    invoke_open: Pattern[str]  # group(1)为函数名
+    invoke_close: str
+    parameter_open: Pattern[str]  # group(1)为参数名
+    parameter_close: str = "</parameter>"
+
+
+MINIMAX = ToolCallFormat(
+    name="minimax",
+    block_open="<minimax:tool_call>",
+    block_close="</minimax:tool_call>",
+    invoke_open=re.compile(r'<invoke name="([^"]*)">'),
+    invoke_close="</invoke>",
+    parameter_open=re.compile(r'<parameter name="([^"]*)">'),
+)
+
+QWEN3_CODER = ToolCallFormat(
+    name="qwen3_coder",
+    block_open="<tool_call>",
+    block_close="</tool_call>",
+    invoke_open=re.compile(r"<function=([^>\n]*)>"),
+    invoke_close="</function>",
+    parameter_open=re.compile(r"<parameter=([^>\n]*)>"),
+)
+
+TOOL_CALL_FORMATS = {f.name: f for f in (MINIMAX, QWEN3_CODER)}
+
+
+def detect_tool_format(tokenizer) -> Optional[ToolCallFormat]:
+    """按chat template（或词表中的特殊token）识别模型使用的工具调用格式"""
+    template = getattr(tokenizer, "chat_template", None) or ""
+    if not isinstance(template, str):
+        template = ""
+    vocab = getattr(tokenizer, "vocab", None) or {}
+    if MINIMAX.block_open in template or MINIMAX.block_open in vocab:
+        return MINIMAX
+    if "<function=" in template and "<parameter=" in template:
+        return QWEN3_CODER
+    return None
+
+
+@dataclass
+class ToolCallDelta:
+    """一个工具调用的增量，对应chat.completion.chunk中delta.tool_calls的一项"""
+    index: int
+    id: Optional[str] = None  # 只在调用的第一个增量中出现
+    name: Optional[str] = None
+    arguments: str = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        delta: Dict[str, Any] = {"index": self.index}
+        function: Dict[str, Any] = {"arguments": self.arguments}
+        if self.id is not None:
+            delta["id"] = self.id
+            delta["type"] = "function"
+            function["name"] = self.name
+        delta["function"] = function
+        return delta
+
+
+@dataclass
+class ToolCall:
+    """一个完整（或因生成结束而中断）的工具调用"""
+    id: str
+    name: str
+    arguments: str = ""
+    complete: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        """chat completions 的 message.tool_calls 项"""
+        return {"id": self.id, "type": "function", "function": {"name": self.name, "arguments": self.arguments}}
+
+
+def tool_parameter_types(tools: Optional[List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """{函数名: {参数名: 参数schema}}，tools为OpenAI chat completions格式"""
+    types: Dict[str, Dict[str, Any]] = {}
+    for tool in tools or ():
+        function = tool.get("function", tool) if isinstance(tool, dict) else None
+        if not isinstance(function, dict) or not function.get("name"):
+            continue
+        parameters = function.get("parameters") or {}
+        properties = parameters.get("properties") if isinstance(parameters, dict) else None
+        types[function["name"]] = properties if isinstance(properties, dict) else {}
+    return types
+
+
+def convert_parameter(value: str, schema: Optional[Dict[str, Any]]) -> Any:
+    """按参数声明的类型转换参数值；string与无法解析的值保留原文"""
+    kind = schema.get("type") if isinstance(schema, dict) else None
+    kinds = kind if isinstance(kind, list) else [kind]
+    if "string" in kinds:
+        if "null" in kinds and value == "null":
+            return None
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+class ToolCallStreamParser:
+    """
+    增量状态机：feed() 返回本次新增的 (content_delta, tool_call_deltas)。
+
+    标签可能被拆分到多个token中：content中可能是块开头标签的尾部会被暂存，
+    块内的文本在标签完整出现之前不做处理。
+    """
+
+    def __init__(self, fmt: ToolCallFormat, tools: Optional[List[Dict[str, Any]]] = None):
+        self.format = fmt
+        self.parameter_types = tool_parameter_types(tools)
+        self.state = CONTENT
+        self.calls: List[ToolCall] = []
+        self.content: List[str] = []
+
+        self._buffer = ""
+        self._parameter: Optional[str] = None
+        self._arguments = 0  # 当前调用已输出的参数数
+
+    def feed(self, text: str) -> Tuple[str, List[ToolCallDelta]]:
+        self._buffer += text
+        content: List[str] = []
+        deltas: List[ToolCallDelta] = []
+        while self._buffer and self._step(content, deltas):
+            pass
+        return "".join(content), deltas
+
+    def finish(self) -> Tuple[str, List[ToolCallDelta]]:
+        """输出被暂存的content尾部；未闭合的调用保持中断时的状态（生成结束时调用）"""
+        rest, self._buffer = self._buffer, ""
+        if self.state == CONTENT and rest:
+            self.content.append(rest)
+            return rest, []
+        return "", []
+
+    def result(self) -> Tuple[str, List[ToolCall]]:
+        """完整的 (content, 工具调用)；有工具调用时content去掉首尾空白"""
+        content = "".join(self.content)
+        return (content.strip() if self.calls else content), self.calls
+
+    @property
+    def completed_calls(self) -> int:
+        return sum(1 for call in self.calls if call.complete)
+
+    def _step(self, content: List[str], deltas: List[ToolCallDelta]) -> bool:
+        """处理缓冲区开头的一段，返回是否还能继续"""
+        fmt = self.format
+        if self.state == CONTENT:
+            i = self._buffer.find(fmt.block_open)
+            if i < 0:
+                keep = partial_tag_length(self._buffer, (fmt.block_open,))
+                ready = self._buffer[:len(self._buffer) - keep]
+                self._buffer = self._buffer[len(ready):]
+                if ready:
+                    content.append(ready)
+                    self.content.append(ready)
+                return False
+            if i:
+                content.append(self._buffer[:i])
+                self.content.append(self._buffer[:i])
+            self._buffer = self._buffer[i + len(fmt.block_open):]
+            self.state = BLOCK
+            return True
+
+        if self.state == BLOCK:
+            return self._next_tag(fmt.invoke_open, fmt.block_close, self._open_call, CONTENT, deltas)
+
+        if self.state == INVOKE:
+            return self._next_tag(fmt.parameter_open, fmt.invoke_close, self._open_parameter, BLOCK, deltas)
+
+        # PARAMETER
+        i = self._buffer.find(fmt.parameter_close)
+        if i < 0:
+            return False
+        value, self._buffer = self._buffer[:i], self._buffer[i + len(fmt.parameter_close):]
+        self._close_parameter(value, deltas)
+        self.state = INVOKE
+        return True
+
+    def _next_tag(self, open_pattern: Pattern[str], close: str, on_open, close_state: str,
+                  deltas: List[ToolCallDelta]) -> bool:
+        """在块或调用内寻找下一个开始标签或本层的结束标签，之间的文本（通常是换行）丢弃"""
+        match = open_pattern.search(self._buffer)
+        i = self._buffer.find(close)
+        if i >= 0 and (match is None or i < match.start()):
+            self._buffer = self._buffer[i + len(close):]
+            if self.state == INVOKE:
+                self._close_call(deltas)
+            self.state = close_state
+            return True
+        if match is None:
+            return False
+        self._buffer = self._buffer[match.end():]
+        on_open(match.group(1).strip(), deltas)
+        return True
+
+    def _open_call(self, name: str, deltas: List[ToolCallDelta]):
+        call = ToolCall(id=f"call_{uuid.uuid4().hex[:12]}", name=name)
+        self.calls.append(call)
+        self._arguments = 0
+        deltas.append(ToolCallDelta(len(self.calls) - 1, call.id, name))
+        self.state = INVOKE
+
+    def _open_parameter(self, name: str, deltas: List[ToolCallDelta]):
+        self._parameter = name
+        self.state = PARAMETER
+
+    def _close_parameter(self, value: str, deltas: List[ToolCallDelta]):
+        call = self.calls[-1]
+        if self.format is QWEN3_CODER:
+            # 值前后各有一个换行
+            value = value[1:] if value.startswith("\n") else value
+            value = value[:-1] if value.endswith("\n") else value
+        else:
+            value = value.strip()
+        schema = self.parameter_types.get(call.name, {}).get(self._parameter)
+        fragment = "{" if self._arguments == 0 else ", "
+        fragment += json.dumps(self._parameter, ensure_ascii=False) + ": "
+        fragment += json.dumps(convert_parameter(value, schema), ensure_ascii=False)
+        self._arguments += 1
+        self._append_arguments(fragment, deltas)
+
+    def _close_call(self, deltas: List[ToolCallDelta]):
+        self._append_arguments("}" if self._arguments else "{}", deltas)
+        self.calls[-1].complete = True
+
+    def _append_arguments(self, fragment: str, deltas: List[ToolCallDelta]):
+        self.calls[-1].arguments += fragment
+        deltas.append(ToolCallDelta(len(self.calls) - 1, arguments=fragment))
+
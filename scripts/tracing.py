@@ -0,0 +1,161 @@
+"""
+每个请求的阶段耗时（span树）
+
+HTTP处理线程在请求开始时 start() 一个Trace，之后任何位置都可以用 span()
+记录一个阶段（chat template、tokenize、构建响应、JSON序列化……）；没有
+当前Trace时 span() 什么都不做。当前Trace保存在contextvar中，ASGI模式下
+asyncio.to_thread 会把它带进工作线程。引擎线程内的阶段（排队、prefill、
+decode）由请求句柄上的时间戳补记。
+
+所有时间戳都来自 time.perf_counter()。TraceWriter 把Trace写成Chrome trace
+事件（JSON数组格式，可直接用 chrome://tracing 或 Perfetto 打开）。
+"""
+
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Span:
+    """一个阶段：开始/结束时间戳、属性和子阶段"""
+
+    __slots__ = ("name", "start", "end", "attrs", "children")
+
+    def __init__(self, name: str, start: float, end: Optional[float] = None, **attrs):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attrs: Dict[str, Any] = attrs
+        self.children: List["Span"] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        """毫秒为单位，start_ms相对于请求开始"""
+        node: Dict[str, Any] = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        if self.attrs:
+            node["attrs"] = self.attrs
+        if self.children:
+            node["children"] = [child.to_dict(origin) for child in self.children]
+        return node
+
+
+class Trace:
+    """一个请求的span树，根span覆盖整个请求"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name: str):
+        self.id = next(self._ids)
+        self.root = Span(name, time.perf_counter())
+        self._stack = [self.root]
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Span]:
+        """记录with块的耗时，块内的span成为它的子span"""
+        span = self.add(name, time.perf_counter(), **attrs)
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            self._stack.pop()
+
+    def add(
+        self,
+        name: str,
+        start: float,
+        end: Optional[float] = None,
+        parent: Optional[Span] = None,
+        **attrs,
+    ) -> Span:
+        """补记一个已知起止时间的span（默认挂在当前span下）"""
+        span = Span(name, start, end, **attrs)
+        (parent or self._stack[-1]).children.append(span)
+        return span
+
+    def finish(self):
+        if self.root.end is None:
+            self.root.end = time.perf_counter()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.root.to_dict(self.root.start)
+
+    def chrome_events(self) -> List[Dict[str, Any]]:
+        """Chrome trace的完整事件（ph=X），每个请求一条时间线（tid）"""
+        events = []
+
+        def visit(span: Span):
+            events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": round(span.start * 1e6, 3),
+                "dur": round(span.duration * 1e6, 3),
+                "pid": os.getpid(),
+                "tid": self.id,
+                "args": span.attrs,
+            })
+            for child in span.children:
+                visit(child)
+
+        visit(self.root)
+        return events
+
+
+_current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+
+
+def start(name: str) -> Trace:
+    """为当前请求开始一个新的Trace"""
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """在当前Trace中记录一个阶段；没有Trace时不记录"""
+    trace = _current.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attrs) as s:
+        yield s
+
+
+class TraceWriter:
+    """
+    把Trace追加到Chrome trace文件（JSON数组格式）。
+
+    该格式允许省略结尾的 ']'，所以每个请求只需追加事件，文件在服务器
+    运行期间或被中断后都可以直接打开。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("[\n")
+        self._first = True
+
+    def write(self, trace: Trace):
+        lines = [json.dumps(event, ensure_ascii=False) for event in trace.chrome_events()]
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line if self._first else ",\n" + line)
+                self._first = False
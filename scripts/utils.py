@@ -136,6 +136,10 @@ def generate_markdown_report(results: dict, output_file: str):
         "peak_memory_gb": "内存峰值 (GB)",
         "avg_tps": "平均生成速度 (tokens/sec)",
         "avg_ttft_sec": "平均首token延迟 (秒)",
+        "baseline_avg_tps": "无draft平均生成速度 (tokens/sec)",
+        "speculative_avg_tps": "投机解码平均生成速度 (tokens/sec)",
+        "speculative_speedup": "投机解码加速比",
+        "draft_acceptance_rate": "draft token接受率",
     }
     for key, label in metric_labels.items():
         if key in metrics:
@@ -159,6 +163,14 @@ def generate_markdown_report(results: dict, output_file: str):
             f"- 生成速度: {test.get('tps', 0):.2f} tokens/sec",
             f"- 总tokens: {test.get('total_tokens', 0)}",
             f"- 生成时间: {test.get('generation_time_sec', 0):.2f} 秒",
+        ])
+        speculative = test.get("speculative")
+        if speculative:
+            lines.append(
+                f"- 投机解码: {speculative['baseline_tps']:.2f} -> {speculative['speculative_tps']:.2f} "
+                f"tokens/sec ({speculative['speedup']:.2f}x), 接受率 {speculative['acceptance_rate']:.1%}"
+            )
+        lines.extend([
             "",
             "**输出预览:**",
             "```",
@@ -33,7 +33,7 @@ echo ""
 # 检查虚拟环境
 if [ ! -d "venv" ]; then
     echo -e "${YELLOW}⚠ 虚拟环境不存在${NC}"
-    echo "请先运行: python3 -m venv venv && source venv/bin/activate && pip install mlx-lm flask flask-cors"
+    echo "请先运行: python3 -m venv venv && source venv/bin/activate && pip install 'mlx-lm>=0.31.2' flask flask-cors"
     exit 1
 fi
 
@@ -46,7 +46,7 @@ echo -e "${GREEN}→ 检查依赖...${NC}"
 python -c "import mlx_lm" 2>/dev/null || {
     echo -e "${YELLOW}⚠ mlx-lm未安装${NC}"
     echo "正在安装..."
-    pip install -q mlx-lm
+    pip install -q 'mlx-lm>=0.31.2'
 }
 
 python -c "import flask" 2>/dev/null || {